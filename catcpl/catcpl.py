@@ -29,10 +29,30 @@ import threading as th
 import collections
 import pandas as pd
 import tkinter as tk
+import tkinter.filedialog
 import os
 import statistics
 import scipy.special
 import queue
+import warnings
+import copy
+import json
+import sqlite3
+import matplotlib.figure
+import matplotlib.ticker
+import matplotlib.backends.backend_agg
+import sys
+import argparse
+import glob
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import socket
+import socketserver
+import inspect
+import functools
+import secrets
+import hmac
 
 import gui.gui_script
 
@@ -50,33 +70,130 @@ class ECommError(Exception):
 # In[39]:
 
 
+#Log records of all threads. The records are appended to a ring buffer (append and popleft of a deque are 
+#thread-safe without a lock) and only formatted when they are read, records below level are discarded unformatted.
+class LogBuffer():
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+    
+    def __init__(self, maxlen:int=10000, level:int=INFO):
+        #the oldest records are dropped if the buffer is not read
+        self.records = collections.deque(maxlen=maxlen)
+        self.level = level
+        self.dropped = 0 #approximate, only for information
+        
+    def enabled(self, level:int) -> bool:
+        return level >= self.level
+    
+    #s is formatted with s.format(*args) when the record is read, args must not be modified afterwards
+    def put(self, level:int, name:str, s:str, args:tuple=()):
+        if level >= self.level:
+            if len(self.records) == self.records.maxlen:
+                self.dropped += 1
+            self.records.append((time.time(),level,name,s,args))
+    
+    #Removes all records and returns them as (time, level, text)
+    def get_all(self) -> list:
+        result = []
+        if self.dropped > 0:
+            result.append((time.time(),self.WARNING,'Warning: {} log messages were dropped.'.format(self.dropped)))
+            self.dropped = 0
+        while True:
+            try:
+                t, level, name, s, args = self.records.popleft()
+            except IndexError:
+                break
+            result.append((t,level,self.format(name,s,args)))
+        return result
+    
+    @staticmethod
+    def format(name:str, s:str, args:tuple=()) -> str:
+        if len(args) > 0:
+            try:
+                s = s.format(*args)
+            except (IndexError, KeyError, ValueError):
+                s = '{} {}'.format(s,args)
+        if s == '' or name == '':
+            return s
+        return '[{}] {}'.format(name,s)
+
+
+#Log file that is renamed to <path>.1 (the older files to .2, .3, ...) when it exceeds max_bytes
+class LogFile():
+    max_bytes = 1000000
+    backup_count = 3
+    
+    def __init__(self, path:str):
+        self.path = path
+        
+    #records: (time, level, text) as returned by LogBuffer.get_all(), all records are written at once
+    def write(self, records:list):
+        text = ''.join('{} {:7} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t)),LogBuffer.level_names[level],s) 
+                       for t, level, s in records if s != '')
+        if text == '':
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(text) > self.max_bytes:
+                self.rotate()
+            with open(self.path, 'a') as f:
+                f.write(text)
+        except OSError as e:
+            print('Log file {} could not be written: {}'.format(self.path,e))
+    
+    def rotate(self):
+        for i in range(self.backup_count-1,0,-1):
+            if os.path.exists('{}.{}'.format(self.path,i)):
+                os.replace('{}.{}'.format(self.path,i),'{}.{}'.format(self.path,i+1))
+        os.replace(self.path,self.path+'.1')
+
+
 class LogObject():
     log_name = ''
     initialized = False
-    log_queue = None
+    log_queue = None #LogBuffer, without a buffer messages are printed directly
+    print_log = True
+    show_error_dialog = True #False without GUI (e.g. batch processing)
+    gui_bus = None #GUIUpdateBus, set by the Controller for all objects
     
     def log(self, s: str, error: bool=False, noID: bool=False):
-        if s == '':
-            ss = ''
-        elif noID:
-            ss = s
+        if error:
+            level = LogBuffer.ERROR
+        elif s.startswith('Warning'):
+            level = LogBuffer.WARNING
         else:
-            ss = '[{}] {}'.format(self.log_name,s)
-        print(ss)
+            level = LogBuffer.INFO
+        self.log_record(level,'' if noID else self.log_name,s)
+    
+    #Debug messages (e.g. every device query) are only formatted (s.format(*args)) if the debug level is enabled
+    def log_debug(self, s: str, *args):
+        if not self.log_queue is None and self.log_queue.enabled(LogBuffer.DEBUG):
+            self.log_queue.put(LogBuffer.DEBUG,self.log_name,s,args)
         
-        if error or ss.lower().find('error') != -1:
-            self.show_error_diag(ss)
-            
-        if not (self.log_queue is None):
-            self.log_queue.put(ss)
+    def log_record(self, level:int, name:str, s:str, args:tuple=()):
+        if self.log_queue is None:
+            ss = LogBuffer.format(name,s,args)
+            if self.print_log:
+                print(ss)
+            if self.show_error_dialog and level >= LogBuffer.ERROR:
+                self.show_error_diag(ss)
+        else:
+            #printing and error dialogs are handled by the reader of the buffer
+            self.log_queue.put(level,name,s,args)
         
     def log_ask(self, q:str):
-        self.log('<< {}'.format(q))
+        self.log_debug('<< {}',q)
         
     def log_answer(self,s:str):
-        self.log('>> {}'.format(s))
+        self.log_debug('>> {}',s)
         
     def show_error_diag(self, s:str):
+        #windows can only be created in the GUI thread
+        if not self.gui_bus is None and not self.gui_bus.in_gui_thread():
+            self.gui_bus.post(None,lambda: self.show_error_diag(s))
+            return
         
         def place_central():
             win.attributes("-alpha", 0.0)
@@ -154,7 +271,7 @@ class PEM(VisaDevice):
     
     float_acc = 0.025 #accuracy for checking float values like the wavelength when setting amplitude
     
-    def initialize(self, rm:pyvisa.ResourceManager, log_queue:queue.Queue) -> bool:
+    def initialize(self, rm:pyvisa.ResourceManager, log_queue:LogBuffer) -> bool:
         self.rm = rm
         self.log_queue = log_queue
         try:
@@ -308,7 +425,8 @@ class Mono(VisaDevice):
     log_name = 'MON'
     
     #rm = ResourceManager
-    def initialize(self,rm:pyvisa.ResourceManager,log_queue:queue.Queue) -> bool:
+    #full_check = False skips the movement of the grating in check_response
+    def initialize(self,rm:pyvisa.ResourceManager,log_queue:LogBuffer,full_check:bool=True) -> bool:
         self.rm = rm
         self.log_queue = log_queue
         try:
@@ -322,7 +440,7 @@ class Mono(VisaDevice):
             self.log("Error connecting to: "+self.name+", try using a different USB port: "+str(e),True)
             return False
             
-        if self.check_response():
+        if self.check_response(full_check):
             self.log("Test successful!")
             initialized = True
             return True
@@ -331,16 +449,20 @@ class Mono(VisaDevice):
             return False
             
     #The test runs the same commands twice and checks whether they produce the same results
-    def check_response(self) -> bool:
+    #If full is True, the grating is moved to 1000 nm and back to 0 nm in addition, otherwise only the identity of the device is checked
+    def check_response(self,full:bool=True) -> bool:
         r1 = self.log_query('MODEL')
         r2 = self.log_query('SERIAL')
         r3 = self.log_query('MODEL')
         r4 = self.log_query('SERIAL')
+        identity_ok = (r1 == r3) and (r2 == r4) and (self.model in r1) and (self.serial in r2)
+        if not full:
+            return identity_ok
         self.log("Move to 1000 nm...")
         r5 = self.log_query('1000 GOTO')
         self.log("Move to 0 nm...")
         r6 = self.log_query('0 GOTO')
-        return (r1 == r3) and (r2 == r4) and (self.model in r1) and (self.serial in r2) and (self.ok in r5) and (self.ok in r6)       
+        return identity_ok and (self.ok in r5) and (self.ok in r6)       
         
     def retry_query(self,q:str,n:int=3) -> str:
         success = False
@@ -407,11 +529,36 @@ class MFLI(LogObject):
     
     sqrt2 = np.sqrt(2)
     
-    def __init__(self,ID:str,logname:str,log_queue:queue.Queue):
+    node_rel_tol = 0.001 #relative tolerance when comparing node values with the values on the device
+    #nodes (last part of the path) that are compared with an absolute tolerance instead, e.g. 0.001 of a phase of 160° would be 0.16°
+    node_abs_tol = {'phaseshift': 1e-6} #deg
+    max_poll_step = 0.05 #s, max. duration of one poll() call, limits how long the api session is locked by read_data
+    
+    #oscilloscope sampling rate = 60 MHz/2^scope_time
+    scope_time = 0
+    clockbase = 60e6 #Hz, timestamps of the samples are counted in ticks of the device clock, read at connect
+    pem_freq = 50e3 #Hz, nominal modulation frequency of the PEM
+    
+    def __init__(self,ID:str,logname:str,log_queue:LogBuffer):
         self.devID = ID #ID of the device, for example dev3902
         self.devPath = '/'+self.devID+'/'
         self.log_name = logname
         self.log_queue = log_queue
+        #node path (relative to devPath) -> value of all nodes set by apply_node_config
+        self.applied_config = {}
+        #One API session is shared by data acquisition, oscilloscope monitoring and control functions
+        #Every call to the API is done while holding api_lock, so that the threads can use the session alternately
+        #(e.g. the oscilloscope is read between two poll() calls of read_data)
+        self.api_lock = th.RLock()
+        #True while read_data or read_ac_theta are collecting demodulator data
+        self.acquiring = False
+        #PMTWatchdog that checks the polled demodulator data, set by the Controller
+        self.watchdog = None
+    
+    #Hz, follows scope_time if it is changed
+    @property
+    def scope_rate(self) -> float:
+        return 60e6/2**self.scope_time
     
     def connect(self) -> bool:
         try:
@@ -425,6 +572,7 @@ class MFLI(LogObject):
 
             #Issue a warning and return False if the release version of the API used in the session (daq) does not have the same release version as the Data Server (that the API is connected to).
             zhinst.utils.utils.api_server_version_check(self.daq)
+            self.clockbase = float(self.daq.getInt(self.devPath+'clockbase'))
             return True
         except Exception as e:
             self.log('Error connecting: {}'.format(str(e)),True)
@@ -433,7 +581,8 @@ class MFLI(LogObject):
     def disconnect(self):
         self.log('Disconnecting...')
         try:
-            self.daq.disconnectDevice(self.devID)
+            with self.api_lock:
+                self.daq.disconnectDevice(self.devID)
         except Exception as e:
             self.log('Error during disconnecting: {}'.format(str(e)),True)
         
@@ -445,68 +594,28 @@ class MFLI(LogObject):
     def setup_for_scope(self) -> bool:
         return self.setup_device(False,False,False,False,False,False,True)    
     
+    #initialize the api session for data acquisition and oscilloscope monitoring
+    def setup_for_daq_and_scope(self,bessel,bessel_lp) -> bool:
+        return self.setup_device(True,True,True,True,True,True,True,bessel,bessel_lp)
+    
     def setup_device(self,pmt:bool,ch1:bool,ch2:bool,ch3:bool,ch4:bool,daqm:bool,scp:bool,bessel:float=0.0,bessel_lp:float=0.0) -> bool:
+        self.api_lock.acquire()
         try:
-            if pmt:
-                self.log('Setting up device...')
-                self.log('PMT voltage control...')
-                #Set upper and lower limit for PMT control voltage via Aux Out 1 of MFLI
-                self.daq.setDouble(self.devPath+'auxouts/0/limitlower', self.pmt_low_limit)
-                self.daq.setDouble(self.devPath+'auxouts/0/limitupper', self.pmt_high_limit)
-                #Set output of Aux Out 1 to Manual
-                self.daq.setInt(self.devPath+'auxouts/0/outputselect', -1)
-                self.set_PMT_voltage(0.0,False)
-                self.set_input_range(3.0)
-
-            if ch1:
-                self.log('Channel 1...')
-                #Channel 1 (AC, CPL)
-                self.daq.setInt(self.devPath+'demods/0/adcselect', 0)                
-                self.daq.setInt(self.devPath+'extrefs/0/enable', 0)
-                self.daq.setDouble(self.devPath+'demods/0/phaseshift', self.phaseoffset)
-                self.daq.setInt(self.devPath+'demods/0/oscselect', 0)     
-                self.daq.setDouble(self.devPath+'sigins/0/scaling', 1)     
-                #filter timeconst
-                self.daq.setInt(self.devPath+'demods/0/order', self.filter_order)
-                self.daq.setDouble(self.devPath+'demods/0/timeconstant', self.time_const)
-                #transfer rate
-                self.daq.setDouble(self.devPath+'demods/0/rate', self.sampling_rate)   
-                self.daq.setInt(self.devPath+'demods/0/enable', 1)
-
-            if ch2:
-                self.log('Channel 2...')
-                #Channel 2 (ExtRef)
-                self.daq.setInt(self.devPath+'demods/1/adcselect', 8)
-                self.daq.setInt(self.devPath+'extrefs/0/enable', 1)
-                #deactivate data transfer
-                self.daq.setInt(self.devPath+'demods/1/enable', 0)
-
-            if ch3:
-                self.log('Channel 3...')
-                #Channel 3 (DC, 0 Hz)
-                self.daq.setInt(self.devPath+'demods/2/adcselect', 0)
-                self.daq.setDouble(self.devPath+'oscs/1/freq', 0)
-                self.daq.setDouble(self.devPath+'demods/2/phaseshift', self.dc_phaseoffset)
-                self.daq.setInt(self.devPath+'demods/2/order', self.filter_order)
-                self.daq.setDouble(self.devPath+'demods/2/timeconstant', self.time_const)                
-                self.daq.setDouble(self.devPath+'demods/2/rate', self.sampling_rate)
-                self.daq.setInt(self.devPath+'demods/2/enable', 1)
+            self.log('Setting up device...')
+            if scp:
+                self.log('Oscilloscope module...')
+                self.scope = self.daq.scopeModule()
+                self.scope.set('averager/weight', 0)
+                self.scope.set('averager/restart', 0)
+                self.scope.set('mode', 1)
+                self.scope.set('/historylength', 1)
                 
-            if ch4:
-                self.log('Channel 4...')
-                #Channel 4 (2f, linear polarization)
-                self.daq.setInt(self.devPath+'extrefs/1/enable', 0)
-                self.daq.setInt(self.devPath+'demods/3/adcselect', 0)
-                self.daq.setDouble(self.devPath+'demods/3/phaseshift', self.phaseoffset + self.rel_lp_phaseoffset) 
-                self.daq.setInt(self.devPath+'demods/3/oscselect', 0)  
-                self.daq.setInt(self.devPath+'demods/3/harmonic', 2)
-                self.daq.setDouble(self.devPath+'sigins/0/scaling', 1)     
-                #filter timeconst
-                self.daq.setInt(self.devPath+'demods/3/order', self.filter_order)
-                self.daq.setDouble(self.devPath+'demods/3/timeconstant', self.time_const)
-                #transfer rate
-                self.daq.setDouble(self.devPath+'demods/3/rate', self.sampling_rate) 
-                self.daq.setInt(self.devPath+'demods/3/enable', 1)
+            self.apply_node_config(self.get_node_config(pmt,ch1,ch2,ch3,ch4,scp))
+            
+            if pmt:
+                self.pmt_volt = 0.0
+                self.signal_range = self.daq.getDouble(self.devPath+'sigins/0/range')
+                self.log('PMT voltage set to {:.3f} V, signal range set to {:.3f} V.'.format(self.pmt_volt,self.signal_range))
 
             if daqm:
                 self.node_paths = [self.devPath+'demods/0/sample',
@@ -516,41 +625,145 @@ class MFLI(LogObject):
                 self.bessel_corr_lp = bessel_lp
 
             if scp:
-                self.log('Oscilloscope...')
-                self.scope = self.daq.scopeModule()
-                self.scope.set('averager/weight', 0)
-                self.scope.set('averager/restart', 0)
-                self.scope.set('mode', 1)
-                #set scope sampling rate to 60 MHz
-                self.daq.setInt(self.devPath+'scopes/0/time', 0)
-                self.daq.setInt(self.devPath+'scopes/0/trigenable', 0)
-                self.daq.setInt(self.devPath+'scopes/0/enable', 0)
-
                 self.scope.unsubscribe('*')
                 self.scope.subscribe(self.devPath+'scopes/0/wave')
-                self.daq.setDouble(self.devPath+'scopes/0/length', 4096)
-                self.scope.set('/historylength', 1)
-                self.daq.setInt(self.devPath+'scopes/0/enable', 0)
-                self.daq.setInt(self.devPath+'scopes/0/channels/0/inputselect', 0)
-
-            # Perform a global synchronisation between the device and the data server:
-            # Ensure that the settings have taken effect on the device before issuing
-            # the getSample() command.        
-            self.daq.sync()
             
             self.log('Setup complete.')
             return True
         except Exception as e:
             self.log('Error in MFLI setup: '+str(e),True)
             return False
+        finally:
+            self.api_lock.release()
+    
+    #Returns the settings of the selected parts of the device as dict: node path (relative to devPath) -> value
+    def get_node_config(self,pmt:bool,ch1:bool,ch2:bool,ch3:bool,ch4:bool,scp:bool) -> dict:
+        config = {}
+        if pmt:
+            #Set upper and lower limit for PMT control voltage via Aux Out 1 of MFLI
+            config['auxouts/0/limitlower'] = self.pmt_low_limit
+            config['auxouts/0/limitupper'] = self.pmt_high_limit
+            #Set output of Aux Out 1 to Manual
+            config['auxouts/0/outputselect'] = -1
+            config['auxouts/0/offset'] = 0.0
+            config['sigins/0/range'] = 3.0
+
+        if ch1:
+            #Channel 1 (AC, CPL)
+            config['demods/0/adcselect'] = 0
+            config['extrefs/0/enable'] = 0
+            config['demods/0/phaseshift'] = self.phaseoffset
+            config['demods/0/oscselect'] = 0
+            config['sigins/0/scaling'] = 1.0
+            #filter timeconst
+            config['demods/0/order'] = self.filter_order
+            config['demods/0/timeconstant'] = self.time_const
+            #transfer rate
+            config['demods/0/rate'] = self.sampling_rate
+            config['demods/0/enable'] = 1
+
+        if ch2:
+            #Channel 2 (ExtRef)
+            config['demods/1/adcselect'] = 8
+            config['extrefs/0/enable'] = 1
+            #deactivate data transfer
+            config['demods/1/enable'] = 0
+
+        if ch3:
+            #Channel 3 (DC, 0 Hz)
+            config['demods/2/adcselect'] = 0
+            config['oscs/1/freq'] = 0.0
+            config['demods/2/phaseshift'] = self.dc_phaseoffset
+            config['demods/2/order'] = self.filter_order
+            config['demods/2/timeconstant'] = self.time_const
+            config['demods/2/rate'] = self.sampling_rate
+            config['demods/2/enable'] = 1
+            
+        if ch4:
+            #Channel 4 (2f, linear polarization)
+            config['extrefs/1/enable'] = 0
+            config['demods/3/adcselect'] = 0
+            config['demods/3/phaseshift'] = self.phaseoffset + self.rel_lp_phaseoffset
+            config['demods/3/oscselect'] = 0
+            config['demods/3/harmonic'] = 2
+            config['sigins/0/scaling'] = 1.0
+            #filter timeconst
+            config['demods/3/order'] = self.filter_order
+            config['demods/3/timeconstant'] = self.time_const
+            #transfer rate
+            config['demods/3/rate'] = self.sampling_rate
+            config['demods/3/enable'] = 1
+
+        if scp:
+            #set scope sampling rate to 60 MHz
+            config['scopes/0/time'] = self.scope_time
+            config['scopes/0/trigenable'] = 0
+            config['scopes/0/enable'] = 0
+            config['scopes/0/length'] = 4096
+            config['scopes/0/channels/0/inputselect'] = 0
+        return config
+    
+    #Reads the current values of the nodes (relative to devPath) from the device in one request
+    def read_node_values(self,nodes) -> dict:
+        nodes = list(nodes)
+        with self.api_lock:
+            data = self.daq.get(','.join([self.devPath+node for node in nodes]), True)
+        values = {}
+        for node in nodes:
+            key = (self.devPath+node).lower()
+            if key in data:
+                values[node] = data[key]['value'][0]
+        return values
+    
+    #The device rounds some values (e.g. rate, timeconstant) to the next possible value, therefore floats are compared with a tolerance
+    def node_value_equal(self,node:str,a,b) -> bool:
+        name = node.split('/')[-1]
+        if name in self.node_abs_tol:
+            return abs(float(a)-float(b)) <= self.node_abs_tol[name]
+        return math.isclose(float(a),float(b),rel_tol=self.node_rel_tol,abs_tol=1e-9)
+    
+    #Writes all nodes of config that differ from the values on the device in one transaction and returns the changed nodes
+    def apply_node_config(self,config:dict) -> dict:
+        try:
+            current = self.read_node_values(config.keys())
+        except Exception as e:
+            self.log('Could not read node values, all nodes will be written: {}'.format(str(e)))
+            current = {}
+        
+        changes = {}
+        for node, value in config.items():
+            if not (node in current and self.node_value_equal(node,current[node],value)):
+                changes[node] = value
+        
+        with self.api_lock:
+            if len(changes) > 0:
+                self.daq.set([(self.devPath+node, value) for node, value in changes.items()])
+            # Perform a global synchronisation between the device and the data server:
+            # Ensure that the settings have taken effect on the device before issuing
+            # the getSample() command.        
+            self.daq.sync()
+        
+        self.applied_config.update(config)
+        self.log('{:d} of {:d} nodes changed.'.format(len(changes),len(config)))
+        return changes
+    
+    #Returns the current values of all nodes that were configured by apply_node_config (for the parameter file)
+    def get_config_snapshot(self) -> dict:
+        try:
+            values = self.read_node_values(self.applied_config.keys())
+            return {node: values.get(node,value) for node, value in self.applied_config.items()}
+        except Exception as e:
+            self.log('Could not read node values: {}'.format(str(e)))
+            return dict(self.applied_config)
         
     def set_PMT_voltage(self,volt:float,autorange:bool=True):
         self.log('')
         self.log('Setting PMT voltage to: {:.3f} V'.format(volt))
         if (volt <= self.pmt_high_limit) and (volt >= self.pmt_low_limit):
-            self.daq.setDouble(self.devPath+'auxouts/0/offset', volt)
-            self.pmt_volt = volt
-            self.daq.sync()
+            with self.api_lock:
+                self.daq.setDouble(self.devPath+'auxouts/0/offset', volt)
+                self.pmt_volt = volt
+                self.daq.sync()
                    
             self.log('Please wait 10 s for stabilization before starting a measurement.')
             if autorange:
@@ -560,14 +773,16 @@ class MFLI(LogObject):
             self.log("PMT voltage not set because out of range (0.0-1.1 V): "+str(volt)+" V")
    
     def set_input_range(self,f:float,auto:bool=False):
-        if auto:
-            self.daq.setInt(self.devPath+'sigins/0/autorange', 1)
-        else:
-            self.daq.setDouble(self.devPath+'sigins/0/range', f)
-        self.daq.sync()            
+        with self.api_lock:
+            if auto:
+                self.daq.setInt(self.devPath+'sigins/0/autorange', 1)
+            else:
+                self.daq.setDouble(self.devPath+'sigins/0/range', f)
+            self.daq.sync()            
         time.sleep(1.5)
-        self.daq.sync()
-        self.signal_range = self.daq.getDouble(self.devPath+'sigins/0/range')
+        with self.api_lock:
+            self.daq.sync()
+            self.signal_range = self.daq.getDouble(self.devPath+'sigins/0/range')
         self.log('')
         self.log('Signal range adjusted to {:.3f} V.'.format(self.signal_range)) 
         
@@ -584,41 +799,70 @@ class MFLI(LogObject):
     
     def set_phaseoffset(self,f:float):
         self.phaseoffset = f
-        self.daq.setDouble(self.devPath+'demods/0/phaseshift', self.phaseoffset)
-        self.daq.setDouble(self.devPath+'demods/3/phaseshift', self.phaseoffset)    
-        self.daq.sync()
+        with self.api_lock:
+            self.daq.setDouble(self.devPath+'demods/0/phaseshift', self.phaseoffset)
+            self.daq.setDouble(self.devPath+'demods/3/phaseshift', self.phaseoffset)    
+            self.daq.sync()
         self.log('Phase offset set to {:.3f} deg'.format(self.phaseoffset))
     
     #activate oscilloscope
     def start_scope(self):
-        self.scope.set('clearhistory', 1)
-        self.scope.execute()
-        self.daq.setInt(self.devPath+'scopes/0/enable', 1)
-        self.daq.sync()        
+        with self.api_lock:
+            self.scope.set('clearhistory', 1)
+            self.scope.execute()
+            self.daq.setInt(self.devPath+'scopes/0/enable', 1)
+            self.daq.sync()        
     
     #read data from oscilloscope and return max. and avg. signal
     def read_scope(self):
-        data = self.scope.read(True)
+        wave = self.read_scope_wave()
+        if wave is None:
+            return [float('nan'),float('nan')]
+        else:
+            return [wave.max(),statistics.mean(wave)]
+    
+    #returns the last recorded oscilloscope trace or None if no new trace is available
+    #The device time of its last sample (s) and the time between two samples are stored in wave_time and wave_dt
+    def read_scope_wave(self):
+        with self.api_lock:
+            data = self.scope.read(True)
         
-        max_volt = 0.0
+        wave = None
         if self.devPath+'scopes/0/wave' in data:
-            if 'wave' in data[self.devPath+'scopes/0/wave'][0][0]:
-                for chunk in data[self.devPath+'scopes/0/wave'][0][0]['wave']:
-                    max_volt = max(max_volt,chunk.max())
-                    avg_volt = statistics.mean(chunk)
-            else:
-                max_volt = float('nan')
-                avg_volt = float('nan')
-        else:
-            max_volt = float('nan')
-            avg_volt = float('nan')                    
-            
-        return [max_volt,avg_volt]
+            record = data[self.devPath+'scopes/0/wave'][0][0]
+            if 'wave' in record:
+                for chunk in record['wave']:
+                    wave = chunk
+                self.wave_time = record['timestamp']/self.clockbase
+                self.wave_dt = record['dt']
+        return wave
+    
+    #current time of the device clock in s, the timestamps of the samples refer to this clock
+    def read_device_time(self) -> float:
+        with self.api_lock:
+            return self.daq.getInt(self.devPath+'status/time')/self.clockbase
+    
+    #returns the frequency of the external reference (PEM) and whether the lock-in amplifier is locked to it
+    def read_ref_status(self):
+        values = self.read_node_values(['oscs/0/freq','extrefs/0/locked'])
+        return float(values.get('oscs/0/freq',float('nan'))), bool(values.get('extrefs/0/locked',0))
+    
+    #on_trip(level, latency) is called after the watchdog switched off the PMT
+    def create_watchdog(self,log_queue:LogBuffer,on_trip=None):
+        return PMTWatchdog(self,log_queue,on_trip)
+    
+    #Emergency shutdown of the PMT, requires only api_lock and not the locks of the Controller
+    def zero_pmt_voltage(self):
+        with self.api_lock:
+            self.daq.setDouble(self.devPath+'auxouts/0/offset', 0.0)
+            self.daq.sync()
+            self.pmt_volt = 0.0
     
     def stop_scope(self):
-        self.scope.finish()
-        self.daq.setInt(self.devPath+'scopes/0/enable', 0)
-        self.daq.sync()              
+        with self.api_lock:
+            self.scope.finish()
+            self.daq.setInt(self.devPath+'scopes/0/enable', 0)
+            self.daq.sync()              
         
     #deactivate external reference for a certain oscillator. Used for measurements without modulation by PEM
     def set_extref_active(self,osc_index:int,b:bool):
@@ -626,7 +870,12 @@ class MFLI(LogObject):
             i = 1 #on
         else:
             i = 0 #off
-        self.daq.setInt(self.devPath+'extrefs/'+str(osc_index)+'/enable', i)
+        with self.api_lock:
+            self.daq.setInt(self.devPath+'extrefs/'+str(osc_index)+'/enable', i)
+            
+    def sync(self):
+        with self.api_lock:
+            self.daq.sync()
     
     #reads demodulator data from MFLI and returns calculated glum etc. 
     #This function is run in a separate thread, that can be aborted by ext_abort_flag[0]
@@ -641,11 +890,18 @@ class MFLI(LogObject):
                 return arr[-n:]
         
         def subscribe_to_nodes(paths):
-            #Subscribe to data streams
-            for path in paths:
-                self.daq.subscribe(path)  
-            #clear buffer
-            self.daq.sync()  
+            with self.api_lock:
+                #Subscribe to data streams
+                for path in paths:
+                    self.daq.subscribe(path)  
+                #clear buffer
+                self.daq.sync()  
+        
+        # only the demodulator nodes of this function are unsubscribed, the oscilloscope module is not affected
+        def unsubscribe_from_nodes(paths):
+            with self.api_lock:
+                for path in paths:
+                    self.daq.unsubscribe(path)
             
         # ensures that all nodes send data regardless of whether the values changed or not
         def prepare_nodes(paths):
@@ -654,7 +910,7 @@ class MFLI(LogObject):
         
         # collects data chunks from MFLI using the low-level poll() command and aligns the channels according to their timestamps
         def poll_data(paths) -> np.array:  
-            poll_time_step = min(0.1, self.dwell_time*1.3)
+            poll_time_step = min(self.max_poll_step, self.dwell_time*1.3)
         
             # initialize array for raw data
             raw_xy = [[[],[],[]],[[],[],[]],[[],[],[]]] # array_x = sample (0, 2, 3), array_y = timestep, x, y
@@ -665,32 +921,41 @@ class MFLI(LogObject):
             expected_poll_count = np.ceil(self.data_set_size/data_per_step)           
             
             # start data buffering
-            subscribe_to_nodes(paths)
+            self.acquiring = True
+            try:
+                subscribe_to_nodes(paths)
             
-            i = 0
-            while (data_count < self.data_set_size) and not ext_abort_flag[0] and (i < expected_poll_count+10):
-                prepare_nodes(paths)
-                # collects data for poll_time_step
-                data_chunk = self.daq.poll(poll_time_step, 100, 0, True)
+                i = 0
+                while (data_count < self.data_set_size) and not ext_abort_flag[0] and (i < expected_poll_count+10):
+                    # the api session is only locked for one poll step, so that the oscilloscope can be read in between
+                    with self.api_lock:
+                        prepare_nodes(paths)
+                        # collects data for poll_time_step
+                        data_chunk = self.daq.poll(poll_time_step, 100, 0, True)
                 
-                if is_data_complete(data_chunk, self.node_paths):                
-                    # add new data to raw_xy
-                    for j in range(0,3):
-                        raw_xy[j][0].extend(data_chunk[self.node_paths[j]]['timestamp'])
-                        raw_xy[j][1].extend(data_chunk[self.node_paths[j]]['x'])
-                        raw_xy[j][2].extend(data_chunk[self.node_paths[j]]['y'])
+                    if is_data_complete(data_chunk, self.node_paths):                
+                        # the PMT watchdog checks every sample of AC and DC
+                        if not self.watchdog is None:
+                            self.watchdog.check_demod(data_chunk[self.node_paths[0]], data_chunk[self.node_paths[1]])
+                        # add new data to raw_xy
+                        for j in range(0,3):
+                            raw_xy[j][0].extend(data_chunk[self.node_paths[j]]['timestamp'])
+                            raw_xy[j][1].extend(data_chunk[self.node_paths[j]]['x'])
+                            raw_xy[j][2].extend(data_chunk[self.node_paths[j]]['y'])
                 
-                # find overlap of timestamps between the three samples
-                last_overlap = np.intersect1d(np.intersect1d(np.array(raw_xy[0][0]),np.array(raw_xy[1][0])),np.array(raw_xy[2][0]))
-                data_count = last_overlap.size
+                    # find overlap of timestamps between the three samples
+                    last_overlap = np.intersect1d(np.intersect1d(np.array(raw_xy[0][0]),np.array(raw_xy[1][0])),np.array(raw_xy[2][0]))
+                    data_count = last_overlap.size
                 
-                # if only a few values are missing, reduce the poll time accordingly
-                if self.data_set_size-data_count < data_per_step:
-                    poll_time_step = max(math.ceil((self.data_set_size-data_count)/self.sampling_rate * 1.2), 0.025)
+                    # if only a few values are missing, reduce the poll time accordingly
+                    if self.data_set_size-data_count < data_per_step:
+                        poll_time_step = max(min((self.data_set_size-data_count)/self.sampling_rate * 1.2, self.max_poll_step), 0.025)
                 
-                i += 1
-            # Stop data buffering
-            self.daq.unsubscribe('*')
+                    i += 1
+            finally:
+                # Stop data buffering
+                unsubscribe_from_nodes(paths)
+                self.acquiring = False
             
             # identify the timestamps that are identical in all three samples, reduce number of data points to data_set_size (to avoid different numbers of data points at different wavelenghts)
             overlap_timestamps = np_array_tail(last_overlap, int(self.data_set_size))
@@ -829,206 +1094,2824 @@ class MFLI(LogObject):
         self.log('Recording AC theta...')
         
         #This function uses poll instead of read for performance reasons. Also no temporal alignment of the data is required
-        self.daq.subscribe(path)
-        self.daq.sync()
-        
-        while not ext_abort_flag[0]:
-            data_chunk = self.daq.poll(0.1, 50, 0, True)
-            if path in data_chunk:
-                x = data_chunk[path]['x']
-                y = data_chunk[path]['y']
-                new_theta = np.arctan2(y,x)*180/np.pi
-                theta.extend(new_theta)
-                self.ac_theta_avg = np.average(theta)
-                self.ac_theta_count = len(theta)
-
-        self.daq.unsubscribe('*')
-        self.daq.sync()
+        self.acquiring = True
+        try:
+            with self.api_lock:
+                self.daq.subscribe(path)
+                self.daq.sync()
+            
+            while not ext_abort_flag[0]:
+                with self.api_lock:
+                    data_chunk = self.daq.poll(0.1, 50, 0, True)
+                if path in data_chunk:
+                    x = data_chunk[path]['x']
+                    y = data_chunk[path]['y']
+                    new_theta = np.arctan2(y,x)*180/np.pi
+                    theta.extend(new_theta)
+                    self.ac_theta_avg = np.average(theta)
+                    self.ac_theta_count = len(theta)
+        finally:
+            with self.api_lock:
+                self.daq.unsubscribe(path)
+                self.daq.sync()
+            self.acquiring = False
         self.log('Stop recording AC theta...')
         ext_abort_flag[0] = False
         return self.ac_theta_avg
             
 
 
-# In[44]:
+# In[ ]:
 
 
-#Dialog that guides the user through the phase offset calibration
-class PhaseOffsetCalibrationDialog(LogObject):
-    update_interval = 1000 #ms
-    
-    log_name = 'CAL'
+#Protects the PMT from too high signals
+#The watchdog reads the oscilloscope in its own thread as fast as possible and additionally checks every AC and DC sample
+#that is polled by MFLI.read_data. If the signal is above shutdown_threshold for trip_count consecutive values of one source,
+#the PMT control voltage is set to 0 V directly via the MFLI without waiting for the locks of the Controller.
+class PMTWatchdog(LogObject):
+    log_name = 'WDG'
     
-    new_offset = 0.0
-    current_average = 0.0
-    current_datapoints_count = 0
+    shutdown_threshold = 2.95 #V
+    trip_count = 3 #number of consecutive values above shutdown_threshold
+    scope_interval = 0.005 #s, delay between two oscilloscope reads
     
-    skipped_pos_cal = False
-    skipped_neg_cal = False
+    sqrt2 = np.sqrt(2)
     
-    def __init__(self, ctrl):
-        self.controller = ctrl
-        self.log_queue = ctrl.log_queue
+    #on_trip(level:float, latency:float) is called after the PMT was switched off
+    def __init__(self, mfli:MFLI, log_queue:LogBuffer, on_trip=None):
+        self.mfli = mfli
+        self.log_queue = log_queue
+        self.on_trip = on_trip
+        #on_wave(wave) is called with every new oscilloscope trace
+        self.on_wave = None
         
-        #Setting up the window
-        self.window = tk.Toplevel()
-        self.window.title('Phaseoffset Calibration')
-        self.window.resizable(False, False)
-        self.window.configure(bg = "#EBFFE8")
-        #stay on top of main window
-        self.window.attributes('-topmost', 'true')
-        #Disable X buttton
-        self.window.protocol("WM_DELETE_WINDOW", self.disable_event)
-
-        self.lbl_text = tk.Label(self.window, text='Insert a sample, move to a suitable wavelength and adjust gain to obtain strong positive CPL (e.g. Eu(facam)3 in DMSO at 613 nm)',  font=("Arial", 18), width=40,height=5,wraplength=600, bg = "#EBFFE8")
-        self.lbl_text.pack()
-        self.lbl_time = tk.Label(self.window, text='Time passed (>1200 s recommended): 0 s', font=("Arial", 14),bg = "#EBFFE8")
-        self.lbl_time.pack()
-        self.lbl_datapoints = tk.Label(self.window, text='Number of data points: 0', font=("Arial", 14),bg = "#EBFFE8")
-        self.lbl_datapoints.pack()
-        self.lbl_average = tk.Label(self.window, text='Average phase: 0 deg', font=("Arial", 14),bg = "#EBFFE8")
-        self.lbl_average.pack()
-        self.lbl_avg_pos = tk.Label(self.window, text='Average pos. phase: --', font=("Arial", 14),bg = "#EBFFE8")
-        self.lbl_avg_pos.pack()
-        self.lbl_avg_neg = tk.Label(self.window, text='Average neg. phase: --', font=("Arial", 14),bg = "#EBFFE8")
-        self.lbl_avg_neg.pack()
-        self.btn_next = tk.Button(self.window, text='Next', command=self.next_step, font=("Arial", 14))
-        self.btn_next.pack()
-        self.btn_skip = tk.Button(self.window, text='Skip', command=self.skip, font=("Arial", 14))
-        self.btn_skip.pack()
-        self.btn_close = tk.Button(self.window, text='Close', command=self.close, font=("Arial", 14))
-        self.btn_close.pack()
+        self.stop_trigger = False
+        self.thread = None
+        #check() is called from the watchdog thread (scope) and from the acquisition thread (demod)
+        self.check_lock = th.Lock()
+        self.count = {'scope': 0, 'demod': 0}
+        #device time (s) of the first of the consecutive values above threshold
+        self.first_above = {'scope': 0.0, 'demod': 0.0}
         
-        self.step = 0
-        self.t0 = 0.0
+        #latest oscilloscope values
+        self.max_volt = float('nan')
+        self.avg_volt = float('nan')
+        self.wave = None
+        #number of traces read so far, is incremented after the values above are updated
+        self.wave_count = 0
         
-    def next_step(self):
-        self.step += 1
+        #reaction latency = time between the first value above threshold and the confirmed shutdown of the PMT
+        #= detection delay (until trip_count values were checked) + shutdown time (setting the PMT voltage)
+        self.last_latency = float('nan')
+        self.last_detection_delay = float('nan')
+        self.last_shutdown_time = float('nan')
+        self.trip_history = [] #[time, source, level, latency, detection delay, shutdown time]
+    
+    def start(self):
+        self.stop_trigger = False
+        self.thread = th.Thread(target=self.run)
+        self.thread.start()
         
-        if self.step == 1:
-            self.lbl_text.config(text = 'Collecting phase of positive CPL ')
-            self.t0 = time.time()
-            self.window.after(self.update_interval, self.update_loop) 
-            self.controller.cal_start_record_thread(positive=True)
-            
-        elif self.step == 2:
-            self.controller.cal_stop_record()
-            if self.skipped_pos_cal:
-                self.lbl_avg_pos.config(text = 'Average pos. phase: skipped')
-            else:
-                current_values = self.controller.cal_get_current_values()
-                self.lbl_avg_pos.config(text = 'Average pos. phase: {:.3f} deg'.format(current_values[0]))
-            self.reset_labels()
-            self.lbl_text.config(text = 'Insert a sample, move to a suitable wavelength and adjust gain to obtain strong negative CPL (e.g. Eu(facam)3 in DMSO at 595 nm)')                
-            
-        elif self.step == 3:
-            self.lbl_text.config(text = 'Collecting phase of negative CPL')
-            self.t0 = time.time()
-            self.window.after(self.update_interval, self.update_loop) 
-            self.controller.cal_start_record_thread(positive=False)
-            
-        elif self.step == 4:
-            self.controller.cal_stop_record()
-            #wait for cal_theta_thread to stop
-            self.show_summary_after_thread()
+    def stop(self):
+        self.stop_trigger = True
+        if not self.thread is None:
+            self.thread.join()
             
-        elif self.step == 5:
-            self.controller.cal_apply_new()
-            self.controller.cal_end()
-            self.window.destroy()
+    def is_alive(self) -> bool:
+        return not self.thread is None and self.thread.is_alive()
     
-    #wait for the measurement thread to finish before showing the results
-    def show_summary_after_thread(self):
-        if not self.controller.cal_theta_thread is None:
-            if self.controller.cal_theta_thread.is_alive():
-                self.window.after(100,self.show_summary_after_thread)
-            else:
-                self.show_summary()
-        else:
-            self.show_summary()
+    #will be executed in separate thread
+    def run(self):
+        while not self.stop_trigger:
+            wave = self.mfli.read_scope_wave()
+            if not wave is None:
+                self.wave = wave
+                self.max_volt = wave.max()
+                self.avg_volt = wave.mean()
+                self.wave_count += 1
+                self.check('scope',[self.max_volt],[self.mfli.wave_time-(wave.size-1-wave.argmax())*self.mfli.wave_dt])
+                if not self.on_wave is None:
+                    self.on_wave(wave)
+            time.sleep(self.scope_interval)
     
-    def show_summary(self):
-        if self.skipped_neg_cal:
-            self.lbl_avg_neg.config(text = 'Average neg. phase: skipped')
-        else:
-            current_values = self.controller.cal_get_current_values()
-            self.lbl_avg_neg.config(text = 'Average neg. phase: {:.3f} deg'.format(current_values[0]))
-            
-        self.new_offset = self.controller.cal_get_new_phaseoffset(self.skipped_pos_cal,self.skipped_neg_cal)
-        self.btn_skip['state'] = 'disabled'
+    #ac_sample, dc_sample: demodulator samples as returned by poll()
+    #The signal level is estimated as mean (DC) + amplitude of the modulation (AC) in V
+    def check_demod(self, ac_sample:dict, dc_sample:dict):
+        n = min(len(ac_sample['x']),len(dc_sample['x']))
+        ac_r = np.sqrt(np.square(ac_sample['x'][:n]) + np.square(ac_sample['y'][:n]))
+        dc_r = np.sqrt(np.square(dc_sample['x'][:n]) + np.square(dc_sample['y'][:n]))
+        self.check('demod',dc_r/self.sqrt2 + ac_r*self.sqrt2,np.asarray(dc_sample['timestamp'][:n])/self.mfli.clockbase)
         
-        if self.skipped_pos_cal and self.skipped_neg_cal:
-            self.lbl_text.config(text = 'Calibration was skipped.')
-            self.btn_next['state'] = 'disabled'
-        else:
-            self.lbl_text.config(text = 'The new phase offset was determined to: {:.3f} degrees. Do you want to apply this value?'.format(self.new_offset))
-            self.btn_next.config(text = 'Save')
-    
-    def skip(self):
-        if self.step == 0:
-            self.log('Pos. phase: skipped')
-            self.skipped_pos_cal = True
-            self.step += 1
-            self.next_step()
-        elif self.step == 1:
-            self.log('Pos. phase: skipped')            
-            self.skipped_pos_cal = True
-            self.next_step()
-        elif self.step == 2:
-            self.log('Neg. phase: skipped')            
-            self.skipped_neg_cal = True
-            self.step += 1
-            self.next_step()                
-        elif self.step == 3:
-            self.log('Neg. phase: skipped')            
-            self.skipped_neg_cal = True
-            self.next_step()                
-                
-    def update_loop(self):
-        if self.step in [1,3] and self.controller.cal_running:
-            self.lbl_time.config(text = 'Time passed (>1200 s recommended): {:.0f} s'.format(time.time()-self.t0))
-            current_values = self.controller.cal_get_current_values()
-            self.lbl_average.config(text = 'Average phase: {:.3f} deg'.format(current_values[0]))
-            self.lbl_datapoints.config(text = 'Number of data points: {}'.format(current_values[1]))
-            self.window.after(self.update_interval, self.update_loop) 
-    
-    def reset_labels(self):
-        self.lbl_time.config(text = 'Time passed (>1200 s recommended): 0 s')
-        self.lbl_average.config(text = 'Average phase: 0 deg')
-        self.lbl_datapoints.config(text = 'Number of data points: 0')
+    #Counts the consecutive values above shutdown_threshold and switches off the PMT when trip_count is reached
+    #times: device time (s) when the levels were measured
+    def check(self, source:str, levels, times):
+        tripped = False
+        with self.check_lock:
+            for level, t in zip(levels,times):
+                if level >= self.shutdown_threshold:
+                    if self.count[source] == 0:
+                        self.first_above[source] = t
+                    self.count[source] += 1
+                    if self.count[source] >= self.trip_count:
+                        tripped = True
+                        trip_level = level
+                        first_above = self.first_above[source]
+                        self.count[source] = 0
+                        break
+                else:
+                    self.count[source] = 0
+        #nothing to do if the PMT is already switched off
+        if tripped and self.mfli.pmt_volt > 0.0:
+            self.trip(source,trip_level,first_above)
+            
+    #first_above: device time (s) of the first value above threshold
+    def trip(self, source:str, level:float, first_above:float):
+        t_detect = time.perf_counter()
+        self.mfli.zero_pmt_voltage()
+        t_off = time.perf_counter()
         
-    def close(self):      
-        self.log('Calibration aborted.')
-        if self.step in [1,3]:
-            self.controller.cal_stop_record()
-        self.controller.cal_end_after_thread()
+        #The age of the first value is taken from the device clock, so that the time until the data was polled and checked is included
+        try:
+            age = self.mfli.read_device_time()-first_above
+            self.last_detection_delay = age-(time.perf_counter()-t_detect)
+        except Exception as e:
+            self.log('Device time could not be read: {}'.format(str(e)))
+            self.last_detection_delay = float('nan')
+        self.last_shutdown_time = t_off-t_detect
+        self.last_latency = self.last_detection_delay+self.last_shutdown_time
+        self.trip_history.append([time.time(),source,level,self.last_latency,self.last_detection_delay,self.last_shutdown_time])
+        self.log('Signal ({:.2f} V, {}) higher than threshold ({:.2f} V)!! PMT set to 0 V after {:.1f} ms (detection {:.1f} ms, shutdown {:.1f} ms).'.format(
+            level,source,self.shutdown_threshold,self.last_latency*1000,self.last_detection_delay*1000,self.last_shutdown_time*1000),True)
+        if not self.on_trip is None:
+            self.on_trip(level,self.last_latency)
         
-    def disable_event(self):
-        pass
-    
 
-
-# In[45]:
+# In[ ]:
 
 
-#Combines the individual components and controls the main window
-class Controller(LogObject):
-    version = '1.0.1'
+#Ring buffer of float64 records in shared memory that is written by one process. The number of written records is 
+#stored in front of the records and only increased after a record is complete. Readers keep their own position
+#and lose the oldest records if they read too slowly.
+class SharedRing():
+    #name: attach to an existing ring (see spec), otherwise a new ring is created
+    def __init__(self, capacity:int, record_size:int, name:str=None):
+        self.capacity = capacity
+        self.record_size = record_size
+        self.owner = name is None
+        if self.owner:
+            self.shm = multiprocessing.shared_memory.SharedMemory(create=True, size=8*(1+capacity*record_size))
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        self.counter = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((capacity,record_size), dtype=np.float64, buffer=self.shm.buf, offset=8)
+        if self.owner:
+            self.counter[0] = 0
     
-    lowpass_filter_risetime = 0.6 #s, depends on the timeconstant of the low pass filter
-    shutdown_threshold = 2.95 #Vl
-    osc_refresh_delay = 100 #ms
-    log_update_interval = 200 #ms
-    spec_refresh_delay = 1000 #ms
-    move_delay = 0.2 #s, additional delay after changing wavelength
+    #arguments of the constructor to attach to the ring in another process
+    def spec(self) -> tuple:
+        return (self.capacity,self.record_size,self.shm.name)
     
-    #A warning is printed if one value of lp_theta_std is below the threshold
-    #as this indicates the presence of linear polarization in the emission
-    lp_theta_std_warning_threshold = 1.0
+    #number of records written so far
+    @property
+    def count(self) -> int:
+        return int(self.counter[0])
     
-    input_ranges = ['0.003','0.010','0.030','0.100','0.300','1.000','3.000']
+    #values can be shorter than a record, returns the index of the record
+    def write(self, values) -> int:
+        n = self.count
+        self.records[n % self.capacity,:len(values)] = values
+        self.counter[0] = n + 1
+        return n
     
-    log_name = 'CTRL'
+    #Returns a copy of record index or None if it was already overwritten
+    def get(self, index:int) -> np.array:
+        if index < self.count - self.capacity or index >= self.count:
+            return None
+        record = self.records[index % self.capacity].copy()
+        #the record might have been overwritten while it was copied
+        if index < self.count - self.capacity:
+            return None
+        return record
+    
+    def latest(self) -> np.array:
+        return self.get(self.count - 1)
+    
+    #Returns the records from index start on that are still available and the index of the next record
+    def read(self, start:int):
+        end = self.count
+        start = max(start,end - self.capacity)
+        data = self.records[np.arange(start,end) % self.capacity]
+        overwritten = self.count - self.capacity
+        if overwritten > start:
+            data = data[overwritten-start:]
+        return data, end
+    
+    def close(self):
+        #the numpy views must be released before the shared memory can be closed
+        del self.counter, self.records
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+#Runs the lock-in amplifier (MFLI with PMT watchdog) in its own process, so that polling and evaluating the 
+#demodulator data and reading the oscilloscope do not compete with the GUI and matplotlib for the GIL. 
+#Commands are received from MFLIProcess over a pipe and executed in separate threads as in the GUI process. The 
+#results of read_data, the oscilloscope traces and the state of the MFLI are published in SharedRings.
+class AcquisitionEngine(LogObject):
+    log_name = 'ENG'
+    
+    state_fields = ['acquiring','pmt_volt','signal_range','phaseoffset','dwell_time','ac_theta_avg','ac_theta_count']
+    result_size = 19 #call id, success, number of values, 16 values of read_data
+    scope_length = 4096 #samples per oscilloscope trace (scopes/0/length)
+    publish_interval = 0.02 #s, state and log messages
+    
+    def __init__(self, conn, ID:str, logname:str, rings:dict):
+        self.conn = conn
+        self.send_lock = th.Lock()
+        self.log_queue = LogBuffer()
+        self.mfli = MFLI(ID,logname,self.log_queue)
+        self.result_ring = SharedRing(*rings['results'])
+        self.scope_ring = SharedRing(*rings['scope'])
+        self.state_ring = SharedRing(*rings['state'])
+        self.watchdog = None
+        #call id -> abort flag of read_data or read_ac_theta
+        self.flags = {}
+        self.stop_trigger = False
+    
+    #Entry point of the process
+    @staticmethod
+    def run_process(conn, ID:str, logname:str, rings:dict):
+        AcquisitionEngine(conn,ID,logname,rings).run()
+    
+    def send(self, msg:tuple):
+        with self.send_lock:
+            self.conn.send(msg)
+    
+    def run(self):
+        publisher = th.Thread(target=self.publish_loop)
+        publisher.start()
+        while not self.stop_trigger:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == 'call':
+                call_id, method, args, flag = msg[1:]
+                if not flag is None:
+                    self.flags[call_id] = [flag]
+                th.Thread(target=self.execute,args=(call_id,method,args),daemon=True).start()
+            elif msg[0] == 'abort':
+                if msg[1] in self.flags:
+                    self.flags[msg[1]][0] = True
+            elif msg[0] == 'quit':
+                self.stop_trigger = True
+        
+        self.stop_watchdog()
+        publisher.join()
+        for ring in [self.result_ring,self.scope_ring,self.state_ring]:
+            ring.close()
+    
+    def execute(self, call_id:int, method:str, args:tuple):
+        flag = self.flags.get(call_id)
+        try:
+            if method == 'read_data':
+                data = self.mfli.read_data(flag)
+                #the values are published in the ring, the reply only contains the index
+                values = np.asarray(data['data'],dtype=np.float64)
+                result = self.result_ring.write(np.concatenate(([call_id,data['success'],values.size],values)))
+            elif method == 'read_ac_theta':
+                result = self.mfli.read_ac_theta(flag)
+            elif method == 'start_watchdog':
+                result = self.start_watchdog(*args)
+            elif method == 'stop_watchdog':
+                result = self.stop_watchdog()
+            else:
+                result = getattr(self.mfli,method)(*args)
+            reply = ('reply',call_id,True,result)
+        except Exception as e:
+            reply = ('reply',call_id,False,'{}: {}'.format(type(e).__name__,e))
+        #the state is up to date when the reply arrives
+        self.publish_state()
+        self.send(reply+(None if flag is None else flag[0],))
+        self.flags.pop(call_id,None)
+    
+    def start_watchdog(self, threshold:float):
+        self.watchdog = self.mfli.create_watchdog(self.log_queue,lambda level, latency: self.send(('trip',level,latency)))
+        self.watchdog.shutdown_threshold = threshold
+        self.watchdog.on_wave = self.publish_wave
+        self.mfli.watchdog = self.watchdog
+        self.watchdog.start()
+        
+    def stop_watchdog(self):
+        if not self.watchdog is None:
+            self.watchdog.stop()
+            self.mfli.watchdog = None
+            self.watchdog = None
+    
+    #record: time, max., average, number of samples, samples
+    def publish_wave(self, wave:np.array):
+        n = min(wave.size,self.scope_length)
+        self.scope_ring.write(np.concatenate(([time.time(),self.watchdog.max_volt,self.watchdog.avg_volt,n],wave[:n])))
+        
+    def publish_state(self):
+        self.state_ring.write([float(getattr(self.mfli,field)) for field in self.state_fields])
+    
+    def publish_loop(self):
+        while not self.stop_trigger:
+            self.publish_state()
+            self.send_log()
+            time.sleep(self.publish_interval)
+        self.send_log()
+            
+    def send_log(self):
+        records = self.log_queue.get_all()
+        if len(records) > 0:
+            self.send(('log',records))
+            
+
+#Has the methods of MFLI that are used by the Controller and executes them in an AcquisitionEngine process
+class MFLIProcess(MFLI):
+    
+    def __init__(self, ID:str, logname:str, log_queue:LogBuffer):
+        self.devID = ID
+        self.devPath = '/'+self.devID+'/'
+        self.log_name = logname
+        self.log_queue = log_queue
+        self.watchdog = None
+        
+        self.result_ring = SharedRing(16,AcquisitionEngine.result_size)
+        self.scope_ring = SharedRing(8,4+AcquisitionEngine.scope_length)
+        self.state_ring = SharedRing(4,len(AcquisitionEngine.state_fields))
+        rings = {'results': self.result_ring.spec(), 'scope': self.scope_ring.spec(), 'state': self.state_ring.spec()}
+        
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.send_lock = th.Lock()
+        #call id -> {'done': th.Event, 'reply': (success, result, flag)}
+        self.calls = {}
+        self.call_count = 0
+        self.process = multiprocessing.Process(target=AcquisitionEngine.run_process,args=(child_conn,ID,logname,rings),daemon=True)
+        self.process.start()
+        self.receiver = th.Thread(target=self.receive_loop,daemon=True)
+        self.receiver.start()
+    
+    #Executes method of the MFLI in the engine process and returns its result
+    #abort_flag: list whose first element aborts read_data or read_ac_theta, the final value is copied back
+    def call(self, method:str, *args, abort_flag:list=None):
+        entry = {'done': th.Event()}
+        try:
+            with self.send_lock:
+                self.call_count += 1
+                call_id = self.call_count
+                self.calls[call_id] = entry
+                self.conn.send(('call',call_id,method,args,None if abort_flag is None else abort_flag[0]))
+        except OSError:
+            raise ECommError('{} failed: the acquisition process is not running.'.format(method))
+        
+        aborted = False
+        while not entry['done'].wait(0.01):
+            if not self.receiver.is_alive():
+                self.calls.pop(call_id,None)
+                entry['reply'] = (False,'The acquisition process ended.',True)
+                break
+            if not aborted and not abort_flag is None and abort_flag[0]:
+                with self.send_lock:
+                    self.conn.send(('abort',call_id))
+                aborted = True
+        
+        success, result, flag = entry['reply']
+        if not abort_flag is None:
+            abort_flag[0] = flag
+        if not success:
+            raise ECommError('{} failed in the acquisition process: {}'.format(method,result))
+        return result
+    
+    #Replies, log messages and watchdog trips from the engine process
+    def receive_loop(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == 'reply':
+                entry = self.calls.pop(msg[1],None)
+                if not entry is None:
+                    entry['reply'] = msg[2:]
+                    entry['done'].set()
+            elif msg[0] == 'log':
+                for t, level, text in msg[1]:
+                    self.log_record(level,'',text)
+            elif msg[0] == 'trip':
+                if not self.watchdog is None and not self.watchdog.on_trip is None:
+                    self.watchdog.on_trip(msg[1],msg[2])
+        
+        #the process ended, waiting calls fail
+        for call_id in list(self.calls):
+            entry = self.calls.pop(call_id)
+            entry['reply'] = (False,'The acquisition process ended.',True)
+            entry['done'].set()
+    
+    def get_state(self, field:str) -> float:
+        state = self.state_ring.latest()
+        if state is None:
+            return getattr(MFLI,field,0.0)
+        return state[AcquisitionEngine.state_fields.index(field)]
+    
+    @property
+    def acquiring(self) -> bool:
+        return bool(self.get_state('acquiring'))
+    
+    @property
+    def pmt_volt(self) -> float:
+        return self.get_state('pmt_volt')
+    
+    @property
+    def signal_range(self) -> float:
+        return self.get_state('signal_range')
+    
+    @property
+    def phaseoffset(self) -> float:
+        return self.get_state('phaseoffset')
+    
+    @property
+    def dwell_time(self) -> float:
+        return self.get_state('dwell_time')
+    
+    @property
+    def ac_theta_avg(self) -> float:
+        return self.get_state('ac_theta_avg')
+    
+    @property
+    def ac_theta_count(self) -> int:
+        return int(self.get_state('ac_theta_count'))
+    
+    def connect(self) -> bool:
+        return self.call('connect')
+    
+    def disconnect(self):
+        self.call('disconnect')
+        
+    #Ends the engine process
+    def close(self):
+        if self.process.is_alive():
+            with self.send_lock:
+                self.conn.send(('quit',))
+            self.process.join(5)
+        self.conn.close()
+        for ring in [self.result_ring,self.scope_ring,self.state_ring]:
+            ring.close()
+    
+    def setup_for_daq_and_scope(self,bessel,bessel_lp) -> bool:
+        return self.call('setup_for_daq_and_scope',bessel,bessel_lp)
+    
+    def get_config_snapshot(self) -> dict:
+        return self.call('get_config_snapshot')
+    
+    def set_PMT_voltage(self,volt:float,autorange:bool=True):
+        self.call('set_PMT_voltage',volt,autorange)
+        
+    def set_input_range(self,f:float,auto:bool=False):
+        self.call('set_input_range',f,auto)
+        
+    def set_dwell_time(self,t:float):
+        self.call('set_dwell_time',t)
+    
+    def set_phaseoffset(self,f:float):
+        self.call('set_phaseoffset',f)
+    
+    def start_scope(self):
+        self.call('start_scope')
+    
+    def stop_scope(self):
+        self.call('stop_scope')
+    
+    def read_ref_status(self):
+        return self.call('read_ref_status')
+    
+    def set_extref_active(self,osc_index:int,b:bool):
+        self.call('set_extref_active',osc_index,b)
+    
+    def sync(self):
+        self.call('sync')
+        
+    def zero_pmt_voltage(self):
+        self.call('zero_pmt_voltage')
+    
+    def read_data(self,ext_abort_flag:list) -> dict:
+        record = self.result_ring.get(self.call('read_data',abort_flag=ext_abort_flag))
+        if record is None:
+            self.log('Result of read_data was overwritten before it was read.',True)
+            return {'success': False, 'data': np.zeros(14)}
+        return {'success': bool(record[1]), 'data': record[3:3+int(record[2])]}
+    
+    def read_ac_theta(self,ext_abort_flag:list) -> float:
+        return self.call('read_ac_theta',abort_flag=ext_abort_flag)
+    
+    def create_watchdog(self,log_queue:LogBuffer,on_trip=None):
+        return WatchdogProcess(self,on_trip)
+    
+
+#PMT watchdog in the engine process of an MFLIProcess, the oscilloscope values are read from the shared ring
+class WatchdogProcess():
+    shutdown_threshold = PMTWatchdog.shutdown_threshold
+    
+    def __init__(self, mfli:MFLIProcess, on_trip=None):
+        self.mfli = mfli
+        self.on_trip = on_trip
+        self.started = False
+        
+    def start(self):
+        self.mfli.call('start_watchdog',self.shutdown_threshold)
+        self.started = True
+        
+    def stop(self):
+        self.mfli.call('stop_watchdog')
+        self.started = False
+        
+    def is_alive(self) -> bool:
+        return self.started and self.mfli.process.is_alive()
+    
+    def get_scope(self, i:int) -> float:
+        record = self.mfli.scope_ring.latest()
+        if record is None:
+            return float('nan')
+        return record[i]
+    
+    @property
+    def wave_count(self) -> int:
+        return self.mfli.scope_ring.count
+    
+    @property
+    def max_volt(self) -> float:
+        return self.get_scope(1)
+    
+    @property
+    def avg_volt(self) -> float:
+        return self.get_scope(2)
+    
+    @property
+    def wave(self) -> np.array:
+        record = self.mfli.scope_ring.latest()
+        if record is None:
+            return None
+        return record[4:4+int(record[3])]
+
+
+# In[ ]:
+
+
+#Vectorized analysis of one oscilloscope trace: spectrum (PEM 1f/2f, mains pickup), clipping and headroom
+class ScopeAnalyzer():
+    mains_freq = 50.0 #Hz
+    clip_level = 0.99 #fraction of the input range above which a sample counts as clipped
+    #tolerance of the reference frequency with respect to the nominal PEM frequency
+    pem_freq_tol = 0.05
+    
+    def __init__(self):
+        #Hann windows are cached by trace length
+        self.windows = {}
+        
+    def get_window(self, n:int) -> np.array:
+        if not n in self.windows:
+            self.windows[n] = np.hanning(n)
+        return self.windows[n]
+    
+    #wave: trace in V, sample_rate in Hz, signal_range = input range in V, 
+    #ref_freq = frequency of the PEM reference in Hz, ref_locked = lock status of the external reference
+    def analyze(self, wave:np.array, sample_rate:float, signal_range:float, ref_freq:float, ref_locked:bool, pem_freq:float) -> dict:
+        n = wave.size
+        window = self.get_window(n)
+        
+        #single-sided amplitude spectrum in V (peak), the window is normalized by its sum
+        spectrum = np.abs(np.fft.rfft((wave-wave.mean())*window))*2/window.sum()
+        bin_width = sample_rate/n
+        
+        #Amplitude of a frequency component: max. of the three bins around the frequency (to include leakage of the window)
+        def amplitude_at(f:float) -> float:
+            if (f < bin_width) or (f >= sample_rate/2) or np.isnan(f):
+                return float('nan')
+            i = int(round(f/bin_width))
+            return spectrum[max(i-1,1):i+2].max()
+        
+        abs_wave = np.abs(wave)
+        peak = abs_wave.max()
+        amp_1f = amplitude_at(ref_freq)
+        amp_2f = amplitude_at(2*ref_freq)
+        #mains pickup can only be resolved if the trace covers at least two periods
+        if n/sample_rate >= 2/self.mains_freq:
+            amp_mains = amplitude_at(self.mains_freq)
+        else:
+            amp_mains = float('nan')
+        
+        return {'max_volt': wave.max(),
+                'avg_volt': wave.mean(),
+                'amp_1f': amp_1f,
+                'amp_2f': amp_2f,
+                'ratio_2f_1f': amp_2f/amp_1f if amp_1f > 0 else float('nan'),
+                'amp_mains': amp_mains,
+                'clip_fraction': np.count_nonzero(abs_wave >= self.clip_level*signal_range)/n,
+                'headroom': signal_range/peak if peak > 0 else float('inf'),
+                'ref_freq': ref_freq,
+                'pem_lock_ok': bool(ref_locked) and abs(ref_freq-pem_freq) <= self.pem_freq_tol*pem_freq}
+
+
+# In[ ]:
+
+
+#Spectrum with preallocated storage: one row per quantity (row 0 = wavelength), one column per point of the planned wavelength grid
+class SpectrumBuffer():
+    wl_decimals = 3 #wavelengths are matched after rounding to this number of decimals (pm)
+    
+    def __init__(self, wavelengths:np.array, n_rows:int):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        self.buffer = np.full((n_rows, self.wavelengths.size), np.nan)
+        self.count = 0
+        #lookup wavelength -> column
+        self.columns = {self.wl_key(wl): i for i, wl in enumerate(self.wavelengths)}
+        
+    def wl_key(self, wl:float) -> float:
+        return round(float(wl), self.wl_decimals)
+    
+    #Returns the column of a wavelength of the grid or -1
+    def find(self, wl:float) -> int:
+        return self.columns.get(self.wl_key(wl), -1)
+    
+    #values: one value per row, the first value is the wavelength
+    def append(self, values):
+        if self.count >= self.buffer.shape[1]:
+            raise IndexError('SpectrumBuffer is full ({} points)'.format(self.buffer.shape[1]))
+        self.buffer[:,self.count] = values
+        self.count += 1
+    
+    #View (no copy) of the points recorded so far
+    @property
+    def data(self) -> np.array:
+        return self.buffer[:,:self.count]
+    
+    def __len__(self) -> int:
+        return self.count
+
+
+#Ring buffer of the latest capacity points of a kinetics measurement for the display, the rows are the same as in a
+#SpectrumBuffer with the time (s) instead of the wavelength. The memory does not grow during long measurements.
+class KineticsBuffer():
+    def __init__(self, capacity:int, n_rows:int):
+        self.buffer = np.full((n_rows, capacity), np.nan)
+        self.count = 0 #number of appended points, including the overwritten ones
+    
+    def append(self, values):
+        self.buffer[:,self.count % self.buffer.shape[1]] = values
+        self.count += 1
+    
+    #Copy of the points in the buffer in chronological order
+    @property
+    def data(self) -> np.array:
+        capacity = self.buffer.shape[1]
+        if self.count <= capacity:
+            return self.buffer[:,:self.count].copy()
+        i = self.count % capacity
+        return np.concatenate((self.buffer[:,i:],self.buffer[:,:i]),axis=1)
+    
+    #Averages of n consecutive points (all rows). The blocks are counted from the first point of the measurement,
+    #so that they do not change when old points are overwritten. An incomplete last block is left out.
+    def get_block_averages(self, n:int) -> np.array:
+        data = self.data
+        skip = (-(self.count - data.shape[1])) % n
+        m = (data.shape[1] - skip)//n
+        return data[:,skip:skip+m*n].reshape(data.shape[0],m,n).mean(axis=2)
+    
+    def __len__(self) -> int:
+        return min(self.count,self.buffer.shape[1])
+
+    
+#Online average of repeated spectra on the same wavelength grid. The buffer contains the mean of every value row 
+#and the propagated standard deviation (sqrt(sum(std**2))/n) of every std row in the same layout as the added data.
+class SpectrumStats(SpectrumBuffer):
+    
+    #std_rows: rows that contain standard deviations, all other rows except the wavelength are averaged
+    def __init__(self, wavelengths:np.array, n_rows:int, std_rows):
+        super().__init__(wavelengths, n_rows)
+        self.buffer[0] = self.wavelengths
+        self.std_rows = np.array(std_rows, dtype=int)
+        self.value_rows = np.array([r for r in range(1,n_rows) if not r in self.std_rows], dtype=int)
+        #number of averaged values and sum of the variances for each wavelength
+        self.n_values = np.zeros(self.wavelengths.size, dtype=int)
+        self.var_sum = np.zeros((self.std_rows.size, self.wavelengths.size))
+        
+    #values: one value per row, the first value is the wavelength. Returns False if the wavelength is not part of the grid.
+    def add(self, values) -> bool:
+        values = np.asarray(values, dtype=float)
+        col = self.find(values[0])
+        if col < 0:
+            return False
+        
+        n = self.n_values[col]+1
+        x = values[self.value_rows]
+        if n == 1:
+            self.buffer[self.value_rows,col] = x
+        else:
+            #Welford update of the mean
+            self.buffer[self.value_rows,col] += (x-self.buffer[self.value_rows,col])/n
+        self.var_sum[:,col] += values[self.std_rows]**2
+        self.buffer[self.std_rows,col] = np.sqrt(self.var_sum[:,col])/n
+        
+        self.n_values[col] = n
+        #data gives all points up to the last averaged wavelength
+        self.count = max(self.count, col+1)
+        return True
+
+
+#Average of complete sets of repeated spectra in one vectorized pass. 
+#spectra: array with the dimensions (repetitions, rows, points), the rows have the layout of SpectrumBuffer,
+#each std row directly follows its value row (e.g. DC, DC_std).
+class SpectrumAverager():
+    methods = ['mean','weighted','sigma_clip','median']
+    sigma_clip_limit = 4.0 #points further than this from the median (in robust standard deviations) are rejected
+    sigma_clip_iterations = 3
+    #a scan is rejected completely if more than this fraction of its points were rejected
+    scan_reject_fraction = 0.5
+    
+    #std_rows: rows that contain standard deviations, clip_rows: value rows used to find outliers
+    def __init__(self, std_rows, clip_rows, method:str='mean'):
+        if not method in self.methods:
+            raise ValueError('Unknown averaging method {} (available: {})'.format(method,', '.join(self.methods)))
+        self.std_rows = np.array(std_rows, dtype=int)
+        self.value_rows = self.std_rows-1
+        self.clip_rows = np.array(clip_rows, dtype=int)
+        self.method = method
+        
+    #Returns a mask (repetitions, points) of rejected points
+    def sigma_clip(self, spectra:np.array) -> np.array:
+        x = spectra[:,self.clip_rows,:]
+        std = spectra[:,self.clip_rows+1,:]
+        std = np.where(std > 0, std, np.nan)
+        rejected = ~np.isfinite(x).all(axis=1)
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            #points without any remaining value give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for i in range(self.sigma_clip_iterations):
+                kept = np.where(rejected[:,np.newaxis,:], np.nan, x)
+                #deviation from the median of the scans in units of the std of each point
+                z = np.abs(kept-np.nanmedian(kept, axis=0))/std
+                #the spread of z is estimated from all points and scans (few scans per point are not sufficient),
+                #z = 0 is excluded as it is the median itself for an odd number of scans
+                sigma = 1.4826*np.nanmedian(np.where(z > 0, z, np.nan), axis=(0,2))
+                outlier = (z > self.sigma_clip_limit*sigma[np.newaxis,:,np.newaxis]).any(axis=1)
+                #outliers can only be identified with at least three scans
+                outlier &= ((~rejected).sum(axis=0) >= 3)[np.newaxis,:]
+                new_rejected = rejected | outlier
+                if (new_rejected == rejected).all():
+                    break
+                rejected = new_rejected
+        
+        #reject whole scans with too many outliers
+        n_points = np.isfinite(spectra[:,0,:]).sum(axis=1)
+        bad_scans = rejected.sum(axis=1) > self.scan_reject_fraction*np.maximum(n_points,1)
+        rejected[bad_scans,:] = True
+        return rejected
+    
+    #Returns the averaged spectrum (rows, points) and a report {'rejected': mask (repetitions, points), 
+    #'rejected_scans': indices of completely rejected scans, 'n_used': number of averaged values per point}
+    def average(self, spectra:np.array):
+        spectra = np.asarray(spectra, dtype=float)
+        n_reps, n_rows, n_points = spectra.shape
+        
+        if self.method == 'sigma_clip':
+            rejected = self.sigma_clip(spectra)
+        else:
+            rejected = np.zeros((n_reps,n_points), dtype=bool)
+        #the same points are excluded from all rows to keep AC and DC consistent
+        used = ~rejected[:,np.newaxis,:] & np.isfinite(spectra[:,self.value_rows,:])
+        n_used = used.sum(axis=0)
+        x = np.where(used, spectra[:,self.value_rows,:], 0.0)
+        var = np.where(used, spectra[:,self.std_rows,:]**2, 0.0)
+        
+        avg = np.full((n_rows,n_points), np.nan)
+        #wavelengths of the points, NaN only if no scan contains the point
+        avg[0] = np.fmax.reduce(spectra[:,0,:], axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            #points without any used value give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            #Gaussian propagation of uncertainty of the mean
+            mean = x.sum(axis=0)/n_used
+            mean_std = np.sqrt(var.sum(axis=0))/n_used
+            if self.method == 'weighted':
+                #inverse-variance weights, values without a valid std fall back to the plain mean
+                w = np.where(used & (var > 0), 1/var, 0.0)
+                w_sum = w.sum(axis=0)
+                avg[self.value_rows] = np.where(w_sum > 0, (w*x).sum(axis=0)/w_sum, mean)
+                avg[self.std_rows] = np.where(w_sum > 0, 1/np.sqrt(w_sum), mean_std)
+            elif self.method == 'median':
+                avg[self.value_rows] = np.nanmedian(np.where(used, spectra[:,self.value_rows,:], np.nan), axis=0)
+                #the standard error of the median of normally distributed values is sqrt(pi/2) times that of the mean
+                avg[self.std_rows] = np.sqrt(np.pi/2)*mean_std
+            else:
+                avg[self.value_rows] = mean
+                avg[self.std_rows] = mean_std
+            
+        return avg, {'rejected': rejected,
+                     'rejected_scans': np.flatnonzero(rejected.all(axis=1)),
+                     'n_used': n_used.min(axis=0)}
+
+
+# In[ ]:
+
+
+#Binary storage of spectra (.npz with one float64 array (columns, points) and the scan parameters as JSON) next to the CSV files.
+#Files are addressed by their path without extension, load() reads both formats.
+class SpectrumFile():
+    extensions = ['.npz','.csv'] #order of preference if both files have the same age
+    #labels in the _params.txt files -> keys of the params dict
+    params_labels = {'Specta Name': 'filename', 'Start WL': 'start_nm', 'End WL': 'end_nm', 'Step': 'step', 
+                     'Dwell time': 'dwell_time', 'Repetitions': 'reps', 'Exc. slit': 'exc_slit', 'Em. slit': 'em_slit', 
+                     'Exc. WL': 'exc_wl', 'Comment': 'comment', 'AC-Blank-File': 'ac_blank', 'DC-Blank-File': 'dc_blank', 
+                     'PEM off': 'pem_off', 'Detector Correction File': 'det_corr', 'PMT voltage': 'pmt_volt', 
+                     'PMT gain': 'pmt_gain', 'Input range': 'input_range', 'Phase offset': 'phaseoffset', 'Averaging': 'avg_method'}
+    
+    #Returns the path of the most recent file of a spectrum or '' if there is none
+    def find(self, base:str) -> str:
+        paths = [base+ext for ext in self.extensions if os.path.exists(base+ext)]
+        if len(paths) == 0:
+            return ''
+        return max(paths, key=lambda path: os.path.getmtime(path))
+    
+    def exists(self, base:str) -> bool:
+        return self.find(base) != ''
+    
+    def save_npz(self, base:str, df:pd.DataFrame, params:dict):
+        #the first column is the index (wavelength)
+        data = np.vstack((df.index.to_numpy(dtype=float), df.to_numpy(dtype=float).T))
+        columns = np.array([df.index.name]+list(df.columns))
+        np.savez(base+'.npz', data=data, columns=columns, params=np.array(self.params_to_json(params)))
+    
+    #numpy values are stored as numbers, everything else that is not JSON serializable as text
+    def params_to_json(self, params:dict) -> str:
+        return json.dumps(params, default=lambda o: o.item() if isinstance(o, np.generic) else str(o))
+    
+    #Returns the spectrum as a DataFrame indexed by wavelength, path with or without extension
+    def load(self, path:str) -> pd.DataFrame:
+        if not os.path.splitext(path)[1] in self.extensions:
+            path = self.find(path)
+        if path.endswith('.npz'):
+            with np.load(path, allow_pickle=False) as f:
+                data = f['data']
+                columns = [str(col) for col in f['columns']]
+            return pd.DataFrame(data[1:].T, columns=columns[1:], index=pd.Index(data[0], name=columns[0]))
+        else:
+            return pd.read_csv(filepath_or_buffer=path, sep=',', index_col='WL')
+    
+    #Returns the scan parameters saved in a binary file or in the _params.txt file of a CSV file, None if there are none
+    def load_params(self, path:str) -> dict:
+        if path.endswith('.npz'):
+            with np.load(path, allow_pickle=False) as f:
+                return json.loads(str(f['params']))
+        base = os.path.splitext(path)[0]
+        if os.path.exists(base+'_params.txt'):
+            return self.read_params_txt(base+'_params.txt')
+        return None
+    
+    #Reads a _params.txt file into a params dict, values are returned as text except for pem_off
+    def read_params_txt(self, path:str) -> dict:
+        params = {key: '' for key in self.params_labels.values()}
+        with open(path, 'r') as f:
+            for line in f:
+                res = re.match(r'(.+?) = (.*?)( nm| s| V| deg)?$', line.rstrip('\n'))
+                if not res is None and res.group(1) in self.params_labels:
+                    params[self.params_labels[res.group(1)]] = res.group(2)
+        params['pem_off'] = int(params['pem_off'] or 0)
+        return params
+
+
+# In[ ]:
+
+
+#Cache of correction tables (detector correction, AC and DC blanks). Files are read again only if their modification
+#time changes and their values are stored after resampling onto the wavelengths of the spectrum.
+#Files are addressed by their path without extension (binary or CSV, see SpectrumFile).
+class CorrectionCache():
+    wl_decimals = SpectrumBuffer.wl_decimals #precision of the wavelength comparison for blanks
+    
+    def __init__(self, spectrum_file:SpectrumFile):
+        #path -> {'mtime': modification time, 'table': DataFrame, 'resampled': {key: array}}
+        self.files = {}
+        self.lock = th.Lock()
+        self.spectrum_file = spectrum_file
+        
+    def get_file(self, base:str) -> dict:
+        path = self.spectrum_file.find(base)
+        if path == '':
+            raise FileNotFoundError('{} does not exist'.format(base))
+        mtime = os.path.getmtime(path)
+        entry = self.files.get(path)
+        if (entry is None) or (entry['mtime'] != mtime):
+            table = self.spectrum_file.load(path).sort_index()
+            entry = {'mtime': mtime, 'table': table, 'resampled': {}}
+            self.files[path] = entry
+        return entry
+    
+    #Returns an array with the values of the correction file resampled onto the given wavelengths or None if the file 
+    #does not cover them. columns = None gives the first column. resample(table, columns, wavelengths) calculates the values,
+    #the result is cached for each resample function.
+    def get(self, base:str, columns, wavelengths:np.array, resample) -> np.array:
+        wavelengths = np.round(np.asarray(wavelengths, dtype=float), self.wl_decimals)
+        with self.lock:
+            entry = self.get_file(base)
+            table = entry['table']
+            if columns is None:
+                columns = [table.columns[0]]
+            key = (tuple(columns), resample.__name__, wavelengths.tobytes())
+            if not key in entry['resampled']:
+                entry['resampled'][key] = resample(table, columns, wavelengths)
+            return entry['resampled'][key]
+    
+    #Linear interpolation within the wavelength range of the file, gives an array (columns, wavelengths)
+    def interpolate(self, table:pd.DataFrame, columns:list, wavelengths:np.array) -> np.array:
+        table_wl = np.round(table.index.to_numpy(dtype=float), self.wl_decimals)
+        if (wavelengths.size == 0) or (table_wl.size == 0):
+            return None
+        #Check if the wavelength region of the spectrum is covered by the correction file
+        if (wavelengths.min() < table_wl[0]) or (wavelengths.max() > table_wl[-1]):
+            return None
+        
+        result = np.empty((len(columns), wavelengths.size))
+        for i, col in enumerate(columns):
+            values = table[col].to_numpy(dtype=float)
+            valid = np.isfinite(values)
+            result[i] = np.interp(wavelengths, table_wl[valid], values[valid])
+        return result
+
+
+#Library of the AC and DC blank measurements in the data folder. Blanks are served on the wavelength grid of any scan:
+#values are linearly interpolated between the measured points and their standard deviations are propagated.
+#Each use of a blank is recorded in blank_usage.csv.
+class BlankLibrary():
+    data_path = ".\\data\\"
+    usage_file = "blank_usage.csv"
+    max_gap = 5.0 #nm, no interpolation between blank points that are further apart
+    
+    def __init__(self, cache:CorrectionCache):
+        self.cache = cache
+        self.usage_lock = th.Lock()
+        
+    #path of the blank file (binary or CSV)
+    def get_path(self, name:str) -> str:
+        return self.cache.spectrum_file.find(self.data_path+name)
+    
+    #Returns an array with the rows value, std and interpolated (1 if the value was interpolated) for the column kind 
+    #('AC' or 'DC') of the blank at the wavelengths, or None if the blank does not cover them
+    def get(self, name:str, kind:str, wavelengths:np.array) -> np.array:
+        return self.cache.get(self.data_path+name, [kind,kind+'_std'], wavelengths, self.interpolate_blank)
+    
+    def interpolate_blank(self, table:pd.DataFrame, columns:list, wavelengths:np.array) -> np.array:
+        table_wl = np.round(table.index.to_numpy(dtype=float), self.cache.wl_decimals)
+        values = table[columns[0]].to_numpy(dtype=float)
+        std = table[columns[1]].to_numpy(dtype=float)
+        valid = np.isfinite(values) & np.isfinite(std)
+        #sorted blank points without duplicates
+        table_wl, index = np.unique(table_wl[valid], return_index=True)
+        values = values[valid][index]
+        std = std[valid][index]
+        
+        #Check if the wavelength region of the scan is covered by the blank
+        if (wavelengths.size == 0) or (table_wl.size == 0):
+            return None
+        if (wavelengths.min() < table_wl[0]) or (wavelengths.max() > table_wl[-1]):
+            return None
+        if table_wl.size == 1:
+            return np.vstack((np.full(wavelengths.size, values[0]), np.full(wavelengths.size, std[0]), np.zeros(wavelengths.size)))
+        
+        #neighbouring blank points of each wavelength
+        upper = np.clip(np.searchsorted(table_wl, wavelengths), 1, table_wl.size-1)
+        lower = upper-1
+        exact = (table_wl[lower] == wavelengths) | (table_wl[upper] == wavelengths)
+        gap = table_wl[upper]-table_wl[lower]
+        if (gap[~exact] > self.max_gap).any():
+            return None
+        
+        t = (wavelengths-table_wl[lower])/gap
+        interpolated = (1-t)*values[lower] + t*values[upper]
+        #Gaussian propagation of uncertainty, the blank points are independent measurements
+        interpolated_std = (((1-t)*std[lower])**2 + (t*std[upper])**2)**0.5
+        return np.vstack((interpolated, interpolated_std, (~exact).astype(float)))
+    
+    #Appends a line to the usage file: which blank was used for which spectrum
+    def record_usage(self, spectrum:str, kind:str, name:str, interpolated:bool):
+        path = self.data_path+self.usage_file
+        with self.usage_lock:
+            new_file = not os.path.exists(path)
+            with open(path, 'a') as f:
+                if new_file:
+                    f.write('Time,Spectrum,Type,Blank,Blank modified,Interpolated\n')
+                f.write('{},{},{},{},{},{:d}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), spectrum, kind, name,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(self.get_path(name)))), interpolated))
+    
+    #Returns the recorded uses of all blanks or of one blank
+    def get_usage(self, name:str=None) -> pd.DataFrame:
+        path = self.data_path+self.usage_file
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=['Time','Spectrum','Type','Blank','Blank modified','Interpolated'])
+        df = pd.read_csv(path, sep=',', dtype={'Spectrum': str, 'Blank': str})
+        if not name is None:
+            df = df[df['Blank'] == name]
+        return df
+
+
+# In[ ]:
+
+
+#Background thread that saves the results (spectra, parameter files and figures), so that the acquisition does not wait 
+#for the disk or for matplotlib. Jobs must only contain copies of the data. put() blocks while max_jobs are waiting.
+class ResultWriter(LogObject):
+    max_jobs = 16
+    
+    log_name = 'WRT'
+    
+    def __init__(self, log_queue:LogBuffer):
+        self.log_queue = log_queue
+        self.jobs = queue.Queue(maxsize=self.max_jobs)
+        #descriptions of the jobs that failed since the last flush
+        self.failed = []
+        self.failed_lock = th.Lock()
+        self.thread = th.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    #func(*args) is executed in the writer thread, description is used in error messages
+    def put(self, description:str, func, *args):
+        self.jobs.put((description, func, args))
+        
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            description, func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                with self.failed_lock:
+                    self.failed.append(description)
+                self.log('Error while saving {}: {}'.format(description,str(e)),True)
+            self.jobs.task_done()
+    
+    #Waits until all jobs are done, returns the descriptions of the jobs that failed since the last flush
+    def flush(self) -> list:
+        self.jobs.join()
+        with self.failed_lock:
+            failed = self.failed
+            self.failed = []
+        return failed
+    
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+    
+
+# In[ ]:
+
+
+#Journal of a running scan: every measured point is appended and written to disk immediately, so that an interrupted 
+#scan can be resumed. The first line contains the scan parameters as JSON, each further line the repetition and the 
+#values of one point (wavelength first).
+class ScanJournal():
+    extension = '.journal'
+    
+    #base: path of the spectrum without extension
+    def __init__(self, base:str):
+        self.path = base+self.extension
+        self.file = None
+        #(repetition, values) of the points in the journal, filled by load()
+        self.points = []
+        #size of the journal without an incomplete last line
+        self.valid_size = 0
+        
+    #An existing journal (of an interrupted scan) is not overwritten, FileExistsError is raised instead
+    def create(self, params:dict):
+        self.file = open(self.path, 'xb')
+        self.file.write((SpectrumFile().params_to_json(params)+'\n').encode())
+        self.sync()
+    
+    #Reads the parameters (returned) and the points of an existing journal, 
+    #a line that was not completely written (e.g. because of a crash) is ignored
+    def load(self) -> dict:
+        with open(self.path, 'rb') as f:
+            lines = f.read().split(b'\n')
+        params = json.loads(lines[0])
+        self.valid_size = len(lines[0])+1
+        self.points = []
+        #the last element is the text after the last line break
+        for line in lines[1:-1]:
+            values = line.split(b',')
+            try:
+                point = (int(values[0]), np.array([float(v) for v in values[1:]]))
+            except ValueError:
+                break
+            self.points.append(point)
+            self.valid_size += len(line)+1
+        return params
+    
+    #Continues a loaded journal
+    def open_append(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.valid_size)
+        self.file = open(self.path, 'ab')
+        
+    def add_point(self, rep:int, values:np.array):
+        self.file.write((','.join([str(rep)]+[repr(float(v)) for v in values])+'\n').encode())
+        self.sync()
+        
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        
+    def close(self):
+        if not self.file is None:
+            self.file.close()
+            self.file = None
+    
+    #The journal is removed after the scan was completed
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+#Data file of a kinetics measurement. The first line contains the parameters as JSON (after #), the second line the 
+#column names. The points are appended in chunks, so the file is complete up to the last chunk if the program crashes.
+class KineticsFile():
+    suffix = '_kinetics.csv'
+    
+    #base: path without suffix
+    def __init__(self, base:str, columns:list):
+        self.path = base+self.suffix
+        self.columns = columns
+        
+    def create(self, params:dict):
+        with open(self.path, 'w') as f:
+            f.write('#'+SpectrumFile().params_to_json(params)+'\n')
+            f.write(','.join(self.columns)+'\n')
+    
+    #chunk: points x columns
+    def write_chunk(self, chunk:np.array):
+        with open(self.path, 'a') as f:
+            np.savetxt(f, chunk, delimiter=',', fmt='%.10g')
+            
+    #Returns the parameters and the points with the time as index
+    @staticmethod
+    def load(path:str):
+        with open(path, 'r') as f:
+            params = json.loads(f.readline()[1:])
+        return params, pd.read_csv(path, skiprows=1, index_col=0)
+    
+
+# In[ ]:
+
+
+#SQLite catalog of the saved spectra and their scan parameters in the data folder, updated whenever a spectrum is saved.
+#Spectra saved before the catalog existed (or by other programs) are added by index_directory().
+class MeasurementCatalog():
+    db_name = 'catalog.sqlite'
+    #column name -> SQL type, the scan parameters have the keys of the params dict
+    columns = {'name': 'TEXT PRIMARY KEY',
+               'file': 'TEXT',
+               'saved': 'REAL', #modification time of the file
+               'role': 'TEXT', #scan, repetition or average
+               'corrected': 'INTEGER',
+               'type': 'TEXT', #job type of queued measurements (sample, ac_blank or dc_blank)
+               'wl_min': 'REAL',
+               'wl_max': 'REAL',
+               'n_points': 'INTEGER',
+               'start_nm': 'REAL',
+               'end_nm': 'REAL',
+               'step': 'REAL',
+               'dwell_time': 'REAL',
+               'reps': 'INTEGER',
+               'pem_off': 'INTEGER',
+               'pmt_volt': 'REAL',
+               'pmt_gain': 'REAL',
+               'input_range': 'REAL',
+               'phaseoffset': 'REAL',
+               'exc_slit': 'REAL',
+               'em_slit': 'REAL',
+               'exc_wl': 'REAL',
+               'ac_blank': 'TEXT',
+               'dc_blank': 'TEXT',
+               'det_corr': 'TEXT',
+               'avg_method': 'TEXT',
+               'comment': 'TEXT',
+               'params': 'TEXT'} #all scan parameters as JSON
+    def __init__(self, data_path:str, spectrum_file:SpectrumFile):
+        self.data_path = data_path
+        self.path = data_path+self.db_name
+        self.spectrum_file = spectrum_file
+        self.lock = th.Lock()
+        #one connection for all threads, access is serialized by the lock
+        self.db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        with self.lock, self.db as db:
+            db.execute('CREATE TABLE IF NOT EXISTS spectra ({})'.format(', '.join(col+' '+t for col, t in self.columns.items())))
+            db.execute('CREATE INDEX IF NOT EXISTS idx_range ON spectra (pem_off, wl_min, wl_max)')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_saved ON spectra (saved)')
+    
+    #Adds or updates a spectrum, name: name of the file without extension, path: path of the saved file
+    def add(self, name:str, path:str, df:pd.DataFrame, params:dict):
+        suffix = name[len(params.get('filename','')):] if name.startswith(params.get('filename','')) else ''
+        corrected = suffix.endswith('_corr')
+        suffix = suffix[:-len('_corr')] if corrected else suffix
+        if suffix == '_avg':
+            role = 'average'
+        elif re.fullmatch('_[0-9]+', suffix):
+            role = 'repetition'
+        else:
+            role = 'scan'
+        
+        def number(key):
+            try:
+                return float(params[key])
+            except (KeyError, TypeError, ValueError):
+                return None
+        
+        wl = df.index.to_numpy(dtype=float)
+        row = {'name': name, 'file': path, 'saved': os.path.getmtime(path), 'role': role, 'corrected': int(corrected),
+               'type': params.get('type',''), 'wl_min': float(wl.min()) if wl.size > 0 else None, 
+               'wl_max': float(wl.max()) if wl.size > 0 else None, 'n_points': int(wl.size),
+               'params': self.spectrum_file.params_to_json(params)}
+        for key in ['start_nm','end_nm','step','dwell_time','reps','pem_off','pmt_volt','pmt_gain','input_range','phaseoffset','exc_slit','em_slit','exc_wl']:
+            row[key] = number(key)
+        for key in ['ac_blank','dc_blank','det_corr','avg_method','comment']:
+            row[key] = str(params.get(key,''))
+            
+        with self.lock, self.db as db:
+            db.execute('INSERT OR REPLACE INTO spectra ({}) VALUES ({})'.format(', '.join(row.keys()), ', '.join('?'*len(row))), list(row.values()))
+    
+    #Adds all spectra of the data folder that are not in the catalog or were modified, returns the number of added spectra
+    def index_directory(self) -> int:
+        with self.lock, self.db as db:
+            known = dict(db.execute('SELECT file, saved FROM spectra').fetchall())
+        count = 0
+        for entry in os.scandir(self.data_path):
+            base, ext = os.path.splitext(entry.path)
+            if (not ext in self.spectrum_file.extensions) or (known.get(entry.path) == entry.stat().st_mtime):
+                continue
+            #only the most recent file of a spectrum is indexed
+            if self.spectrum_file.find(base) != entry.path:
+                continue
+            try:
+                params = self.spectrum_file.load_params(entry.path)
+                if params is None:
+                    continue
+                df = self.spectrum_file.load(entry.path)
+            except Exception:
+                #not a spectrum (e.g. queue files)
+                continue
+            self.add(os.path.basename(base), entry.path, df, params)
+            count += 1
+        return count
+        
+    #Returns the spectra that fulfill the SQL condition where (with ? for the values in args) as a DataFrame
+    def query(self, where:str='1', args:tuple=(), order:str='saved DESC', limit:int=-1) -> pd.DataFrame:
+        with self.lock, self.db as db:
+            return pd.read_sql_query('SELECT * FROM spectra WHERE {} ORDER BY {} LIMIT ?'.format(where,order), db, params=tuple(args)+(limit,))
+    
+    #Returns the name of the latest uncorrected AC ('AC') or DC ('DC') blank (single scan or average) that covers 
+    #start_nm to end_nm, optionally measured with the given step, or '' if there is none.
+    #AC blanks are measured with the PEM off. Scans started in the GUI have no job type, they count as DC blank 
+    #after they were used as DC blank of another spectrum.
+    def latest_blank(self, kind:str, start_nm:float, end_nm:float, step:float=None) -> str:
+        where = "corrected = 0 AND role IN ('scan','average') AND wl_min <= ? AND wl_max >= ?"
+        args = [min(start_nm,end_nm), max(start_nm,end_nm)]
+        if kind == 'AC':
+            where += " AND (pem_off = 1 OR type = 'ac_blank')"
+        else:
+            where += " AND (type = 'dc_blank' OR name IN (SELECT dc_blank FROM spectra WHERE dc_blank != ''))"
+        if not step is None:
+            where += ' AND abs(step - ?) < 1e-6'
+            args.append(step)
+        result = self.query(where, args, limit=1)
+        if len(result) > 0:
+            return result['name'].iloc[0]
+        return ''
+
+
+# In[ ]:
+
+
+#Processing of saved and measured spectra independent of the GUI and the instruments: conversion, correction, 
+#averaging and saving. Used by the Controller and by the batch processing.
+class SpectrumProcessor(LogObject):
+    columns = ['WL','DC','DC_std','AC','AC_std','I_L','I_L_std','I_R','I_R_std','glum','glum_std','lp_r','lp_r_std','lp_theta','lp_theta_std','lp','lp_std']
+    std_rows = range(2,17,2) #rows with standard deviations in the numpy arrays of spectra
+    clip_rows = [1,3] #DC and AC, used to find outliers when averaging
+    
+    log_name = 'PRC'
+    
+    #data_path: folder of the correction and blank files
+    def __init__(self, log_queue:LogBuffer, data_path:str):
+        self.log_queue = log_queue
+        self.data_path = data_path
+        self.spectrum_file = SpectrumFile()
+        #correction files are only read once as long as they are not modified
+        self.corr_cache = CorrectionCache(self.spectrum_file)
+        self.blank_library = BlankLibrary(self.corr_cache)
+        self.blank_library.data_path = data_path
+        
+    #Averages all scans (repetitions, rows, points) with method (see SpectrumAverager) and reports rejected scans/points
+    def average_spectra(self,all_spec:np.array,method:str) -> pd.DataFrame:
+        self.log('')
+        self.log('Averaging ({})...'.format(method))
+        averager = SpectrumAverager(self.std_rows,self.clip_rows,method)
+        avg, report = averager.average(all_spec)
+        
+        for i in report['rejected_scans']:
+            self.log('Warning: Scan {} was rejected.'.format(i+1),False)
+        for i in range(all_spec.shape[0]):
+            if not i in report['rejected_scans']:
+                wls = all_spec[i,0,report['rejected'][i]]
+                if wls.size > 0:
+                    self.log('Scan {}: rejected points at {} nm'.format(i+1,', '.join('{:.2f}'.format(wl) for wl in wls)))
+        
+        return self.calc_cpl(self.np_to_pd(avg))
+        
+    #converts a numpy array to a pandas DataFrame
+    def np_to_pd(self,spec):
+        df = pd.DataFrame(spec.T)
+        df.columns = self.columns
+        df = df.set_index('WL')
+        return df
+        
+    #spectrum: name of the corrected spectrum, used to record which blanks were used
+    def apply_corr(self,dfspec:pd.DataFrame,ac_blank:str,dc_blank:str,det_corr:str,spectrum:str=''):
+        self.log('')
+        self.log('Baseline correction...')
+        
+        wl = dfspec.index.to_numpy(dtype=float)
+        dc = dfspec['DC'].to_numpy(dtype=float)
+        dc_std = dfspec['DC_std'].to_numpy(dtype=float)
+        ac = dfspec['AC'].to_numpy(dtype=float)
+        ac_std = dfspec['AC_std'].to_numpy(dtype=float)
+        
+        #Correction for detector sensitivity, the correction values are interpolated to match the measured wavelength values
+        if det_corr != '':
+            self.log('Detector sensitivity correction with {}'.format(self.spectrum_file.find(self.data_path+det_corr)))
+            corr = self.corr_cache.get(self.data_path+det_corr,None,wl,self.corr_cache.interpolate)
+            
+            if not corr is None:
+                dc = dc/corr[0]
+                dc_std = dc_std/corr[0]
+                ac = ac/corr[0]
+                ac_std = ac_std/corr[0]
+            else:
+                self.log('Detector correction file does not cover the measured wavelength range!',True)
+        
+        #AC baseline correction, the blank is interpolated if it was measured at other wavelengths
+        if ac_blank != '':
+            self.log('AC blank correction with {}'.format(self.blank_library.get_path(ac_blank)))
+            blank = self.blank_library.get(ac_blank,'AC',wl)
+            
+            if not blank is None:
+                ac = ac - blank[0]
+                ac_std = ((ac_std/2)**2 + (blank[1]/2)**2)**0.5
+                self.log_blank_usage(spectrum,'AC',ac_blank,blank)
+            else:
+                self.log('AC blank file does not cover the measured wavelengths (or its points are more than {} nm apart)!'.format(self.blank_library.max_gap),True)                
+        
+        #DC baseline correction
+        if dc_blank != '':
+            self.log('DC blank correction with {}'.format(self.blank_library.get_path(dc_blank)))
+            blank = self.blank_library.get(dc_blank,'DC',wl)
+            
+            if not blank is None:
+                dc = dc - blank[0]
+                dc_std = ((dc_std/2)**2 + (blank[1]/2)**2)**0.5
+                self.log_blank_usage(spectrum,'DC',dc_blank,blank)
+            else:
+                self.log('DC blank file does not cover the measured wavelengths (or its points are more than {} nm apart)!'.format(self.blank_library.max_gap),True)             
+        
+        dfspec['DC'] = dc
+        dfspec['DC_std'] = dc_std
+        dfspec['AC'] = ac
+        dfspec['AC_std'] = ac_std
+            
+        #If there are NaN values in the blank files, this will give NaN values
+        #Drop all rows that contain NaN values
+        #The user must make sure that the blank files contain the correct values for the measurement
+        dfspec = dfspec.dropna(axis=0)
+        
+        dfspec = self.calc_cpl(dfspec)
+        return dfspec
+        
+    def log_blank_usage(self,spectrum:str,kind:str,name:str,blank:np.array):
+        interpolated = blank[2].any()
+        if interpolated:
+            self.log('{} blank interpolated at {} of {} wavelengths'.format(kind,int(blank[2].sum()),blank.shape[1]))
+        if spectrum != '':
+            self.blank_library.record_usage(spectrum,kind,name,interpolated)
+        
+    def calc_cpl(self,df):
+        df['I_L'] = (df['AC'] + df['DC'])
+        df['I_R'] = (df['DC'] - df['AC'])
+        df['glum'] = 2*df['AC']/df['DC']
+        #Gaussian error progression
+        df['I_L_std'] = ((df['AC_std'])**2 + (df['DC_std'])**2)**0.5
+        df['I_R_std'] = df['I_L_std'].copy()
+        df['glum_std'] = ((2*df['AC_std']/df['DC'])**2 + (2*df['AC']/(df['DC']**2)*df['DC_std'])**2)**0.5        
+        return df
+    
+    #Saves a spectrum in the format 'csv', 'npz' or 'both' together with its parameter file, returns the saved file
+    def write_spectrum(self,base:str,dfspec:pd.DataFrame,params:dict,save_format:str) -> str:
+        if save_format in ['csv','both']:
+            dfspec.to_csv(base+'.csv',index=True)
+            self.log('Data saved as: {}'.format(base+'.csv'))
+        if save_format in ['npz','both']:
+            self.spectrum_file.save_npz(base,dfspec,params)
+            self.log('Data saved as: {}'.format(base+'.npz'))
+        self.save_params(base,params)
+        return self.spectrum_file.find(base)
+    
+    def save_params(self,filename,params:dict):
+        with open(filename+'_params.txt', 'w') as f:
+            f.write('Specta Name = {}\n'.format(params['filename']))
+            f.write('Time = {}\n\n'.format(time.asctime(time.localtime(time.time()))))
+            f.write('Setup parameters\n')        
+            f.write('Start WL = {} nm\n'.format(params['start_nm']))
+            f.write('End WL = {} nm\n'.format(params['end_nm']))
+            f.write('Step = {} nm\n'.format(params['step']))
+            f.write('Dwell time = {} s\n'.format(params['dwell_time']))
+            f.write('Repetitions = {}\n'.format(params['reps']))
+            f.write('Exc. slit = {} nm\n'.format(params['exc_slit']))
+            f.write('Em. slit = {} nm\n'.format(params['em_slit']))
+            f.write('Exc. WL = {} nm\n'.format(params['exc_wl']))
+            f.write('Comment = {}\n'.format(params['comment']))
+            f.write('AC-Blank-File = {}\n'.format(params['ac_blank']))
+            f.write('DC-Blank-File = {}\n'.format(params['dc_blank']))
+            f.write('PEM off = {:d}\n'.format(params['pem_off']))
+            f.write('Detector Correction File = {}\n'.format(params['det_corr']))
+            f.write('PMT voltage = {} V\n'.format(params['pmt_volt']))
+            f.write('PMT gain = {}\n'.format(params['pmt_gain']))
+            f.write('Input range = {}\n'.format(params['input_range']))
+            f.write('Phase offset = {} deg\n'.format(params['phaseoffset']))
+            if 'avg_method' in params:
+                f.write('Averaging = {}\n'.format(params['avg_method']))
+            if 'mfli_config' in params:
+                f.write('\nMFLI configuration\n')
+                for node, value in params['mfli_config'].items():
+                    f.write('{} = {}\n'.format(node,value))
+            f.close()
+        self.log('Parameters saved as: {}'.format(filename+'_params.txt'))
+
+
+# In[ ]:
+
+
+#Correction and averaging of saved spectra without the GUI and the instruments, e.g.
+#python catcpl.py batch ".\\data\\sample*" --ac-blank blank_avg --workers 4
+#python catcpl.py batch ".\\data\\" --average --avg-method sigma_clip
+#The jobs run in parallel processes, the results and a manifest.json with the inputs, corrections and logs 
+#of all jobs are written to a new folder.
+class BatchProcessor(LogObject):
+    log_name = 'BAT'
+    show_error_dialog = False
+    data_path = ".\\data\\"
+    manifest_name = 'manifest.json'
+    
+    #one SpectrumProcessor per process and data path, correction files are cached as long as the process runs
+    processors = {}
+    
+    def parse_args(self, argv:list) -> argparse.Namespace:
+        parser = argparse.ArgumentParser(prog='catcpl.py batch', description='Corrects or averages saved spectra.')
+        parser.add_argument('inputs', nargs='+', help='spectra, folders or patterns (e.g. ".\\data\\sample*"), with or without extension')
+        parser.add_argument('--det-corr', default=None, help='detector correction file (default: from the parameters of each spectrum)')
+        parser.add_argument('--ac-blank', default=None, help='AC blank (default: from the parameters of each spectrum)')
+        parser.add_argument('--dc-blank', default=None, help='DC blank (default: from the parameters of each spectrum)')
+        parser.add_argument('--average', action='store_true', help='average the repetitions <name>_1, <name>_2, ... to <name>_avg')
+        parser.add_argument('--avg-method', default='mean', choices=SpectrumAverager.methods)
+        parser.add_argument('--format', default='csv', choices=['csv','npz','both'])
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of parallel processes')
+        parser.add_argument('--data', default=self.data_path, help='folder of the correction files and blanks')
+        parser.add_argument('--out', default='', help='output folder (default: a new batch_<time> folder in the data folder)')
+        return parser.parse_args(argv)
+    
+    #Returns the paths without extension of all spectra that match the inputs
+    def find_spectra(self, inputs:list, spectrum_file:SpectrumFile) -> list:
+        paths = []
+        for pattern in inputs:
+            if os.path.isdir(pattern):
+                pattern = os.path.join(pattern,'*')
+            matches = glob.glob(pattern)
+            if len(matches) == 0:
+                matches = glob.glob(pattern+'.*')
+            for path in matches:
+                base, ext = os.path.splitext(path)
+                #only files with scan parameters are spectra (not e.g. queue files)
+                if ext in spectrum_file.extensions and not base in paths and not spectrum_file.load_params(path) is None:
+                    paths.append(base)
+        return sorted(paths)
+    
+    #A job is a dict with the kind ('correct' or 'average'), the name of the result and the input files
+    def make_jobs(self, bases:list, average:bool) -> list:
+        jobs = []
+        if average:
+            groups = collections.defaultdict(list)
+            for base in bases:
+                res = re.fullmatch(r'(.*)_([0-9]+)', base)
+                if not res is None:
+                    groups[res.group(1)].append((int(res.group(2)),base))
+            for name, reps in sorted(groups.items()):
+                jobs.append({'kind': 'average', 'name': os.path.basename(name), 'inputs': [base for i, base in sorted(reps)]})
+        else:
+            for base in bases:
+                #corrected spectra are not corrected again
+                if not base.endswith('_corr'):
+                    jobs.append({'kind': 'correct', 'name': os.path.basename(base), 'inputs': [base]})
+        return jobs
+    
+    @classmethod
+    def get_processor(cls, data_path:str) -> SpectrumProcessor:
+        if not data_path in cls.processors:
+            processor = SpectrumProcessor(None,data_path)
+            cls.processors[data_path] = processor
+        return cls.processors[data_path]
+    
+    #Runs one job (in a worker process), returns its entry for the manifest
+    @classmethod
+    def run_job(cls, job:dict, options:dict) -> dict:
+        start = time.time()
+        processor = cls.get_processor(options['data'])
+        processor.log_queue = LogBuffer()
+        records = []
+        spectrum_file = processor.spectrum_file
+        result = dict(job, inputs=[spectrum_file.find(base) for base in job['inputs']], outputs=[], status='ok', message='')
+        try:
+            spectra = [spectrum_file.load(base) for base in job['inputs']]
+            params = spectrum_file.load_params(spectrum_file.find(job['inputs'][0]))
+            
+            if job['kind'] == 'average':
+                wl = spectra[0].index.to_numpy(dtype=float)
+                for base, df in zip(job['inputs'],spectra):
+                    if not np.array_equal(df.index.to_numpy(dtype=float),wl):
+                        raise ValueError('{} was measured at other wavelengths than {}'.format(base,job['inputs'][0]))
+                all_spec = np.array([df.reset_index()[processor.columns].to_numpy(dtype=float).T for df in spectra])
+                df = processor.average_spectra(all_spec,options['avg_method'])
+                params = dict(params, reps=len(spectra), avg_method=options['avg_method'])
+                name = job['name']+'_avg'
+                result['outputs'].append(processor.write_spectrum(options['out']+name,df,params,options['format']))
+            else:
+                df = spectra[0]
+                name = job['name']
+            
+            for key in ['ac_blank','dc_blank','det_corr']:
+                if not options[key] is None:
+                    params[key] = options[key]
+            if params['ac_blank'] != '' or params['dc_blank'] != '' or params['det_corr'] != '':
+                df = processor.apply_corr(df.copy(),params['ac_blank'],params['dc_blank'],params['det_corr'])
+                #uncovered wavelength ranges are only logged by apply_corr
+                records += processor.log_queue.get_all()
+                errors = [text for t, level, text in records if level >= LogBuffer.ERROR]
+                if len(errors) > 0:
+                    raise ValueError(errors[0])
+                result['outputs'].append(processor.write_spectrum(options['out']+name+'_corr',df,params,options['format']))
+            elif job['kind'] == 'correct':
+                result['message'] = 'No corrections specified.'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['message'] = '{}: {}'.format(type(e).__name__,e)
+        records += processor.log_queue.get_all()
+        result['log'] = [text for t, level, text in records if text != '']
+        result['seconds'] = round(time.time()-start,3)
+        return result
+    
+    #Returns the correction files used by the jobs with their modification times
+    def get_corrections(self, jobs:list, options:dict, spectrum_file:SpectrumFile) -> dict:
+        names = set()
+        for job in jobs:
+            params = spectrum_file.load_params(spectrum_file.find(job['inputs'][0]))
+            for key in ['ac_blank','dc_blank','det_corr']:
+                name = params.get(key,'') if options[key] is None else options[key]
+                if name != '':
+                    names.add(name)
+        corrections = {}
+        for name in sorted(names):
+            path = spectrum_file.find(options['data']+name)
+            corrections[name] = {'file': path, 'modified': os.path.getmtime(path) if path != '' else None}
+        return corrections
+    
+    #Returns 0 if all jobs were successful and 1 otherwise
+    def main(self, argv:list) -> int:
+        args = self.parse_args(argv)
+        if args.out == '':
+            args.out = os.path.join(args.data,'batch_'+time.strftime('%Y%m%d_%H%M%S'))
+        options = {'data': args.data, 'out': os.path.join(args.out,''), 'det_corr': args.det_corr, 'ac_blank': args.ac_blank,
+                   'dc_blank': args.dc_blank, 'avg_method': args.avg_method, 'format': args.format}
+        
+        spectrum_file = SpectrumFile()
+        jobs = self.make_jobs(self.find_spectra(args.inputs,spectrum_file),args.average)
+        if len(jobs) == 0:
+            self.log('Error: No spectra found.',True)
+            return 1
+        corrections = self.get_corrections(jobs,options,spectrum_file)
+        for name, corr in corrections.items():
+            if corr['file'] == '':
+                self.log('Error: Correction file {} not found in {}.'.format(name,args.data),True)
+                return 1
+        
+        os.makedirs(args.out,exist_ok=True)
+        workers = max(1,min(args.workers,len(jobs)))
+        self.log('{} jobs with {} processes, results in {}'.format(len(jobs),workers,args.out))
+        start = time.time()
+        results = [None]*len(jobs)
+        
+        def finished(i:int, result:dict):
+            results[i] = result
+            self.log('{}/{} {} {}: {} {}'.format(sum(not r is None for r in results),len(jobs),result['kind'],result['name'],result['status'],result['message']))
+        
+        if workers == 1:
+            for i, job in enumerate(jobs):
+                finished(i,self.run_job(job,options))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(BatchProcessor.run_job,job,options): i for i, job in enumerate(jobs)}
+                for future in concurrent.futures.as_completed(futures):
+                    finished(futures[future],future.result())
+        
+        failed = sum(result['status'] != 'ok' for result in results)
+        manifest = {'created': time.asctime(time.localtime(start)), 'argv': argv, 'options': options, 
+                    'corrections': corrections, 'seconds': round(time.time()-start,3), 'failed': failed, 'jobs': results}
+        with open(os.path.join(args.out,self.manifest_name), 'w') as f:
+            json.dump(manifest,f,indent=1)
+        self.log('{} of {} jobs successful in {:.1f} s, manifest saved as: {}'.format(len(jobs)-failed,len(jobs),time.time()-start,os.path.join(args.out,self.manifest_name)))
+        return 0 if failed == 0 else 1
+
+
+# In[ ]:
+
+
+#Updates of the GUI from other threads: post() keeps only the latest update per key (e.g. one widget) and the 
+#Tk loop applies all pending updates at a fixed rate with drain(). Updates from the GUI thread are applied immediately.
+class GUIUpdateBus(LogObject):
+    log_name = 'GUI'
+    
+    def __init__(self, log_queue:LogBuffer=None):
+        self.log_queue = log_queue
+        self.gui_thread = th.current_thread()
+        self.lock = th.Lock()
+        #key -> function without arguments, in the order of the latest posts
+        self.pending = {}
+        
+    def in_gui_thread(self) -> bool:
+        return th.current_thread() is self.gui_thread
+    
+    #key None: the update is not replaced by later updates (e.g. error dialogs)
+    def post(self, key, func):
+        if self.in_gui_thread():
+            func()
+            return
+        if key is None:
+            key = object()
+        with self.lock:
+            self.pending.pop(key,None)
+            self.pending[key] = func
+    
+    #Applies all pending updates, returns their number
+    def drain(self) -> int:
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for func in pending.values():
+            try:
+                func()
+            except Exception as e:
+                self.log('Error: GUI update failed: {}'.format(str(e)),True)
+        return len(pending)
+
+
+# In[ ]:
+
+
+class ControlError(Exception):
+    pass
+
+
+#Local control server for lab automation: JSON-RPC 2.0 over TCP with one JSON object per line. The commands are executed
+#in the GUI thread like the corresponding clicks and are refused while a measurement is running (except status and abort).
+#After subscribe, the client receives every measured point and the start and end of each scan as notifications.
+#The first request of a connection must be auth with the token from token_path, which can only be read by local programs.
+#The connection is closed after an invalid or unauthenticated request, so that e.g. web pages cannot send commands.
+class ControlServer(LogObject):
+    log_name = 'API'
+    
+    host = '127.0.0.1' #only local connections are accepted
+    port = 5800
+    command_timeout = 600.0 #s, maximum waiting time for the GUI thread
+    max_pending = 10000 #notifications per client, if the client reads too slowly the newest are dropped (see seq)
+    token_path = ".\\data\\control_token.txt" #new token at every start of the server
+    http_methods = (b'GET ',b'POST ',b'PUT ',b'PATCH ',b'DELETE ',b'HEAD ',b'OPTIONS ',b'CONNECT ',b'TRACE ')
+    
+    def __init__(self, ctrl):
+        self.controller = ctrl
+        self.log_queue = ctrl.log_queue
+        self.methods = {'status': self.status,
+                        'move': self.move,
+                        'set_pmt': self.set_pmt,
+                        'set_range': self.set_range,
+                        'set_phaseoffset': self.set_phaseoffset,
+                        'start_scan': self.start_scan,
+                        'start_kinetics': self.start_kinetics,
+                        'start_map': self.start_map,
+                        'abort': self.abort,
+                        'subscribe': self.subscribe,
+                        'unsubscribe': self.unsubscribe}
+        self.subscribers = []
+        self.subscribers_lock = th.Lock()
+        #sequence number of the notifications, gaps show dropped notifications
+        self.seq = 0
+        self.server = None
+        
+    def start(self) -> bool:
+        self.token = secrets.token_hex(16)
+        try:
+            with open(self.token_path, 'w') as f:
+                f.write(self.token)
+        except OSError as e:
+            self.log('Error: Token file {} of the control server could not be written: {}'.format(self.token_path,str(e)),True)
+            return False
+        try:
+            self.server = socketserver.ThreadingTCPServer((self.host,self.port),ControlConnection,bind_and_activate=False)
+            self.server.daemon_threads = True
+            self.server.allow_reuse_address = True
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError as e:
+            self.log('Error: Control server could not be started on port {}: {}'.format(self.port,str(e)),True)
+            self.server = None
+            return False
+        self.server.control = self
+        th.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.log('Control server listening on {}:{}'.format(self.host,self.port))
+        return True
+    
+    def stop(self):
+        if not self.server is None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        with self.subscribers_lock:
+            for conn in self.subscribers:
+                conn.subscribed = False
+            self.subscribers = []
+        if os.path.exists(self.token_path):
+            os.remove(self.token_path)
+    
+    #Requests of web browsers are rejected before they are parsed
+    def is_http(self, line:bytes) -> bool:
+        return line.lstrip().upper().startswith(self.http_methods) or b' HTTP/' in line
+    
+    #Returns the reply to one line of a client (None for requests without id) and whether the connection stays open
+    def handle_request(self, conn, line:bytes):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return self.error_reply(None,-32700,'Parse error'), False
+        if not isinstance(request,dict) or not isinstance(request.get('method'),str):
+            return self.error_reply(None,-32600,'Invalid request'), False
+        
+        req_id = request.get('id')
+        method = request['method']
+        params = request.get('params',{})
+        if not conn.authenticated:
+            token = params.get('token') if isinstance(params,dict) else None
+            if method != 'auth' or not isinstance(token,str) or not hmac.compare_digest(token,self.token):
+                self.log('Warning: Connection without valid token closed.')
+                return self.error_reply(req_id,-32001,'Not authenticated'), False
+            conn.authenticated = True
+            result = {'authenticated': True}
+        elif not method in self.methods:
+            return self.error_reply(req_id,-32601,'Method not found: {}'.format(method)), True
+        else:
+            func = self.methods[method]
+            if method in ['subscribe','unsubscribe']:
+                func = functools.partial(func,conn)
+            try:
+                if isinstance(params,list):
+                    inspect.signature(func).bind(*params)
+                    result = func(*params)
+                elif isinstance(params,dict):
+                    inspect.signature(func).bind(**params)
+                    result = func(**params)
+                else:
+                    return self.error_reply(req_id,-32602,'Invalid params'), True
+            except TypeError as e:
+                return self.error_reply(req_id,-32602,'Invalid params: {}'.format(e)), True
+            except (ControlError, ValueError) as e:
+                return self.error_reply(req_id,-32000,str(e)), True
+            except Exception as e:
+                self.log('Error in {}: {}'.format(method,str(e)),True)
+                return self.error_reply(req_id,-32603,'{}: {}'.format(type(e).__name__,e)), True
+        
+        if req_id is None:
+            return None, True
+        return {'jsonrpc': '2.0', 'id': req_id, 'result': result}, True
+    
+    def error_reply(self, req_id, code:int, message:str) -> dict:
+        return {'jsonrpc': '2.0', 'id': req_id, 'error': {'code': code, 'message': message}}
+    
+    #Executes func in the GUI thread and waits for its result
+    def run_in_gui(self, func, *args):
+        done = th.Event()
+        result = {}
+        def run():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+            done.set()
+        self.controller.gui_bus.post(None,run)
+        if not done.wait(self.command_timeout):
+            raise ControlError('No response of the GUI thread within {:.0f} s.'.format(self.command_timeout))
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+    
+    #Executes func in the GUI thread if no measurement is running. The check is also done in the GUI thread,
+    #so that no click or start of the queue can come in between.
+    def run_when_idle(self, func, *args):
+        def run():
+            self.check_idle()
+            return func(*args)
+        return self.run_in_gui(run)
+    
+    #Commands that change the instruments are only accepted when the clicks would be possible
+    def check_idle(self):
+        ctrl = self.controller
+        if not ctrl.initialized:
+            raise ControlError('Instruments not initialized!')
+        if ctrl.acquisition_running or ctrl.queue_running or ctrl.cal_running:
+            raise ControlError('A measurement is running!')
+    
+    #NaN is not allowed in JSON
+    @staticmethod
+    def to_json_value(f) -> float:
+        f = float(f)
+        return None if math.isnan(f) else f
+    
+    def status(self) -> dict:
+        ctrl = self.controller
+        status = {'initialized': ctrl.initialized,
+                  'acquisition_running': ctrl.acquisition_running,
+                  'queue_running': ctrl.queue_running,
+                  'calibration_running': ctrl.cal_running,
+                  'wavelength': self.to_json_value(ctrl.curr_nm)}
+        if ctrl.initialized:
+            status.update({'pmt_volt': self.to_json_value(ctrl.lockin.pmt_volt),
+                           'input_range': self.to_json_value(ctrl.lockin.signal_range),
+                           'phaseoffset': self.to_json_value(ctrl.lockin.phaseoffset),
+                           'max_volt': self.to_json_value(ctrl.max_volt),
+                           'avg_volt': self.to_json_value(ctrl.avg_volt)})
+        if ctrl.acquisition_running:
+            status['points'] = len(ctrl.curr_spec)
+        if ctrl.queue_running and not ctrl.meas_queue is None:
+            status['job'] = ctrl.meas_queue.current_job+1
+            status['jobs'] = len(ctrl.meas_queue.jobs)
+        return status
+    
+    def move(self, nm:float) -> dict:
+        self.run_when_idle(self.controller.move_nm,float(nm))
+        return self.status()
+    
+    def set_pmt(self, volt:float) -> dict:
+        volt = float(volt)
+        if (volt > MFLI.pmt_high_limit) or (volt < MFLI.pmt_low_limit):
+            raise ControlError('PMT voltage out of range ({:.1f}-{:.1f} V)!'.format(MFLI.pmt_low_limit,MFLI.pmt_high_limit))
+        self.run_when_idle(self.controller.set_PMT_voltage,volt)
+        return self.status()
+    
+    #input_range: 'auto' or one of Controller.input_ranges
+    def set_range(self, input_range) -> dict:
+        ctrl = self.controller
+        if input_range == 'auto':
+            self.run_when_idle(ctrl.set_auto_range)
+        else:
+            s = '{:.3f}'.format(float(input_range))
+            if not s in ctrl.input_ranges:
+                raise ControlError('Input range must be auto or one of: {}'.format(', '.join(ctrl.input_ranges)))
+            def set_range():
+                ctrl.set_input_range(float(s))
+                ctrl.set_cbx_text(ctrl.gui.cbx_range,s)
+            self.run_when_idle(set_range)
+        return self.status()
+    
+    def set_phaseoffset(self, value:float) -> dict:
+        self.run_when_idle(self.controller.set_phaseoffset,float(value))
+        return self.status()
+    
+    #params: parameters of the scan as in a queue file (see MeasurementQueue.queue_columns),
+    #the scan is run as measurement queue with one job
+    def start_scan(self, **params) -> dict:
+        unknown = [key for key in params if not key in MeasurementQueue.queue_columns]
+        if len(unknown) > 0:
+            raise ControlError('Unknown parameters: {}'.format(', '.join(unknown)))
+        meas_queue = MeasurementQueue(self.controller)
+        job = meas_queue.make_job(params)
+        meas_queue.jobs = [job]
+        if not self.run_when_idle(self.controller.start_queue,meas_queue):
+            raise ControlError('Scan was not started, see the log of CatCPL.')
+        return {'filename': job['filename'], 'outputs': meas_queue.get_output_names(job)}
+    
+    #see Controller.start_kinetics
+    def start_kinetics(self, filename:str, wl:float, block_time:float, duration:float=0.0, avg_blocks:int=10) -> dict:
+        params = {'filename': str(filename), 'wl': float(wl), 'block_time': float(block_time), 
+                  'duration': float(duration), 'avg_blocks': MeasurementQueue.to_int('avg_blocks',avg_blocks)}
+        if not self.run_when_idle(self.controller.start_kinetics,params):
+            raise ControlError('Kinetics was not started, see the log of CatCPL.')
+        return {'filename': params['filename']+KineticsFile.suffix}
+    
+    #axes: list of {'type', 'name', 'values' or 'start', 'stop', 'step', 'options'}, see Controller.start_map
+    def start_map(self, filename:str, dwell_time:float, axes:list) -> dict:
+        params = {'filename': str(filename), 'dwell_time': float(dwell_time), 'axes': axes}
+        if not self.run_when_idle(self.controller.start_map,params):
+            raise ControlError('Map was not started, see the log of CatCPL.')
+        return {'filename': params['filename']+MapDataset.suffix}
+    
+    def abort(self) -> dict:
+        ctrl = self.controller
+        running = ctrl.acquisition_running or ctrl.queue_running
+        if running:
+            self.run_in_gui(ctrl.abort_measurement)
+        return {'aborted': running}
+    
+    def subscribe(self, conn) -> dict:
+        with self.subscribers_lock:
+            if not conn in self.subscribers:
+                conn.notifications = queue.Queue(maxsize=self.max_pending)
+                conn.subscribed = True
+                th.Thread(target=conn.send_notifications,daemon=True).start()
+                self.subscribers.append(conn)
+        return {'subscribed': True, 'seq': self.seq}
+    
+    def unsubscribe(self, conn) -> dict:
+        with self.subscribers_lock:
+            if conn in self.subscribers:
+                self.subscribers.remove(conn)
+            conn.subscribed = False
+        return {'subscribed': False}
+    
+    def has_subscribers(self) -> bool:
+        return len(self.subscribers) > 0
+    
+    #Sends a notification to all subscribed clients without waiting for them
+    def publish(self, method:str, params:dict):
+        with self.subscribers_lock:
+            self.seq += 1
+            params['seq'] = self.seq
+            msg = {'jsonrpc': '2.0', 'method': method, 'params': params}
+            for conn in self.subscribers:
+                try:
+                    conn.notifications.put_nowait(msg)
+                except queue.Full:
+                    pass
+    
+    
+#One client connection of the ControlServer
+class ControlConnection(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = th.Lock()
+        self.notifications = None
+        self.subscribed = False
+        self.authenticated = False
+    
+    def handle(self):
+        control = self.server.control
+        for line in self.rfile:
+            if line.strip() == b'':
+                continue
+            if not self.authenticated and control.is_http(line):
+                control.log('Warning: HTTP request to the control server rejected.')
+                break
+            reply, keep_open = control.handle_request(self,line)
+            if not reply is None:
+                self.send(reply)
+            if not keep_open:
+                break
+        control.unsubscribe(self)
+    
+    def send(self, msg:dict):
+        data = (json.dumps(msg)+'\n').encode()
+        with self.send_lock:
+            self.wfile.write(data)
+    
+    #will be executed in separate thread after subscribe
+    def send_notifications(self):
+        while self.subscribed:
+            try:
+                msg = self.notifications.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            try:
+                self.send(msg)
+            except OSError:
+                self.subscribed = False
+            
+            
+#Minimal client of the ControlServer for testing and as template for the lab automation
+#python catcpl.py client status
+#python catcpl.py client start_scan filename=sample start_nm=700 end_nm=500 step=1 dwell_time=0.5 pmt_volt=0.8 --follow
+class ControlClient():
+    #token_path: file with the token of the running server (ControlServer.token_path)
+    def __init__(self, host:str=ControlServer.host, port:int=ControlServer.port, token_path:str=ControlServer.token_path):
+        with open(token_path, 'r') as f:
+            token = f.read().strip()
+        self.sock = socket.create_connection((host,port))
+        self.file = self.sock.makefile('rb')
+        self.call_count = 0
+        #notifications that arrived while waiting for a reply
+        self.notifications = collections.deque()
+        self.call('auth',token=token)
+        
+    def call(self, method:str, **params):
+        self.call_count += 1
+        request = {'jsonrpc': '2.0', 'id': self.call_count, 'method': method, 'params': params}
+        self.sock.sendall((json.dumps(request)+'\n').encode())
+        while True:
+            msg = self.receive()
+            if msg.get('id') == self.call_count:
+                if 'error' in msg:
+                    raise ControlError(msg['error']['message'])
+                return msg['result']
+            self.notifications.append(msg)
+    
+    def receive(self) -> dict:
+        line = self.file.readline()
+        if line == b'':
+            raise ConnectionError('Connection closed by CatCPL.')
+        return json.loads(line)
+    
+    #waits for the next notification (after subscribe)
+    def next_notification(self) -> dict:
+        if len(self.notifications) > 0:
+            return self.notifications.popleft()
+        return self.receive()
+    
+    def close(self):
+        self.file.close()
+        self.sock.close()
+    
+    @staticmethod
+    def main(argv:list) -> int:
+        parser = argparse.ArgumentParser(prog='catcpl.py client', description='Sends one command to the control server of a running CatCPL.')
+        parser.add_argument('method', help='status, move, set_pmt, set_range, set_phaseoffset, start_scan, start_kinetics, start_map or abort')
+        parser.add_argument('params', nargs='*', help='parameters as name=value')
+        parser.add_argument('--port', type=int, default=ControlServer.port)
+        parser.add_argument('--token-file', default=ControlServer.token_path, help='token of the control server (default: %(default)s)')
+        parser.add_argument('--follow', action='store_true', help='print the measured points until the scan ends')
+        args = parser.parse_args(argv)
+        
+        params = {}
+        for param in args.params:
+            key, sep, value = param.partition('=')
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        
+        try:
+            client = ControlClient(port=args.port,token_path=args.token_file)
+        except OSError as e:
+            print('Error: Could not connect to CatCPL on port {}: {}'.format(args.port,str(e)))
+            return 1
+        try:
+            if args.follow:
+                client.call('subscribe')
+            print(json.dumps(client.call(args.method,**params)))
+            while args.follow:
+                msg = client.next_notification()
+                print(json.dumps(msg['params']))
+                if msg['method'] == 'scan' and msg['params']['state'] != 'started':
+                    break
+            return 0
+        except (ControlError, ConnectionError) as e:
+            print('Error: {}'.format(str(e)))
+            return 1
+        finally:
+            client.close()
+
+
+# In[ ]:
+
+
+#Base class of the axes of a map (see MapPlanner). Further axes (e.g. other instruments) are subclasses that are added 
+#to Controller.scan_axis_types. The class attributes can be changed for each map with the options of the axis.
+class ScanAxis(LogObject):
+    log_name = 'AXS'
+    
+    unit = ''
+    move_time = 1.0 #s, typical duration of one step, the slowest axes are moved least often
+    spectral = False #True: start, stop and step give the same wavelengths as a spectrum, the last one may pass stop
+    
+    def __init__(self, ctrl, name:str, **options):
+        self.controller = ctrl
+        self.log_queue = ctrl.log_queue
+        self.name = name
+        for key, value in options.items():
+            if not hasattr(type(self),key) or callable(getattr(type(self),key)):
+                raise ValueError('Unknown option {} of axis {}'.format(key,name))
+            setattr(self,key,value)
+        self.value = float('nan')
+    
+    def connect(self) -> bool:
+        return True
+    
+    def disconnect(self):
+        pass
+    
+    #returns when the value is reached
+    def move(self, value:float):
+        self.value = value
+    
+    #actual value of the axis, e.g. the measured temperature
+    def read(self) -> float:
+        return self.value
+
+
+#Axis for tests without instruments, every move takes step_delay
+class SimulatedAxis(ScanAxis):
+    move_time = 0.0
+    step_delay = 0.0 #s
+    
+    def move(self, value:float):
+        time.sleep(self.step_delay)
+        self.value = value
+
+
+#Emission wavelength (monochromator and PEM) as axis of a map
+class EmissionAxis(ScanAxis):
+    unit = 'nm'
+    move_time = 0.5
+    spectral = True
+    
+    def move(self, value:float):
+        self.controller.move_nm(value)
+        self.value = value
+
+
+#Second monochromator for the excitation wavelength
+class ExcitationMono(Mono):
+    #---edit these for different model---
+    name = 'ASRL5::INSTR'
+    model = 'SP-2-150i'
+    serial = ''
+    
+    log_name = 'EXC'
+    
+
+class ExcitationAxis(ScanAxis):
+    unit = 'nm'
+    move_time = 0.5
+    spectral = True
+    
+    def connect(self) -> bool:
+        self.mono = ExcitationMono()
+        return self.mono.initialize(pyvisa.ResourceManager(),self.log_queue,False)
+    
+    def disconnect(self):
+        self.mono.close()
+    
+    def move(self, value:float):
+        self.mono.set_nm(value)
+        self.value = value
+
+
+#Instrument with SCPI-like commands to set and read a value (e.g. temperature controller, magnet power supply). 
+#move() waits until the value is within tolerance for stable_time.
+class VisaScanAxis(ScanAxis, VisaDevice):
+    resource = ''
+    set_cmd = '{}' #formatted with the new value
+    read_cmd = ''
+    tolerance = 0.0
+    stable_time = 0.0 #s
+    move_timeout = 3600.0 #s
+    poll_interval = 1.0 #s
+    
+    def connect(self) -> bool:
+        try:
+            self.inst = pyvisa.ResourceManager().open_resource(self.resource, timeout = 5000)
+            self.log('{}: {} {}'.format(self.name,self.read(),self.unit))
+            return True
+        except Exception as e:
+            self.log('Error connecting to {} ({}): {}'.format(self.resource,self.name,str(e)),True)
+            return False
+    
+    def disconnect(self):
+        self.close()
+        
+    def move(self, value:float):
+        self.inst.write(self.set_cmd.format(value))
+        self.log_ask(self.set_cmd.format(value))
+        self.value = value
+        start = time.time()
+        stable_since = None
+        while not self.controller.stop_spec_trigger[0]:
+            if abs(self.read()-value) <= self.tolerance:
+                if stable_since is None:
+                    stable_since = time.time()
+                if time.time()-stable_since >= self.stable_time:
+                    return
+            else:
+                stable_since = None
+            if time.time()-start > self.move_timeout:
+                raise ECommError('{} did not reach {} {} within {:.0f} s.'.format(self.name,value,self.unit,self.move_timeout))
+            time.sleep(self.poll_interval)
+    
+    def read(self) -> float:
+        return float(self.log_query(self.read_cmd))
+
+
+class TemperatureAxis(VisaScanAxis):
+    #---edit these for different model (Lake Shore 335)---
+    resource = 'GPIB0::12::INSTR'
+    set_cmd = 'SETP 1,{:.3f}'
+    read_cmd = 'KRDG? A'
+    unit = 'K'
+    tolerance = 0.1
+    stable_time = 60.0
+    move_time = 600.0
+
+
+class FieldAxis(VisaScanAxis):
+    #---edit these for different model---
+    resource = 'GPIB0::13::INSTR'
+    set_cmd = 'FIELD:TARG {:.5f}'
+    read_cmd = 'FIELD:MAG?'
+    unit = 'T'
+    tolerance = 0.001
+    stable_time = 5.0
+    move_time = 120.0
+
+
+#Plans the points of a map over several axes. The axes are sorted by move_time, so that the slowest axis changes least 
+#often. The points are ordered in serpentine fashion: instead of returning to its first value every axis reverses its
+#direction, so that consecutive points differ by one step of one axis.
+class MapPlanner():
+    #axes: list of (ScanAxis, values)
+    def __init__(self, axes:list):
+        axes = sorted(axes, key=lambda axis: -axis[0].move_time)
+        self.axes = [axis for axis, values in axes]
+        self.values = [np.asarray(values, dtype=float) for axis, values in axes]
+        self.shape = tuple(values.size for values in self.values)
+    
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+    
+    #Index tuples of the points in the order of the measurement. An axis runs backwards when the number of lines of 
+    #the slower axes that were started before is odd.
+    def iter_order(self):
+        for counter in np.ndindex(*self.shape):
+            index = []
+            line = 0
+            for c, n in zip(counter,self.shape):
+                index.append(n-1-c if line % 2 else c)
+                line = line*n + c
+            yield tuple(index)
+    
+    #Number of moves of every axis
+    def count_moves(self) -> list:
+        moves = [0]*len(self.shape)
+        last = None
+        for index in self.iter_order():
+            for k in range(0,len(index)):
+                if last is None or index[k] != last[k]:
+                    moves[k] += 1
+            last = index
+        return moves
+
+
+#One map in a single .npy file with the shape (axes..., columns) that is preallocated with NaN and written point by point 
+#via a memory map, np.load(path, mmap_mode='r') also reads an incomplete map. The data is flushed to disk in chunks of 
+#flush_points. The axes, their values, the columns and the parameters are stored in <name>_map.json.
+class MapDataset():
+    suffix = '_map.npy'
+    info_suffix = '_map.json'
+    flush_points = 20
+    
+    #base: path without suffix
+    def __init__(self, base:str, planner:MapPlanner, columns:list):
+        self.path = base+self.suffix
+        self.info_path = base+self.info_suffix
+        self.planner = planner
+        self.columns = columns
+        self.count = 0
+        self.data = None
+        
+    def create(self, params:dict):
+        self.data = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float64, shape=self.planner.shape+(len(self.columns),))
+        self.data[...] = np.nan
+        self.info = {'axes': [{'name': axis.name, 'type': type(axis).__name__, 'unit': axis.unit, 'values': values.tolist()}
+                              for axis, values in zip(self.planner.axes,self.planner.values)],
+                     'columns': self.columns,
+                     'params': params,
+                     'points': 0,
+                     'complete': False}
+        self.flush()
+    
+    def write(self, index:tuple, values:np.array):
+        self.data[index] = values
+        self.count += 1
+    
+    def flush(self):
+        self.data.flush()
+        self.info['points'] = self.count
+        with open(self.info_path, 'w') as f:
+            f.write(SpectrumFile().params_to_json(self.info))
+    
+    def close(self, complete:bool):
+        self.info['complete'] = complete
+        self.flush()
+        self.data = None
+        
+    #Returns the info and the data (read-only memory map)
+    @staticmethod
+    def load(base:str):
+        with open(base+MapDataset.info_suffix, 'r') as f:
+            info = json.load(f)
+        return info, np.load(base+MapDataset.suffix, mmap_mode='r')
+
+
+# In[44]:
+
+
+#Dialog that guides the user through the phase offset calibration
+class PhaseOffsetCalibrationDialog(LogObject):
+    update_interval = 1000 #ms
+    
+    log_name = 'CAL'
+    
+    new_offset = 0.0
+    current_average = 0.0
+    current_datapoints_count = 0
+    
+    skipped_pos_cal = False
+    skipped_neg_cal = False
+    
+    def __init__(self, ctrl):
+        self.controller = ctrl
+        self.log_queue = ctrl.log_queue
+        
+        #Setting up the window
+        self.window = tk.Toplevel()
+        self.window.title('Phaseoffset Calibration')
+        self.window.resizable(False, False)
+        self.window.configure(bg = "#EBFFE8")
+        #stay on top of main window
+        self.window.attributes('-topmost', 'true')
+        #Disable X buttton
+        self.window.protocol("WM_DELETE_WINDOW", self.disable_event)
+
+        self.lbl_text = tk.Label(self.window, text='Insert a sample, move to a suitable wavelength and adjust gain to obtain strong positive CPL (e.g. Eu(facam)3 in DMSO at 613 nm)',  font=("Arial", 18), width=40,height=5,wraplength=600, bg = "#EBFFE8")
+        self.lbl_text.pack()
+        self.lbl_time = tk.Label(self.window, text='Time passed (>1200 s recommended): 0 s', font=("Arial", 14),bg = "#EBFFE8")
+        self.lbl_time.pack()
+        self.lbl_datapoints = tk.Label(self.window, text='Number of data points: 0', font=("Arial", 14),bg = "#EBFFE8")
+        self.lbl_datapoints.pack()
+        self.lbl_average = tk.Label(self.window, text='Average phase: 0 deg', font=("Arial", 14),bg = "#EBFFE8")
+        self.lbl_average.pack()
+        self.lbl_avg_pos = tk.Label(self.window, text='Average pos. phase: --', font=("Arial", 14),bg = "#EBFFE8")
+        self.lbl_avg_pos.pack()
+        self.lbl_avg_neg = tk.Label(self.window, text='Average neg. phase: --', font=("Arial", 14),bg = "#EBFFE8")
+        self.lbl_avg_neg.pack()
+        self.btn_next = tk.Button(self.window, text='Next', command=self.next_step, font=("Arial", 14))
+        self.btn_next.pack()
+        self.btn_skip = tk.Button(self.window, text='Skip', command=self.skip, font=("Arial", 14))
+        self.btn_skip.pack()
+        self.btn_close = tk.Button(self.window, text='Close', command=self.close, font=("Arial", 14))
+        self.btn_close.pack()
+        
+        self.step = 0
+        self.t0 = 0.0
+        
+    def next_step(self):
+        self.step += 1
+        
+        if self.step == 1:
+            self.lbl_text.config(text = 'Collecting phase of positive CPL ')
+            self.t0 = time.time()
+            self.window.after(self.update_interval, self.update_loop) 
+            self.controller.cal_start_record_thread(positive=True)
+            
+        elif self.step == 2:
+            self.controller.cal_stop_record()
+            if self.skipped_pos_cal:
+                self.lbl_avg_pos.config(text = 'Average pos. phase: skipped')
+            else:
+                current_values = self.controller.cal_get_current_values()
+                self.lbl_avg_pos.config(text = 'Average pos. phase: {:.3f} deg'.format(current_values[0]))
+            self.reset_labels()
+            self.lbl_text.config(text = 'Insert a sample, move to a suitable wavelength and adjust gain to obtain strong negative CPL (e.g. Eu(facam)3 in DMSO at 595 nm)')                
+            
+        elif self.step == 3:
+            self.lbl_text.config(text = 'Collecting phase of negative CPL')
+            self.t0 = time.time()
+            self.window.after(self.update_interval, self.update_loop) 
+            self.controller.cal_start_record_thread(positive=False)
+            
+        elif self.step == 4:
+            self.controller.cal_stop_record()
+            #wait for cal_theta_thread to stop
+            self.show_summary_after_thread()
+            
+        elif self.step == 5:
+            self.controller.cal_apply_new()
+            self.controller.cal_end()
+            self.window.destroy()
+    
+    #wait for the measurement thread to finish before showing the results
+    def show_summary_after_thread(self):
+        if not self.controller.cal_theta_thread is None:
+            if self.controller.cal_theta_thread.is_alive():
+                self.window.after(100,self.show_summary_after_thread)
+            else:
+                self.show_summary()
+        else:
+            self.show_summary()
+    
+    def show_summary(self):
+        if self.skipped_neg_cal:
+            self.lbl_avg_neg.config(text = 'Average neg. phase: skipped')
+        else:
+            current_values = self.controller.cal_get_current_values()
+            self.lbl_avg_neg.config(text = 'Average neg. phase: {:.3f} deg'.format(current_values[0]))
+            
+        self.new_offset = self.controller.cal_get_new_phaseoffset(self.skipped_pos_cal,self.skipped_neg_cal)
+        self.btn_skip['state'] = 'disabled'
+        
+        if self.skipped_pos_cal and self.skipped_neg_cal:
+            self.lbl_text.config(text = 'Calibration was skipped.')
+            self.btn_next['state'] = 'disabled'
+        else:
+            self.lbl_text.config(text = 'The new phase offset was determined to: {:.3f} degrees. Do you want to apply this value?'.format(self.new_offset))
+            self.btn_next.config(text = 'Save')
+    
+    def skip(self):
+        if self.step == 0:
+            self.log('Pos. phase: skipped')
+            self.skipped_pos_cal = True
+            self.step += 1
+            self.next_step()
+        elif self.step == 1:
+            self.log('Pos. phase: skipped')            
+            self.skipped_pos_cal = True
+            self.next_step()
+        elif self.step == 2:
+            self.log('Neg. phase: skipped')            
+            self.skipped_neg_cal = True
+            self.step += 1
+            self.next_step()                
+        elif self.step == 3:
+            self.log('Neg. phase: skipped')            
+            self.skipped_neg_cal = True
+            self.next_step()                
+                
+    def update_loop(self):
+        if self.step in [1,3] and self.controller.cal_running:
+            self.lbl_time.config(text = 'Time passed (>1200 s recommended): {:.0f} s'.format(time.time()-self.t0))
+            current_values = self.controller.cal_get_current_values()
+            self.lbl_average.config(text = 'Average phase: {:.3f} deg'.format(current_values[0]))
+            self.lbl_datapoints.config(text = 'Number of data points: {}'.format(current_values[1]))
+            self.window.after(self.update_interval, self.update_loop) 
+    
+    def reset_labels(self):
+        self.lbl_time.config(text = 'Time passed (>1200 s recommended): 0 s')
+        self.lbl_average.config(text = 'Average phase: 0 deg')
+        self.lbl_datapoints.config(text = 'Number of data points: 0')
+        
+    def close(self):      
+        self.log('Calibration aborted.')
+        if self.step in [1,3]:
+            self.controller.cal_stop_record()
+        self.controller.cal_end_after_thread()
+        
+    def disable_event(self):
+        pass
+    
+
+
+# In[ ]:
+
+
+#List of scan recipes (jobs) that are measured back to back by the Controller without user interaction
+#The jobs are loaded from a CSV file with one job per line and the column names of queue_columns
+class MeasurementQueue(LogObject):
+    log_name = 'QUE'
+    
+    #column name: default value (None = mandatory column), type
+    queue_columns = {'type': ('sample', str), #sample, ac_blank (PEM off) or dc_blank
+                     'filename': (None, str),
+                     'start_nm': (None, float),
+                     'end_nm': (None, float),
+                     'step': (None, float),
+                     'dwell_time': (None, float),
+                     'reps': (1, int),
+                     'pmt_volt': (None, float),
+                     'input_range': ('auto', str), #auto or one of Controller.input_ranges
+                     'phaseoffset': ('', str), #empty = keep current phase offset
+                     'ac_blank': ('', str),
+                     'dc_blank': ('', str),
+                     'det_corr': ('', str),
+                     'exc_slit': ('', str),
+                     'em_slit': ('', str),
+                     'exc_wl': ('', str),
+                     'comment': ('', str)}
+    job_types = ['sample','ac_blank','dc_blank']
+    
+    def __init__(self, ctrl):
+        self.controller = ctrl
+        self.log_queue = ctrl.log_queue
+        self.jobs = []
+        self.current_job = -1
+        self.jobs_done = 0
+        
+    def load(self, path:str) -> bool:
+        self.jobs = []
+        self.current_job = -1
+        self.jobs_done = 0
+        try:
+            df = pd.read_csv(filepath_or_buffer=path, sep=',', dtype=str, keep_default_na=False, skipinitialspace=True)
+            df.columns = df.columns.str.strip()
+            
+            missing = [col for col, (default, _) in self.queue_columns.items() if default is None and not col in df.columns]
+            if len(missing) > 0:
+                self.log('Error: Missing columns in queue file: {}'.format(', '.join(missing)),True)
+                return False
+            
+            for index, row in df.iterrows():
+                self.jobs.append(self.make_job(row.to_dict()))
+                
+            self.log('Loaded {:d} jobs from {}.'.format(len(self.jobs),path))
+            return self.validate()
+        except Exception as e:
+            self.jobs = []
+            self.log('Error while loading queue file {}: {}'.format(path,str(e)),True)
+            return False
+    
+    #values: column name -> value (text or number), missing or empty values are replaced by the defaults
+    def make_job(self, values:dict) -> dict:
+        job = {}
+        for col, (default, typ) in self.queue_columns.items():
+            value = values.get(col,'')
+            if isinstance(value,str):
+                value = value.strip()
+            if value != '' and not value is None:
+                job[col] = self.to_int(col,value) if typ is int else typ(value)
+            elif default is None:
+                raise ValueError('Missing value of {}'.format(col))
+            else:
+                job[col] = default
+        job['pem_off'] = int(job['type'] == 'ac_blank')
+        job['pmt_gain'] = ''
+        if job['input_range'] != 'auto':
+            job['input_range'] = '{:.3f}'.format(float(job['input_range']))
+        return job
+    
+    #Accepts integral numbers also as float or text (e.g. 2.0 or '2.0'), other values raise a ValueError
+    @staticmethod
+    def to_int(name:str, value) -> int:
+        f = float(value)
+        if not f.is_integer():
+            raise ValueError('{} must be an integer (not {})'.format(name,value))
+        return int(f)
+    
+    #Names of all spectra files (without extension) that will be written by a job
+    def get_output_names(self, job:dict) -> list:
+        if job['reps'] == 1:
+            names = [job['filename']]
+        else:
+            names = [job['filename']+'_'+str(i+1) for i in range(0,job['reps'])] + [job['filename']+'_avg']
+        return names + [name+'_corr' for name in names]
+    
+    #Checks all jobs before the queue is started, blank and correction files may also be produced by an earlier job of the queue
+    def validate(self) -> bool:
+        ok = len(self.jobs) > 0
+        planned = []
+        #wavelength grids of the planned spectra, to check the coverage of blanks that are measured in the queue
+        planned_grids = {}
+        for i, job in enumerate(self.jobs):
+            s = 'Queue job {:d} ({}): '.format(i+1,job['filename'])
+            if not job['type'] in self.job_types:
+                self.log(s+'Error: Unknown job type {}, allowed are: {}'.format(job['type'],', '.join(self.job_types)),True)
+                ok = False
+            if self.controller.check_illegal_chars(job['filename']):
+                self.log(s+'Error: Filename contains one of these illegal characters: '+self.controller.illegal_chars,True)
+                ok = False
+            if (job['pmt_volt'] > MFLI.pmt_high_limit) or (job['pmt_volt'] < MFLI.pmt_low_limit):
+                self.log(s+'Error: PMT voltage out of range ({:.1f}-{:.1f} V)!'.format(MFLI.pmt_low_limit,MFLI.pmt_high_limit),True)
+                ok = False
+            if (job['input_range'] != 'auto') and not job['input_range'] in self.controller.input_ranges:
+                self.log(s+'Error: Input range must be auto or one of: {}'.format(', '.join(self.controller.input_ranges)),True)
+                ok = False
+            if job['reps'] < 1 or job['step'] <= 0 or job['dwell_time'] <= 0:
+                self.log(s+'Error: Repetitions, step and dwell time must be positive!',True)
+                ok = False
+                
+            for key in ['ac_blank','dc_blank','det_corr']:
+                if not (job[key] in planned or self.controller.filename_exists_or_empty(job[key])):
+                    self.log(s+'Error: File {} does not exist and is not measured before in the queue!'.format(job[key]),True)
+                    ok = False
+            
+            #the blanks must cover the wavelengths of the job as in start_spec
+            wl_grid = self.controller.get_wl_grid(job['start_nm'],job['end_nm'],job['step']) if job['step'] > 0 else np.array([])
+            for key, kind in [('ac_blank','AC'),('dc_blank','DC')]:
+                if job[key] == '' or wl_grid.size == 0:
+                    continue
+                if job[key] in planned_grids:
+                    blank_grid = planned_grids[job[key]]
+                    covered = (blank_grid.min() <= wl_grid.min() and blank_grid.max() >= wl_grid.max() 
+                               and (blank_grid.size == 1 or np.abs(np.diff(blank_grid)).max() <= self.controller.blank_library.max_gap))
+                elif self.controller.filename_exists_or_empty(job[key]):
+                    covered = not self.controller.blank_library.get(job[key],kind,wl_grid) is None
+                else:
+                    continue
+                if not covered:
+                    self.log(s+'Error: {}-blank {} does not cover the wavelength range (or its points are more than {} nm apart)!'.format(
+                        kind,job[key],self.controller.blank_library.max_gap),True)
+                    ok = False
+                    
+            if os.path.exists(ScanJournal(".\\data\\"+job['filename']).path):
+                self.log(s+'Error: The journal of an interrupted scan {} exists! Resume the scan or remove the journal.'.format(job['filename']),True)
+                ok = False
+                    
+            outputs = self.get_output_names(job)
+            for name in outputs:
+                if name in planned or (name != '' and self.controller.filename_exists_or_empty(name)):
+                    self.log(s+'Error: Spectra filename {} already exists!'.format(name),True)
+                    ok = False
+                    break
+            planned.extend(outputs)
+            for name in outputs:
+                planned_grids[name] = wl_grid
+        return ok
+    
+    def get_job_text(self, i:int) -> str:
+        job = self.jobs[i]
+        return '{:d}) {} [{}] {:g}-{:g} nm, {:g} nm, {:g} s x {:d}, PMT {:.3f} V'.format(
+            i+1,job['filename'],job['type'],job['start_nm'],job['end_nm'],job['step'],job['dwell_time'],job['reps'],job['pmt_volt'])
+
+
+#Dialog to load a queue file and to start and monitor the queued measurements
+class QueueDialog(LogObject):
+    update_interval = 1000 #ms
+    
+    log_name = 'QUE'
+    
+    def __init__(self, ctrl, meas_queue:MeasurementQueue):
+        self.controller = ctrl
+        self.meas_queue = meas_queue
+        self.log_queue = ctrl.log_queue
+        
+        self.window = tk.Toplevel()
+        self.window.title('Measurement Queue')
+        self.window.resizable(False, False)
+        self.window.configure(bg = "#D1FFDB")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        
+        self.lbl_text = tk.Label(self.window, text='Load a queue file (.csv) with one measurement per line.', font=("Arial", 14), wraplength=600, bg = "#D1FFDB")
+        self.lbl_text.pack()
+        self.lst_jobs = tk.Listbox(self.window, width=90, height=15, font=("Arial", 10), exportselection=False)
+        self.lst_jobs.pack()
+        self.lbl_status = tk.Label(self.window, text='No jobs loaded', font=("Arial", 14), bg = "#D1FFDB")
+        self.lbl_status.pack()
+        self.btn_load = tk.Button(self.window, text='Load', command=self.load, font=("Arial", 14))
+        self.btn_load.pack()
+        self.btn_start = tk.Button(self.window, text='Start', command=self.start, font=("Arial", 14), state='disabled')
+        self.btn_start.pack()
+        self.btn_close = tk.Button(self.window, text='Close', command=self.close, font=("Arial", 14))
+        self.btn_close.pack()
+        
+        self.closed = False
+        
+    def load(self):
+        path = tk.filedialog.askopenfilename(parent=self.window, initialdir='.\\data\\', filetypes=[('Queue files','*.csv')])
+        if path != '':
+            ok = self.meas_queue.load(path)
+            self.lst_jobs.delete(0,tk.END)
+            for i in range(0,len(self.meas_queue.jobs)):
+                self.lst_jobs.insert(tk.END,self.meas_queue.get_job_text(i))
+            if ok:
+                self.lbl_status.config(text = '{:d} jobs ready'.format(len(self.meas_queue.jobs)))
+            else:
+                self.lbl_status.config(text = 'Queue file contains errors, see log')
+            self.btn_start['state'] = self.controller.gui.get_state_const(ok)
+    
+    def start(self):
+        self.btn_start['state'] = 'disabled'
+        self.btn_load['state'] = 'disabled'
+        self.controller.start_queue(self.meas_queue)
+        self.window.after(self.update_interval, self.update_loop)
+        
+    def update_loop(self):
+        if self.closed:
+            return
+        i = self.meas_queue.current_job
+        self.lst_jobs.selection_clear(0,tk.END)
+        if i >= 0:
+            self.lst_jobs.selection_set(i)
+            self.lst_jobs.see(i)
+            self.lbl_status.config(text = 'Running job {:d}/{:d}'.format(i+1,len(self.meas_queue.jobs)))
+        if self.controller.queue_running:
+            self.window.after(self.update_interval, self.update_loop)
+        else:
+            self.lbl_status.config(text = '{:d}/{:d} jobs done'.format(self.meas_queue.jobs_done,len(self.meas_queue.jobs)))
+            self.btn_load['state'] = 'normal'
+        
+    #The dialog can be closed while the queue is running, the queue is stopped with the Abort button of the main window
+    def close(self):
+        self.closed = True
+        self.window.destroy()
+
+
+#Dialog to start a kinetics measurement: glum, AC and DC versus time at a fixed wavelength, 
+#the other parameters (PMT, slits, comment, ...) are taken from the main window
+class KineticsDialog(LogObject):
+    log_name = 'KIN'
+    
+    #label, key, default value
+    fields = [('Filename','filename',''),
+              ('Wavelength / nm','wl','550'),
+              ('Block time / s','block_time','1.0'),
+              ('Duration / s (0: until abort)','duration','0'),
+              ('Averaged blocks in plot','avg_blocks','10')]
+    
+    def __init__(self, ctrl):
+        self.controller = ctrl
+        self.log_queue = ctrl.log_queue
+        
+        self.window = tk.Toplevel()
+        self.window.title('Kinetics')
+        self.window.resizable(False, False)
+        self.window.configure(bg = "#D1FFDB")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        
+        self.lbl_text = tk.Label(self.window, text='Records AC, DC, LP and glum at one wavelength. Every point is the average of one block.', 
+                                 font=("Arial", 14), wraplength=400, bg = "#D1FFDB")
+        self.lbl_text.grid(row=0, column=0, columnspan=2)
+        self.edits = {}
+        for i, (label, key, default) in enumerate(self.fields):
+            tk.Label(self.window, text=label, font=("Arial", 12), bg = "#D1FFDB").grid(row=i+1, column=0, sticky='w')
+            edt = tk.Entry(self.window, font=("Arial", 12), width=20)
+            edt.insert(0, default)
+            edt.grid(row=i+1, column=1)
+            self.edits[key] = edt
+        self.btn_start = tk.Button(self.window, text='Start', command=self.start, font=("Arial", 14))
+        self.btn_start.grid(row=len(self.fields)+1, column=0)
+        self.btn_close = tk.Button(self.window, text='Close', command=self.close, font=("Arial", 14))
+        self.btn_close.grid(row=len(self.fields)+1, column=1)
+        
+    def start(self):
+        values = {key: edt.get() for key, edt in self.edits.items()}
+        try:
+            values['wl'] = float(values['wl'])
+            values['block_time'] = float(values['block_time'])
+            values['duration'] = float(values['duration'])
+            values['avg_blocks'] = MeasurementQueue.to_int('avg_blocks',values['avg_blocks'])
+        except ValueError as e:
+            self.log('Error: Invalid kinetics parameter: '+str(e),True)
+            return
+        if self.controller.start_kinetics(values):
+            self.close()
+    
+    #The measurement is stopped with the Abort button of the main window
+    def close(self):
+        self.window.destroy()
+
+
+# In[45]:
+
+
+#Combines the individual components and controls the main window
+class Controller(LogObject):
+    version = '1.0.1'
+    
+    lowpass_filter_risetime = 0.6 #s, depends on the timeconstant of the low pass filter
+    shutdown_threshold = 2.95 #Vl
+    osc_refresh_delay = 40 #ms, signal tuning graph
+    scope_analysis_delay = 0.1 #s, analysis of the oscilloscope trace and input range check
+    log_update_interval = 200 #ms
+    gui_update_interval = 50 #ms, updates of the GUI from other threads (see GUIUpdateBus)
+    log_level = LogBuffer.INFO #LogBuffer.DEBUG additionally logs every query of the PEM and the monochromator
+    log_path = ".\\data\\catcpl.log" #rotating log file, see LogFile
+    log_box_lines = 5000 #older lines are removed from the log box
+    spec_refresh_delay = 1000 #ms
+    move_delay = 0.2 #s, additional delay after changing wavelength
+    #True: the lock-in amplifier and the PMT watchdog run in a separate process (see AcquisitionEngine), 
+    #requires that catcpl.py is run as script
+    acquisition_process = False
+    #True: the instruments can also be controlled by other programs via the local ControlServer
+    control_server_active = False
+    
+    #A warning is printed if one value of lp_theta_std is below the threshold
+    #as this indicates the presence of linear polarization in the emission
+    lp_theta_std_warning_threshold = 1.0
+    
+    input_ranges = ['0.003','0.010','0.030','0.100','0.300','1.000','3.000']
+    
+    log_name = 'CTRL'
     acquisition_running = False
     
     #Parameters to calculate approx. gain from control voltage of PMT, log(gain) = slope*pmt_voltage + offset, derived from manual
@@ -1037,36 +3920,48 @@ class Controller(LogObject):
     max_gain = 885.6
     gain_norm = 4775.0
     
-    max_volt_hist_lenght = 75# number of data points in the signal tuning graph
+    max_volt_hist_lenght = 190# number of data points in the signal tuning graph (7.6 s)
+    
+    #oscilloscope analysis: the input range is adjusted if clip_fraction_limit is exceeded in clip_refresh_count consecutive traces
+    clip_fraction_limit = 0.001
+    clip_refresh_count = 3
+    scope_analysis = None
     edt_changed_color = '#FFBAC5'
+    illegal_chars = '#@$%^&*{}:;"|<>/?\`~'+"'" #not allowed in filenames
+    
+    kinetics_capacity = 100000 #latest points of a kinetics measurement that are shown in the plots
+    kinetics_chunk_size = 100 #points of a kinetics measurement that are written to the file at once
+    kinetics = None #KineticsBuffer of the current or last kinetics measurement, None during wavelength scans
+    kinetics_avg_blocks = 10
+    
+    #axis types of maps (see start_map), further ScanAxis subclasses can be added
+    scan_axis_types = {'emission': EmissionAxis,
+                       'excitation': ExcitationAxis,
+                       'temperature': TemperatureAxis,
+                       'field': FieldAxis,
+                       'simulated': SimulatedAxis}
+    
+    pmt_settle_time = 10 #s, waiting time after changing the PMT voltage before a queued measurement starts
     
-    curr_spec = np.array([[],#wavelenght
-                          [],#DC
-                          [],#DC stddev                          
-                          [],#AC
-                          [],#AC stddev
-                          [],#I_L
-                          [],#I_L stddev
-                          [],#I_R
-                          [],#I_R stddev  
-                          [],#glum
-                          [],#glum stddev
-                          [],#lp_r
-                          [],#lp_r stddev
-                          [],#lp theta
-                          [],#lp theta stddev
-                          [],#lp
-                          []])#lp stddev
+    #If True, only the identity of the devices is tested during initialization (no movement of the monochromator grating)
+    fast_health_check = False
+    
+    #current spectrum, SpectrumBuffer with the rows
+    #WL, DC, DC stddev, AC, AC stddev, I_L, I_L stddev, I_R, I_R stddev, glum, glum stddev,
+    #lp_r, lp_r stddev, lp theta, lp theta stddev, lp, lp stddev
+    curr_spec = SpectrumBuffer([], 17)
     index_ac = 3 #in curr_spec
     index_dc = 1
     index_glum = 9
     index_lp_theta = 13    
     
-    #averaged spectrum during measurement
-    avg_spec = np.array([[],#wavelenght
-                          [],#DC
-                          [],#AC
-                          []])#glum
+    save_format = 'csv' #format of the saved spectra: 'csv', 'npz' (binary) or 'both'
+    
+    #averaged spectrum during measurement, SpectrumStats with the same rows as curr_spec
+    avg_spec = SpectrumStats([], 17, range(2,17,2))
+    #Averaging of the final spectrum of repeated scans: 'mean', 'weighted' (inverse-variance), 'sigma_clip' or 'median'
+    #With 'mean' the running average is used, the other methods are applied to all scans at the end of the measurement.
+    avg_method = 'mean'
     
     #variables required for phase offset calibration
     cal_running = False
@@ -1074,6 +3969,12 @@ class Controller(LogObject):
     cal_new_value = 0.0
     cal_theta_thread = None
     
+    #variables required for the measurement queue
+    queue_running = False
+    meas_queue = None
+    
+    curr_nm = float('nan') #last wavelength set with move_nm
+    
     
     #---Start of initialization/closing section---    
     
@@ -1081,8 +3982,7 @@ class Controller(LogObject):
         #Locks to prevent race conditions in multithreading
         self.pem_lock = th.Lock()
         self.mono_lock = th.Lock()
-        self.lockin_daq_lock = th.Lock()
-        self.lockin_osc_lock = th.Lock()
+        self.lockin_lock = th.Lock()
         
         #This trigger to stop spectra acquisition is a list to pass it by reference to the read_data thread
         self.stop_spec_trigger = [False]
@@ -1090,12 +3990,27 @@ class Controller(LogObject):
         self.stop_osc_trigger = False
         #For phaseoffset calibration
         self.stop_cal_trigger = [False]
+        #For the measurement queue
+        self.stop_queue_trigger = False
         self.spec_thread = None
         
         #Create window
         self.gui = gui.gui_script.GUI()
-        self.log_queue = queue.Queue()
+        #all objects use the bus to update the GUI or show error dialogs from other threads
+        self.log_queue = LogBuffer(level=self.log_level)
+        self.gui_bus = GUIUpdateBus(self.log_queue)
+        LogObject.gui_bus = self.gui_bus
+        self.log_file = LogFile(self.log_path)
         self.log_box = self.gui.edt_debuglog
+        #results are saved in the background
+        self.writer = ResultWriter(self.log_queue)
+        #conversion, correction and averaging of spectra, correction files are only read once as long as they are not modified
+        self.processor = SpectrumProcessor(self.log_queue,".\\data\\")
+        self.spectrum_file = self.processor.spectrum_file
+        self.blank_library = self.processor.blank_library
+        #catalog of all saved spectra, spectra that were saved while the program was not running are added in the background
+        self.catalog = MeasurementCatalog(".\\data\\",self.spectrum_file)
+        th.Thread(target=self.catalog.index_directory,daemon=True).start()
         self.assign_gui_events()
     
         if os.path.exists("last_params.txt"):
@@ -1103,9 +4018,15 @@ class Controller(LogObject):
         
         self.set_initialized(False)
         self.set_acquisition_running(False)    
+        
+        self.control_server = None
+        if self.control_server_active:
+            self.control_server = ControlServer(self)
+            self.control_server.start()
     
         self.log_author_message()
         self.update_log()
+        self.update_gui()
         
         self.gui.window.mainloop()          
     
@@ -1183,71 +4104,97 @@ class Controller(LogObject):
     
     def init_devices(self):        
         try:           
+            t0 = time.time()
             rm_pem = pyvisa.ResourceManager()
+            rm_mono = pyvisa.ResourceManager()
             self.log('Available COM devices: {}'.format(rm_pem.list_resources()))       
-            self.log('Initialize PEM-200...')
-            self.window_update()            
-
-            self.pem_lock.acquire()
+            if self.fast_health_check:
+                self.log('Fast health check: only the identity of the monochromator is tested.')
+            self.log('Initialize PEM-200, monochromator SP-2155 and lock-in amplifier MFLI...')
+            self.window_update()
+            
             self.pem = PEM()
-            self.window_update()            
-            b1 = self.pem.initialize(rm_pem,self.log_queue)
-            self.pem_lock.release()
-            self.window_update()
+            self.mono = Mono()
+            #one API session of the lock-in amplifier is used for data acquisition and oscilloscope monitoring
+            if self.acquisition_process:
+                self.lockin = MFLIProcess('dev3902','LIA',self.log_queue)
+            else:
+                self.lockin = MFLI('dev3902','LIA',self.log_queue)
+            
+            #The devices do not depend on each other during the setup, so they are connected and tested in parallel
+            #The Bessel correction factors are class constants of PEM and do not require a connection to the PEM
+            results = {}
+            threads = [th.Thread(target=self.init_pem,args=(rm_pem,results)),
+                       th.Thread(target=self.init_mono,args=(rm_mono,results)),
+                       th.Thread(target=self.init_lockin,args=(results,))]
+            for t in threads:
+                t.start()
+            #keep the window responsive while waiting
+            while any(t.is_alive() for t in threads):
+                self.window_update()
+                time.sleep(0.02)
             self.log('')
+            
+            if results['pem'] and results['mono'] and results['lockin']:
+                self.update_PMT_voltage_edt(self.lockin.pmt_volt)
+                self.set_phaseoffset_from_edt()
+                
+                self.gui.setup_osc_trace(self.max_volt_hist_lenght,self.osc_refresh_delay/1000)
+                self.stop_osc_trigger = False
+                self.start_osc_monit()
+                
+                self.set_initialized(True)                            
+                self.move_nm(1000)
 
-            if b1:
-                self.log('Initialize monochromator SP-2155...')
-                rm_mono = pyvisa.ResourceManager()
-                self.window_update()            
-                self.mono_lock.acquire()
-                self.mono = Mono()
                 self.window_update()
-                b2 = self.mono.initialize(rm_mono,self.log_queue)  
-                self.mono_lock.release()
-                self.window_update()            
                 self.log('')
-
-                if b2:
-                    self.log('Initialize lock-in amplifier MFLI for data acquisition...')
-                    self.window_update()            
-                    self.lockin_daq_lock.acquire()
-                    self.lockin_daq = MFLI('dev3902','LID',self.log_queue)
-                    self.window_update()            
-                    b3 = self.lockin_daq.connect()
-                    self.window_update()            
-                    b3 = b3 and self.lockin_daq.setup_for_daq(self.pem.bessel_corr, self.pem.bessel_corr_lp)    
-                    self.update_PMT_voltage_edt(self.lockin_daq.pmt_volt)
-                    self.lockin_daq_lock.release()
-                    self.set_phaseoffset_from_edt()                    
-                    self.window_update()
-                    self.log('')
-
-                    if b3:
-                        self.log('Initialize lock-in amplifier MFLI for oscilloscope monitoring...')
-                        self.window_update()            
-                        self.lockin_osc_lock.acquire()
-                        self.lockin_osc = MFLI('dev3902','LIA',self.log_queue)
-                        self.window_update()            
-                        b4 = self.lockin_osc.connect()
-                        self.window_update()            
-                        b4 = b4 and self.lockin_osc.setup_for_scope()
-                        self.lockin_osc_lock.release()
-                        self.max_volt_history = collections.deque(maxlen=self.max_volt_hist_lenght)
-                        self.osc_refresh_delay = 100#ms
-                        self.stop_osc_trigger = False
-                        self.start_osc_monit()
-
-                        if b4:
-                            self.set_initialized(True)                            
-                            self.move_nm(1000)
-
-                            self.window_update()
-                            self.log('')
-                            self.log('Initialization complete!')
+                self.log('Initialization complete! ({:.1f} s)'.format(time.time()-t0))
+            else:
+                failed = [name for name in ['pem','mono','lockin'] if not results[name]]
+                self.log('ERROR during initialization of: {}!'.format(', '.join(failed)),True)
+                self.close_devices_after_failed_init(results)
+                self.set_initialized(False)
         except Exception as e:
             self.set_initialized(False)
             self.log('ERROR during initialization: {}!'.format(str(e)),True) 
+    
+    #The init_... functions will be executed in separate threads, the result is stored in results[device]
+    def init_pem(self,rm,results:dict):
+        self.run_init_step('pem',self.pem_lock,lambda: self.pem.initialize(rm,self.log_queue),results)
+    
+    def init_mono(self,rm,results:dict):
+        self.run_init_step('mono',self.mono_lock,lambda: self.mono.initialize(rm,self.log_queue,not self.fast_health_check),results)
+    
+    def init_lockin(self,results:dict):
+        self.run_init_step('lockin',self.lockin_lock,
+                           lambda: self.lockin.connect() and self.lockin.setup_for_daq_and_scope(PEM.bessel_corr, PEM.bessel_corr_lp),results)
+    
+    def run_init_step(self,name:str,lock,func,results:dict):
+        results[name] = False
+        lock.acquire()
+        try:
+            results[name] = func()
+        except Exception as e:
+            self.log('Error during initialization of {}: {}'.format(name,str(e)),True)
+        finally:
+            lock.release()
+    
+    #Closes the connections that were successfully established, so that the initialization can be repeated
+    #The PEM and the monochromator are also closed if their resource was opened but the test failed, 
+    #otherwise their COM ports would stay blocked until CatCPL is restarted
+    def close_devices_after_failed_init(self,results:dict):
+        for device in [self.pem,self.mono]:
+            try:
+                if hasattr(device,'inst'):
+                    device.close()
+            except Exception as e:
+                self.log('Error while closing connections: {}.'.format(str(e)),True)
+        try:
+            if results.get('lockin'):
+                self.lockin.disconnect()
+            self.lockin.close()
+        except Exception as e:
+            self.log('Error while closing connections: {}.'.format(str(e)),True)
             
     def disconnect_devices(self):
         self.log('')
@@ -1263,8 +4210,8 @@ class Controller(LogObject):
         try:
             self.pem.close()
             self.mono.close()
-            self.lockin_daq.disconnect()
-            self.lockin_osc.disconnect()
+            self.lockin.disconnect()
+            self.lockin.close()
             self.log('Connections closed.')
             self.set_initialized(False)
         except Exception as e:
@@ -1281,10 +4228,15 @@ class Controller(LogObject):
                     self.cal_stop_record()
                     time.sleep(1)
                     
-            self.save_params('last')
+            self.processor.save_params('last',self.get_params_from_gui())
+            if not self.control_server is None:
+                self.control_server.stop()
+            #write all pending results before closing
+            self.writer.stop()
             
             if self.initialized:
                 self.disconnect_devices()
+            self.log_file.write(self.log_queue.get_all())
             self.gui.window.destroy()            
             
     #---End of initialization/closing section---
@@ -1344,18 +4296,29 @@ class Controller(LogObject):
         #Spectra Setup
         self.gui.btn_start.config(command=self.click_start_spec) 
         self.gui.btn_abort.config(command=self.click_abort_spec)    
+        self.gui.btn_queue.config(command=self.click_queue)
+        self.gui.btn_kinetics.config(command=self.click_kinetics)
+        self.gui.btn_resume.config(command=self.click_resume)
     
         self.gui.window.protocol("WM_DELETE_WINDOW", self.on_closing)
         
     #(de)activate buttons and text components depending on the state of the software
     def set_active_components(self):
+        self.gui_bus.post('active_components',self.update_active_components)
+    
+    def update_active_components(self):
+        #A running queue counts as running acquisition, also between two queued measurements
+        running = self.acquisition_running or self.queue_running
         self.gui.btn_init['state'] = self.gui.get_state_const(not self.initialized)
         self.gui.btn_close['state'] = self.gui.get_state_const(self.initialized)
-        self.gui.set_spectra_setup_enable(not self.acquisition_running and self.initialized and not self.cal_running)
-        self.gui.set_signal_tuning_enable(not self.acquisition_running and self.initialized and not self.cal_collecting) 
-        self.gui.btn_start['state'] = self.gui.get_state_const(not self.acquisition_running and self.initialized and not self.cal_running)      
-        self.gui.btn_abort['state'] = self.gui.get_state_const(self.acquisition_running and self.initialized and not self.cal_running)
-        self.gui.btn_cal_phaseoffset['state'] = self.gui.get_state_const(not self.acquisition_running and self.initialized and not self.cal_running)      
+        self.gui.set_spectra_setup_enable(not running and self.initialized and not self.cal_running)
+        self.gui.set_signal_tuning_enable(not running and self.initialized and not self.cal_collecting) 
+        self.gui.btn_start['state'] = self.gui.get_state_const(not running and self.initialized and not self.cal_running)      
+        self.gui.btn_abort['state'] = self.gui.get_state_const(running and self.initialized and not self.cal_running)
+        self.gui.btn_queue['state'] = self.gui.get_state_const(not running and self.initialized and not self.cal_running)
+        self.gui.btn_kinetics['state'] = self.gui.get_state_const(not running and self.initialized and not self.cal_running)
+        self.gui.btn_resume['state'] = self.gui.get_state_const(not running and self.initialized and not self.cal_running)
+        self.gui.btn_cal_phaseoffset['state'] = self.gui.get_state_const(not running and self.initialized and not self.cal_running)      
         self.gui.set_cat_visible(self.initialized)
         self.update_mfli_status(self.initialized)
         self.update_initialized_status(self.initialized)
@@ -1363,17 +4326,30 @@ class Controller(LogObject):
     def window_update(self):
         self.gui.window.update() 
     
+    #All new log messages are shown in the log box and written to the log file at once
     def update_log(self):
-        #Handle all log messages currently in the queue, if any
-        while self.log_queue.qsize():
-            try:
-                msg = self.log_queue.get(0)
-                self.log_box.insert(tk.END,msg+'\n')
-                self.log_box.see(tk.END)
-            except queue.Empty:
-                pass    
+        records = self.log_queue.get_all()
+        if len(records) > 0:
+            text = ''.join(s+'\n' for t, level, s in records)
+            if self.print_log:
+                print(text,end='')
+            self.log_file.write(records)
+            
+            self.log_box.insert(tk.END,text)
+            lines = int(self.log_box.index('end-1c').split('.')[0])
+            if lines > self.log_box_lines:
+                self.log_box.delete('1.0','{}.0'.format(lines-self.log_box_lines))
+            self.log_box.see(tk.END)
+            
+            for t, level, s in records:
+                if level >= LogBuffer.ERROR:
+                    self.show_error_diag(s)
         self.gui.window.after(self.log_update_interval, self.update_log)
 
+    def update_gui(self):
+        self.gui_bus.drain()
+        self.gui.window.after(self.gui_update_interval, self.update_gui)
+        
     #When the user changes a value in one of the text boxes in the Signal Tuning area
     #the text box is highlighed until the value is saved
     def edt_changed(self, var, index, mode):
@@ -1465,6 +4441,12 @@ class Controller(LogObject):
     def click_abort_spec(self):
         self.abort_measurement()   
         
+    def click_queue(self):
+        self.queue_dialog_open()
+        
+    def click_kinetics(self):
+        self.kinetics_window = KineticsDialog(self)
+        
     def update_phaseoffset_edt(self,value:float):
         self.set_edt_text(self.gui.edt_phaseoffset,'{:.3f}'.format(value))
     
@@ -1491,58 +4473,112 @@ class Controller(LogObject):
             time_left = time_left/3600
         
         #Update label text
-        self.gui.canvas.itemconfigure(self.gui.txt_progress, text='{:.1f} % ({:d}/{:d}), ca. {:.1f} {}'.format(f,run,run_count,time_left,unit))
+        self.set_canvas_text(self.gui.txt_progress,'{:.1f} % ({:d}/{:d}), ca. {:.1f} {}'.format(f,run,run_count,time_left,unit))
     
     def update_initialized_status(self,b:bool):
         if b:
-            self.gui.canvas.itemconfigure(self.gui.txt_init, text='True')
+            self.set_canvas_text(self.gui.txt_init,'True')
         else:
-            self.gui.canvas.itemconfigure(self.gui.txt_init, text='False')
+            self.set_canvas_text(self.gui.txt_init,'False')
     
     def update_mfli_status(self,b:bool):
         if b:
-            self.gui.canvas.itemconfigure(self.gui.txt_mfli, text='connected')
+            self.set_canvas_text(self.gui.txt_mfli,'connected')
         else:
-            self.gui.canvas.itemconfigure(self.gui.txt_mfli, text='-')
+            self.set_canvas_text(self.gui.txt_mfli,'-')
             
     def update_osc_captions(self,curr:float,label):
         if not np.isnan(curr):
-            self.gui.canvas.itemconfigure(label, text='{:.1e} V'.format(curr))
+            self.set_canvas_text(label,'{:.1e} V'.format(curr))
+    
+    def update_scope_analysis_caption(self,analysis):
+        if not analysis is None:
+            if analysis['pem_lock_ok']:
+                s = '1f {:.1e} V, 2f {:.1e} V'.format(analysis['amp_1f'],analysis['amp_2f'])
+            else:
+                s = 'PEM not locked'
+            s = s + ', clip {:.1f} %, headroom x{:.1f}'.format(analysis['clip_fraction']*100,analysis['headroom'])
+            self.set_canvas_text(self.gui.txt_scope_analysis,s)
     
-    def update_osc_plots(self,max_vals):
-        self.gui.plot_osc(data_max=max_vals,max_len=self.max_volt_hist_lenght,time_step=self.osc_refresh_delay)            
+    def update_osc_plots(self):
+        self.gui.osc_trace.refresh()
 
     def update_PMT_voltage_edt(self,volt):
         self.set_edt_text(self.gui.edt_pmt,'{:.3f}'.format(volt))
         self.set_edt_text(self.gui.edt_gain,'{:.3f}'.format(self.volt_to_gain(volt)))  
-        self.gui.edt_pmt.config(bg='#FFFFFF')
-        self.gui.edt_gain.config(bg='#FFFFFF')        
-        self.window_update()    
+        self.set_edt_color(self.gui.edt_pmt,'#FFFFFF')
+        self.set_edt_color(self.gui.edt_gain,'#FFFFFF')
+        if self.gui_bus.in_gui_thread():
+            self.window_update()    
         
     def update_mono_edt_lbl(self,wl):
-        self.gui.canvas.itemconfigure(self.gui.txt_mono, text='{:.2f} nm'.format(wl))
+        self.set_canvas_text(self.gui.txt_mono,'{:.2f} nm'.format(wl))
         self.set_edt_text(self.gui.edt_WL,'{:.2f}'.format(wl))     
-        self.gui.edt_WL.config(bg='#FFFFFF') 
+        self.set_edt_color(self.gui.edt_WL,'#FFFFFF')
             
     def update_pem_lbl(self,wl):
-        self.gui.canvas.itemconfigure(self.gui.txt_PEM, text='{:.2f} nm'.format(wl))
+        self.set_canvas_text(self.gui.txt_PEM,'{:.2f} nm'.format(wl))
+        
+    #The following functions can be called from any thread, only the latest value of a widget is shown (see GUIUpdateBus)
+    def set_canvas_text(self,item,s):
+        self.gui_bus.post(('text',item),lambda: self.gui.canvas.itemconfigure(item, text=s))
         
     def set_edt_text(self,edt,s):
-        state_before = edt['state']
-        edt['state'] = self.gui.get_state_const(True)
-        edt.delete(0,tk.END)
-        edt.insert(0,s)
-        edt['state'] = state_before     
+        def update():
+            state_before = edt['state']
+            edt['state'] = self.gui.get_state_const(True)
+            edt.delete(0,tk.END)
+            edt.insert(0,s)
+            edt['state'] = state_before     
+        self.gui_bus.post(('text',edt),update)
+        
+    def set_edt_color(self,edt,color):
+        self.gui_bus.post(('bg',edt),lambda: edt.config(bg=color))
+        
+    def set_cbx_text(self,cbx,s):
+        self.gui_bus.post(('text',cbx),lambda: cbx.set(s))
+        
+    #Data of the spectra plot, views of the recorded points or copies for saving the figure in another thread
+    def get_spec_plot_data(self,snapshot:bool=False) -> dict:
+        kinetics = self.kinetics
+        if not kinetics is None:
+            return self.get_kinetics_plot_data(kinetics)
+        curr_spec = self.curr_spec.data
+        avg_spec = self.avg_spec.data
+        if snapshot:
+            curr_spec = curr_spec.copy()
+            avg_spec = avg_spec.copy()
+        return {'tot': [curr_spec[0],curr_spec[self.index_dc]],
+                'tot_avg': [avg_spec[0],avg_spec[self.index_dc]],
+                'cpl': [curr_spec[0],curr_spec[self.index_ac]],
+                'cpl_avg': [avg_spec[0],avg_spec[self.index_ac]],
+                'glum': [curr_spec[0],curr_spec[self.index_glum]],
+                #glum of the average is calculated from the averaged AC and DC
+                'glum_avg': [avg_spec[0],2*avg_spec[self.index_ac]/avg_spec[self.index_dc]],
+                'wl_range': self.get_wl_range()}
+    
+    #The time axis of a kinetics measurement is extended while the data grows, the average contains blocks of kinetics_avg_blocks points
+    def get_kinetics_plot_data(self,kinetics:KineticsBuffer) -> dict:
+        data = kinetics.data
+        avg = kinetics.get_block_averages(self.kinetics_avg_blocks)
+        return {'tot': [data[0],data[self.index_dc]],
+                'tot_avg': [avg[0],avg[self.index_dc]],
+                'cpl': [data[0],data[self.index_ac]],
+                'cpl_avg': [avg[0],avg[self.index_ac]],
+                'glum': [data[0],data[self.index_glum]],
+                'glum_avg': [avg[0],2*avg[self.index_ac]/avg[self.index_dc]],
+                'wl_range': None}
+    
+    #Wavelength range of the current scan or None
+    def get_wl_range(self) -> list:
+        wavelengths = self.avg_spec.wavelengths
+        if wavelengths.size == 0:
+            return None
+        return [wavelengths.min(),wavelengths.max()]
         
     def update_spec(self): 
         if self.acquisition_running:
-            self.gui.plot_spec(
-                tot=[self.curr_spec[0],self.curr_spec[self.index_dc]],
-                tot_avg=[self.avg_spec[0],self.avg_spec[1]],
-                cpl=[self.curr_spec[0],self.curr_spec[self.index_ac]],
-                cpl_avg=[self.avg_spec[0],self.avg_spec[2]],
-                glum=[self.curr_spec[0],self.curr_spec[self.index_glum]],
-                glum_avg=[self.avg_spec[0],self.avg_spec[3]],)
+            self.gui.plot_spec(**self.get_spec_plot_data())
         
         if not self.spec_thread is None:
             if self.spec_thread.is_alive():
@@ -1554,59 +4590,87 @@ class Controller(LogObject):
     
     #---Start of spectra acquisition section---
         
-    def start_spec(self): 
+    #Returns True if the file does not need to be checked (empty name) or exists in the data folder
+    def filename_exists_or_empty(self,name: str) -> bool:
+        if name == '':
+            return True
+        else:
+            return self.spectrum_file.exists(".\\data\\"+name)
         
-        def filename_exists_or_empty(name: str) -> bool:
-            if name == '':
-                return True
-            else:
-                return os.path.exists(".\\data\\"+name+".csv")
-            
-        def check_illegal_chars(s):
-            result = False
-            for c in s:
-                if c in '#@$%^&*{}:;"|<>/?\`~'+"'":
-                    result = True
-                    break
-            return result
+    def check_illegal_chars(self,s:str) -> bool:
+        result = False
+        for c in s:
+            if c in self.illegal_chars:
+                result = True
+                break
+        return result
+    
+    #Collects the measurement parameters from the text boxes of the GUI
+    #The returned dict is passed to record_spec and save_params, so that the acquisition thread does not depend on the state of the GUI
+    def get_params_from_gui(self) -> dict:
+        return {'filename': self.gui.edt_filename.get(),
+                'start_nm': self.gui.edt_start.get(),
+                'end_nm': self.gui.edt_end.get(),
+                'step': self.gui.edt_step.get(),
+                'dwell_time': self.gui.edt_dwell.get(),
+                'reps': self.gui.edt_rep.get(),
+                'exc_slit': self.gui.edt_excSlit.get(),
+                'em_slit': self.gui.edt_emSlit.get(),
+                'exc_wl': self.gui.edt_excWL.get(),
+                'comment': self.gui.edt_comment.get(),
+                'ac_blank': self.gui.edt_ac_blank.get(),
+                'dc_blank': self.gui.edt_dc_blank.get(),
+                'det_corr': self.gui.edt_det_corr.get(),
+                'pem_off': self.gui.var_pem_off.get(),
+                'pmt_volt': self.gui.edt_pmt.get(),
+                'pmt_gain': self.gui.edt_gain.get(),
+                'input_range': self.gui.cbx_range.get(),
+                'phaseoffset': self.gui.edt_phaseoffset.get()}
         
-        ac_blank = self.gui.edt_ac_blank.get()
-        dc_blank = self.gui.edt_dc_blank.get()
-        det_corr = self.gui.edt_det_corr.get()
-        filename = self.gui.edt_filename.get()
-        reps = int(self.gui.edt_rep.get())
+    def start_spec(self): 
+        params = self.get_params_from_gui()
+        ac_blank = params['ac_blank']
+        dc_blank = params['dc_blank']
+        det_corr = params['det_corr']
+        filename = params['filename']
         
-        ac_blank_exists = filename_exists_or_empty(ac_blank)
-        dc_blank_exists = filename_exists_or_empty(dc_blank)
-        det_corr_exists = filename_exists_or_empty(det_corr)
+        ac_blank_exists = self.filename_exists_or_empty(ac_blank)
+        dc_blank_exists = self.filename_exists_or_empty(dc_blank)
+        det_corr_exists = self.filename_exists_or_empty(det_corr)
         
-        if not check_illegal_chars(filename):
+        if not self.check_illegal_chars(filename):
             try:
+                params['start_nm'] = float(params['start_nm'])
+                params['end_nm'] = float(params['end_nm'])
+                params['step'] = float(params['step'])
+                params['dwell_time'] = float(params['dwell_time'])
+                params['reps'] = int(params['reps'])
+                
                 #For averaged measurements add the suffix of the first scan for the filename check
-                if reps == 1:
+                if params['reps'] == 1:
                     s = ''
                 else:
                     s = '_1'
-                filename_exists = filename_exists_or_empty(filename+s)
+                filename_exists = self.filename_exists_or_empty(filename+s)
+                signal_ok = self.check_signal_before_scan(params['pem_off'])
+                
+                #the blanks must cover the planned wavelengths, they are interpolated if necessary
+                wl_grid = self.get_wl_grid(params['start_nm'],params['end_nm'],params['step'])
+                ac_blank_ok = (ac_blank == '') or not ac_blank_exists or not self.blank_library.get(ac_blank,'AC',wl_grid) is None
+                dc_blank_ok = (dc_blank == '') or not dc_blank_exists or not self.blank_library.get(dc_blank,'DC',wl_grid) is None
+
+                #the journal of an interrupted scan with the same name is not overwritten
+                journal_exists = os.path.exists(ScanJournal(".\\data\\"+filename).path)
 
-                error = not ac_blank_exists or not dc_blank_exists or not det_corr_exists or filename_exists
+                error = (not ac_blank_exists or not dc_blank_exists or not det_corr_exists or filename_exists or not signal_ok
+                         or not ac_blank_ok or not dc_blank_ok or journal_exists)
                 
                 if not error:
                     self.stop_spec_trigger[0] = False
 
                     self.set_acquisition_running(True)
 
-                    self.spec_thread = th.Thread(target=self.record_spec,args=(
-                        float(self.gui.edt_start.get()),
-                        float(self.gui.edt_end.get()),
-                        float(self.gui.edt_step.get()),
-                        float(self.gui.edt_dwell.get()),
-                        reps,
-                        filename,
-                        ac_blank,
-                        dc_blank,
-                        det_corr,
-                        self.gui.var_pem_off.get()))
+                    self.spec_thread = th.Thread(target=self.record_spec,args=(params,))
                     self.spec_thread.start() 
                     self.update_spec()
                 else:
@@ -1614,17 +4678,51 @@ class Controller(LogObject):
                         self.log('Error: AC-blank file does not exist!',True)
                     if not dc_blank_exists:
                         self.log('Error: DC-blank file does not exist!',True)
+                    if not ac_blank_ok:
+                        self.log('Error: AC-blank does not cover the wavelength range (or its points are more than {} nm apart)!'.format(self.blank_library.max_gap),True)
+                    if not dc_blank_ok:
+                        self.log('Error: DC-blank does not cover the wavelength range (or its points are more than {} nm apart)!'.format(self.blank_library.max_gap),True)
                     if not det_corr_exists:
                         self.log('Error: Detector correction file does not exist!',True)
                     if filename_exists:
                         self.log('Error: Spectra filename {} already exists!'.format(filename+s),True)
+                    if journal_exists:
+                        self.log('Error: The journal of an interrupted scan {} exists! Resume the scan or remove the journal.'.format(filename),True)
             except Exception as e:
                 self.log('Error in click_start_spec: '+str(e),True)
         else:
-            self.log('Error: Filename contains one of these illegal characters: '+'#@$%^&*{}:;"|<>/?\`~'+"'")
+            self.log('Error: Filename contains one of these illegal characters: '+self.illegal_chars,True)
+    
+    #Checks the latest oscilloscope analysis for clipping and for the lock to the PEM reference before a scan is started
+    #For measurements with PEM off (AC blank) the lock is not checked
+    def check_signal_before_scan(self,pem_off:int) -> bool:
+        analysis = self.scope_analysis
+        if analysis is None:
+            return True
+        
+        ok = True
+        if analysis['clip_fraction'] >= self.clip_fraction_limit:
+            self.log('Error: Signal is clipped ({:.2f} % of the samples at the input range limit)! Increase the input range or lower the gain.'.format(analysis['clip_fraction']*100),True)
+            ok = False
+        if pem_off == 0 and not analysis['pem_lock_ok']:
+            self.log('Error: Lock-in amplifier is not locked to the PEM (reference at {:.0f} Hz)! Check the PEM.'.format(analysis['ref_freq']),True)
+            ok = False
+        return ok
     
     #will be executed in separate thread
-    def record_spec(self,start_nm:float,end_nm:float,step:float,dwell_time:float,reps:int,filename:str,ac_blank:str,dc_blank:str,det_corr:str,pem_off:int):
+    #params: dict of measurement parameters as returned by get_params_from_gui
+    #journal: loaded ScanJournal to resume an interrupted scan
+    def record_spec(self,params:dict,journal:ScanJournal=None):
+        start_nm = params['start_nm']
+        end_nm = params['end_nm']
+        step = params['step']
+        dwell_time = params['dwell_time']
+        reps = params['reps']
+        filename = params['filename']
+        ac_blank = params['ac_blank']
+        dc_blank = params['dc_blank']
+        det_corr = params['det_corr']
+        pem_off = params['pem_off']
         
         def check_lp_theta_std(lp:float) -> bool:
             if lp < self.lp_theta_std_warning_threshold:
@@ -1639,30 +4737,47 @@ class Controller(LogObject):
 
         self.log('Starting data acquisition.')
         
-        self.lockin_daq_lock.acquire()
-        self.lockin_daq.set_dwell_time(dwell_time)
-        self.lockin_daq_lock.release()
+        self.lockin_lock.acquire()
+        self.lockin.set_dwell_time(dwell_time)
+        #the current settings of the lock-in amplifier are saved in the parameter file
+        params['mfli_config'] = self.lockin.get_config_snapshot()
+        self.lockin_lock.release()
         
         #wait for MFLI buffer to be ready
         self.interruptable_sleep(dwell_time)
 
-        #array of pandas dataframes with all spectral data
-        dfall_spectra = np.empty(reps, dtype=object)
-        #avg_spec is used to display the averaged spectrum during the measurement
-        self.avg_spec = np.array([[],#wavelength
-                     [],#DC
-                     [],#AC
-                     []])#glum
-
-        correction = ac_blank != '' or dc_blank != '' or det_corr != ''
+        #the plots show spectra again after a kinetics measurement
+        self.kinetics = None
+        self.gui_bus.post('spec_xlabel',functools.partial(self.gui.set_spec_xlabel,'WL / nm'))
 
-        if start_nm > end_nm:
-            inc = -step
+        #all spectra are preallocated on the planned wavelength grid
+        wl_grid = self.get_wl_grid(start_nm,end_nm,step)
+        #avg_spec is updated with every new datapoint, it is displayed during the measurement and saved after each repetition
+        self.avg_spec = SpectrumStats(wl_grid,17,range(2,17,2))
+        #all scans for the final averaging (repetitions, rows, points)
+        all_spec = np.full((reps,17,wl_grid.size),np.nan)
+        params['avg_method'] = self.avg_method
+        
+        #every measured point is written to the journal, so that the scan can be resumed after a crash
+        if journal is None:
+            journal = ScanJournal(".\\data\\"+filename)
+            try:
+                journal.create(params)
+            except FileExistsError:
+                self.log('Error: The journal {} of an interrupted scan already exists! Resume the scan or remove the journal.'.format(journal.path),True)
+                self.set_acquisition_running(False)
+                return
         else:
-            inc = step   
-        direction = np.sign(inc)
+            journal.open_append()
+        #points of a resumed scan for each repetition
+        resumed = collections.defaultdict(list)
+        for rep, values in journal.points:
+            resumed[rep].append(values)
+
+        correction = ac_blank != '' or dc_blank != '' or det_corr != ''
 
         self.update_progress_txt(0,1,0,1,reps,0)
+        self.notify_clients('scan',{'state': 'started', 'filename': filename, 'reps': reps, 'points': int(wl_grid.size)})
 
         #Disable PEM for AC background measurement
         self.set_modulation_active(pem_off == 0)
@@ -1670,37 +4785,44 @@ class Controller(LogObject):
         time_since_start = -1.0
         t0 = time.time()
 
+        #complete repetitions of a resumed scan are restored, an incomplete repetition is continued below
         i = 0
+        while (i<reps) and (len(resumed[i]) >= wl_grid.size):
+            all_spec[i] = np.array(resumed[i][:wl_grid.size]).T
+            if reps > 1:
+                for values in resumed[i]:
+                    self.avg_spec.add(values)
+                index_str = '_'+str(i+1)
+            else:
+                index_str = ''
+            #the files of the repetition are saved again if they were not written before the interruption
+            if not self.filename_exists_or_empty(filename+index_str):
+                self.save_spec(self.processor.np_to_pd(all_spec[i].copy()),filename+index_str,params,False)
+            if correction and not self.filename_exists_or_empty(filename+index_str+'_corr'):
+                dfspec_corr = self.processor.apply_corr(self.processor.np_to_pd(all_spec[i].copy()),ac_blank,dc_blank,det_corr,filename+index_str)
+                self.save_spec(dfspec_corr,filename+index_str+'_corr',params,False)
+            i += 1
+        if len(journal.points) > 0:
+            self.log('Resuming scan at repetition {}/{} with {} points from the journal.'.format(min(i+1,reps),reps,len(journal.points)))
+
         while (i<reps) and not self.stop_spec_trigger[0]:
             self.log('')
             self.log('Run {}/{}'.format(i+1,reps))
 
             lp_detected = False
 
-            self.curr_spec = np.array([[],#wavelenght
-                                      [],#AC
-                                      [],#AC stddev
-                                      [],#DC
-                                      [],#DC stddev
-                                      [],#I_L
-                                      [],#I_L stddev
-                                      [],#I_R
-                                      [],#I_R stddev  
-                                      [],#glum
-                                      [],#glum stddev
-                                      [],#lp_r
-                                      [],#lp_r stddev
-                                      [],#lp theta
-                                      [],#lp theta stddev
-                                      [],#lp 
-                                      []])#lp stddev
+            self.curr_spec = SpectrumBuffer(wl_grid,17)
+            #points of an incomplete repetition of a resumed scan
+            for values in resumed[i]:
+                self.curr_spec.append(values)
+                if reps > 1:
+                    self.avg_spec.add(values)
 
             #self.log('start {}'.format(time.time()-t0))
-            curr_nm = start_nm-inc          
-            while ((((direction > 0) and (curr_nm < end_nm)) or ((direction < 0) and (curr_nm > end_nm)))
-                   and not self.stop_spec_trigger[0]):                                
-
-                curr_nm = curr_nm+inc
+            k = len(self.curr_spec)
+            while (k < wl_grid.size) and not self.stop_spec_trigger[0]:
+                curr_nm = wl_grid[k]
+                k += 1
                 #self.log('before move {:.3f}'.format(time.time()-t0))
                 self.move_nm(curr_nm,pem_off == 0)
                 #self.log('after move {:.3f}'.format(time.time()-t0))
@@ -1714,11 +4836,11 @@ class Controller(LogObject):
                 #Try 5 times to get a valid dataset from the MFLI
                 while (j<5) and not success and not self.stop_spec_trigger[0]:  
                     #self.log('before acquire {:.3f}'.format(time.time()-t0))
-                    self.lockin_daq_lock.acquire()
+                    self.lockin_lock.acquire()
                     #self.log('afer lock {:.3f}'.format(time.time()-t0))
-                    data = self.lockin_daq.read_data(self.stop_spec_trigger)
+                    data = self.lockin.read_data(self.stop_spec_trigger)
                     #self.log('after read {:.3f}'.format(time.time()-t0))
-                    self.lockin_daq_lock.release()
+                    self.lockin_lock.release()
 
                     if not self.stop_spec_trigger[0]:
                         #Check if there is a linearly polarized component (2f) in the signal
@@ -1733,11 +4855,13 @@ class Controller(LogObject):
 
                 if not self.stop_spec_trigger[0]:
                     #add current wavelength to dataset
-                    data_with_WL = np.array([np.concatenate(([curr_nm],data['data']))])
+                    data_with_WL = np.concatenate(([curr_nm],data['data']))
                     #add dataset to current spectrum
-                    self.curr_spec = np.hstack((self.curr_spec, data_with_WL.T))
+                    self.curr_spec.append(data_with_WL)
+                    journal.add_point(i,data_with_WL)
+                    self.notify_point(filename,i,len(self.curr_spec)-1,data_with_WL)
                     if reps > 1:
-                        self.add_data_to_avg_spec(data_with_WL,i)
+                        self.avg_spec.add(data_with_WL)
 
                 time_since_start = time.time()-t0
                 self.update_progress_txt(start_nm,end_nm,curr_nm,i+1,reps,time_since_start)
@@ -1749,18 +4873,23 @@ class Controller(LogObject):
             self.log('This scan took {:.0f} s.'.format(time_since_start))
 
             #process spectra as dataframes (df)
-            dfcurr_spec = self.np_to_pd(self.curr_spec)
+            dfcurr_spec = self.processor.np_to_pd(self.curr_spec.data)
             if reps > 1:
                 index_str = '_'+str(i+1)
             else:
                 index_str = ''                
-            self.save_spec(dfcurr_spec,filename+index_str)
+            self.save_spec(dfcurr_spec,filename+index_str,params)
 
             if correction:
-                dfcurr_spec_corr = self.apply_corr(dfcurr_spec,ac_blank,dc_blank,det_corr)
-                self.save_spec(dfcurr_spec_corr,filename+index_str+'_corr',False)
+                dfcurr_spec_corr = self.processor.apply_corr(dfcurr_spec,ac_blank,dc_blank,det_corr,filename+index_str)
+                self.save_spec(dfcurr_spec_corr,filename+index_str+'_corr',params,False)
 
-            dfall_spectra[i] = dfcurr_spec
+            all_spec[i] = self.curr_spec.buffer
+
+            #the running average is saved after each repetition so that the _avg file is always up to date
+            if (reps > 1) and (i > 0) and not self.stop_spec_trigger[0]:
+                dfavg_spec = self.processor.calc_cpl(self.processor.np_to_pd(self.avg_spec.data.copy()))
+                self.save_spec(dfavg_spec,filename+'_avg',params,False)
 
             if lp_detected:
                 self.log('')
@@ -1771,211 +4900,132 @@ class Controller(LogObject):
         self.log('Stopping data acquisition.')
         self.set_acquisition_running(False)
 
-        #averaging and correction of the averaged spectrum
+        #final averaging and correction of the averaged spectrum
+        #(also if all repetitions of a resumed scan were restored from the journal)
         if reps > 1 and not self.stop_spec_trigger[0]:
-            dfavg_spec = self.df_average_spectra(dfall_spectra)
-            self.save_spec(dfavg_spec,filename+'_avg',False)      
-
+            if self.avg_method != 'mean':
+                dfavg_spec = self.processor.average_spectra(all_spec,self.avg_method)
+            else:
+                dfavg_spec = self.processor.calc_cpl(self.processor.np_to_pd(self.avg_spec.data.copy()))
+            self.save_spec(dfavg_spec,filename+'_avg',params,False)
+            
             if correction:
-                dfavg_spec_corr = self.apply_corr(dfavg_spec_recalc,ac_blank,dc_blank,det_corr)
-                self.save_spec(dfavg_spec_corr,filename+'_avg_corr',False)            
+                dfavg_spec_corr = self.processor.apply_corr(dfavg_spec,ac_blank,dc_blank,det_corr,filename+'_avg')
+                self.save_spec(dfavg_spec_corr,filename+'_avg_corr',params,False)            
+
+        #the journal is kept if the scan was interrupted
+        if self.stop_spec_trigger[0]:
+            journal.close()
+            self.log('The scan can be resumed from {}'.format(journal.path))
+        else:
+            journal.remove()
+
+        #wait until all files of this measurement are written
+        failed = self.writer.flush()
+        if len(failed) > 0:
+            self.log('Error: {} could not be saved!'.format(', '.join(failed)),True)
+        else:
+            self.log('All files are saved.')
 
         self.log('')
         self.log('Returning to start wavelength')
         self.set_modulation_active(True)
         self.move_nm(start_nm,move_pem=True)
 
+        self.notify_clients('scan',{'state': 'aborted' if self.stop_spec_trigger[0] else 'finished', 'filename': filename})
         self.stop_spec_trigger[0] = False
         #except Exception as e:
             #self.log("Error in record_spec: {}".format(str(e)))
     
+    #Notifications for the clients of the ControlServer that subscribed
+    def notify_clients(self,method:str,params:dict):
+        if not self.control_server is None and self.control_server.has_subscribers():
+            self.control_server.publish(method,params)
+    
+    #columns: names of the values, the first is the wavelength or the time
+    def notify_point(self,filename:str,rep:int,index:int,values:np.array,columns:list=SpectrumProcessor.columns):
+        if not self.control_server is None and self.control_server.has_subscribers():
+            self.control_server.publish('point',{'filename': filename, 'rep': rep+1, 'index': index,
+                                                 'values': dict(zip(columns,map(ControlServer.to_json_value,values)))})
+    
+    #Planned wavelength grid of a scan from start_nm to end_nm. As in a stepwise scan, the last point is the first one that reaches
+    #or passes end_nm. The points are calculated from the index instead of being accumulated to avoid rounding drift.
+    def get_wl_grid(self,start_nm:float,end_nm:float,step:float) -> np.array:
+        if start_nm > end_nm:
+            inc = -step
+        else:
+            inc = step
+        n = int(np.ceil(round((end_nm-start_nm)/inc,9)))+1
+        return start_nm+np.arange(n,dtype=float)*inc
+    
     def interruptable_sleep(self,t:float):
         start = time.time()
         while (time.time()-start < t) and not self.stop_spec_trigger[0]:
             time.sleep(0.01)
 
-    def add_data_to_avg_spec(self,data,curr_rep:int):
-        #avg_spec structure: [[WL],[DC],[AC],[glum]] 
-        if curr_rep == 0:
-            self.avg_spec = np.hstack((self.avg_spec, np.array(([data[0][0]],[data[0][self.index_dc]],[data[0][self.index_ac]],[data[0][self.index_glum]]))))
+    #The files are written by the ResultWriter, it gets copies of the data because the spectrum and params can 
+    #be changed by the acquisition thread before they are saved
+    def save_spec(self,dfspec,filename,params:dict,savefig=True):
+        if savefig:
+            plot_data = self.get_spec_plot_data(True)
         else:
-            #find index where the wavelength of the new datapoint matches
-            index = np.where(self.avg_spec[0] == data[0][0])[0] 
-            if len(index) > 0:
-                #reaverage DC and AC
-                self.avg_spec[1][index[0]] = (self.avg_spec[1][index[0]]*curr_rep + data[0][self.index_dc])/(curr_rep+1)
-                self.avg_spec[2][index[0]] = (self.avg_spec[2][index[0]]*curr_rep + data[0][self.index_ac])/(curr_rep+1)
-                #recalculate glum
-                self.avg_spec[3][index[0]] = 2*self.avg_spec[2][index[0]]/self.avg_spec[1][index[0]]            
-
-    #converts a numpy array to a pandas DataFrame
-    def np_to_pd(self,spec):
-        df = pd.DataFrame(spec.T)
-        df.columns = ['WL','DC','DC_std','AC','AC_std','I_L','I_L_std','I_R','I_R_std','glum','glum_std','lp_r','lp_r_std','lp_theta','lp_theta_std','lp','lp_std']       
-        df = df.set_index('WL')
-        return df
-        
-    def df_average_spectra(self,dfspectra):      
-        self.log('')
-        self.log('Averaging...')
-        #create a copy of the Dataframe structure of a spectrum filled with zeros
-        dfavg = dfspectra[0].copy()
-        dfavg.iloc[:,:] = 0.0
-        
-        count = len(dfspectra)
-        #The error of the averaged spectrum is estimated using Gaussian propagation of uncertainty
-        for i in range(0,count):
-            dfavg['DC'] = dfavg['DC'] + dfspectra[i]['DC']/count
-            dfavg['DC_std'] = dfavg['DC_std'] + (dfspectra[i]['DC_std']/count)**2
-            dfavg['AC'] = dfavg['AC'] + dfspectra[i]['AC']/count
-            dfavg['AC_std'] = dfavg['AC_std'] + (dfspectra[i]['AC_std']/count)**2            
-            dfavg['lp_r'] =  dfavg['lp_r'] + dfspectra[i]['lp_r']/count
-            dfavg['lp_r_std'] = dfavg['lp_r_std'] + (dfspectra[i]['lp_r_std']/count)**2
-            dfavg['lp_theta'] =  dfavg['lp_theta'] + dfspectra[i]['lp_theta']/count
-            dfavg['lp_theta_std'] = dfavg['lp_theta_std'] + (dfspectra[i]['lp_theta_std']/count)**2
-            dfavg['lp'] =  dfavg['lp'] + dfspectra[i]['lp']/count
-            dfavg['lp_std'] = dfavg['lp_std'] + (dfspectra[i]['lp_std']/count)**2            
-        dfavg['AC_std'] = dfavg['AC_std']**(0.5)
-        dfavg['DC_std'] = dfavg['DC_std']**(0.5)
-        dfavg['lp_r_std'] = dfavg['lp_r_std']**(0.5)
-        dfavg['lp_theta_std'] = dfavg['lp_theta_std']**(0.5)
-        dfavg['lp_std'] = dfavg['lp_std']**(0.5)
-        
-        dfavg = self.calc_cpl(dfavg)  
-            
-        return dfavg
-    
-    def apply_corr(self,dfspec:pd.DataFrame,ac_blank:str,dc_blank:str,det_corr:str):
-        
-        #Gives True if wavelength region is suitable
-        def is_suitable(df_corr:pd.DataFrame, check_index:bool) -> bool:
-            first_WL_spec = dfspec.index[0]
-            last_WL_spec = dfspec.index[-1]
-            
-            first_WL_corr = df_corr.index[0]
-            last_WL_corr = df_corr.index[-1]
-            
-            #Check if the wavelength region in dfspec is covered by df_det_corr
-            WL_region_ok = min(first_WL_spec,last_WL_spec)>=min(first_WL_corr,last_WL_corr) and max(first_WL_spec,last_WL_spec)<=max(first_WL_corr,last_WL_corr)
-            #Check if the measured wavelength values are available in the correction file (for AC and DC without interpolation)
-            values_ok = not check_index or dfspec.index.isin(df_corr.index).all()
-            
-            return WL_region_ok and values_ok
-            
-        #Interpolate the detector correction values to match the measured wavelength values 
-        def interpolate_detcorr():
-            #Create a copy of the measured wavelengths and fill it with NaNs
-            dfspec_nan = pd.DataFrame()
-            dfspec_nan['nan'] = dfspec['AC'].copy()
-            dfspec_nan.iloc[:,0] = float('NaN')
-            
-            nonlocal df_det_corr            
-            #Add the measured wavelengths to the correction data, missing values in the correction data will be set to NaN
-            df_det_corr = pd.concat([df_det_corr, dfspec_nan], axis=1).drop('nan',axis=1)
-            #Interpolate missing values in the correction data
-            df_det_corr = df_det_corr.interpolate(method='index')
-            #Limit WL values of correction data to measured wavelengths
-            df_det_corr = df_det_corr.filter(items = dfspec_nan.index, axis=0)
-            
-        self.log('')
-        self.log('Baseline correction...')
+            plot_data = None
+        self.writer.put(filename,self.write_spec,dfspec.copy(),filename,copy.deepcopy(params),plot_data)
         
-        #Correction for detector sensitivity
-        #Todo global data path
-        if det_corr != '':
-            self.log('Detector sensitivity correction with {}'.format(".\\data\\"+det_corr+".csv"))
-            df_det_corr = pd.read_csv(filepath_or_buffer=".\\data\\"+det_corr+".csv", sep=',', index_col='WL')
-            
-            if is_corr_suitable(df_det_corr,False):
-                interpolate_detcorr()
-                dfspec['DC'] = dfspec['DC']/df_det_corr.iloc[:,0]
-                dfspec['DC_std'] = dfspec['DC_std']/df_det_corr.iloc[:,0]
-                dfspec['AC'] = dfspec['AC']/df_det_corr.iloc[:,0]            
-                dfspec['AC_std'] = dfspec['AC_std']/df_det_corr.iloc[:,0]   
-            else:
-                self.log('Detector correction file does not cover the measured wavelength range!',True)
-        
-        #AC baseline correction 
-        if ac_blank != '':
-            self.log('AC blank correction with {}'.format(".\\data\\"+ac_blank+".csv"))
-            df_ac_blank = pd.read_csv(filepath_or_buffer=".\\data\\"+ac_blank+".csv", sep=',', index_col='WL')
-            
-            if is_corr_suitable(df_ac_blank,True):
-                dfspec['AC'] = dfspec['AC'] - df_ac_blank['AC']
-                dfspec['AC_std'] = ((dfspec['AC_std']/2)**2 + (df_ac_blank['AC_std']/2)**2)**0.5
-            else:
-                self.log('AC blank correction file does not contain the measured wavelengths!',True)                
+    def write_spec(self,dfspec,filename,params:dict,plot_data:dict):
+        path = self.processor.write_spectrum(".\\data\\"+filename,dfspec,params,self.save_format)
+        self.catalog.add(filename,path,dfspec,params)
+        if not plot_data is None:
+            self.save_spec_fig(".\\data\\"+filename+'.png',plot_data)
+            self.log('Figure saved as: {}'.format(".\\data\\"+filename+'.png'))
+    
+    #Renders the spectra plot with the layout of the GUI from plot_data (see get_spec_plot_data), 
+    #a separate figure is used so that this can run outside of the GUI thread
+    def save_spec_fig(self,path:str,plot_data:dict):
+        fig = matplotlib.figure.Figure(figsize = (2.74,6.76),dpi = 100)
+        matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+        fig.set_facecolor("#FFEDCC")
+        fig.subplots_adjust(left=0.2,bottom=0.07,right=0.95,top=0.95,wspace=0.0,hspace=0.4)
         
-        #DC baseline correction
-        if dc_blank != '':
-            self.log('DC blank correction with {}'.format(".\\data\\"+dc_blank+".csv"))
-            df_dc_blank = pd.read_csv(filepath_or_buffer=".\\data\\"+dc_blank+".csv", sep=',', index_col='WL')
+        panels = [('tot','Tot. Int.',' {:.1e} V',''),
+                  ('cpl','CPL',' {:.1e} V',''),
+                  ('glum','glum',' {:.1e}','WL / nm')]
+        for i, (key, title, value_format, xlabel) in enumerate(panels):
+            data = plot_data[key]
+            avgdata = plot_data[key+'_avg']
+            ax = fig.add_subplot(311+i)
+            ax.set_facecolor("#FFF9EF")
             
-            if is_corr_suitable(df_dc_blank,True):
-                dfspec['DC'] = dfspec['DC'] - df_dc_blank['DC']
-                dfspec['DC_std'] = ((dfspec['DC_std']/2)**2 + (df_dc_blank['DC_std']/2)**2)**0.5
-            else:
-                self.log('DC blank correction file does not contain the measured wavelengths!',True)             
+            formatter = matplotlib.ticker.ScalarFormatter(useMathText=True)
+            formatter.set_scientific(True) 
+            formatter.set_powerlimits((0,0))
+            ax.yaxis.set_major_formatter(formatter)
             
-        #If there are wavelength values in the blankfiles that are not in dfspec this will give NaN values
-        #Drop all rows that contain NaN values
-        #The user must make sure that the blank files contain the correct values for the measurement
-        dfspec = dfspec.dropna(axis=0)
-        
-        dfspec = self.calc_cpl(dfspec)
-        return dfspec
-        
-    def calc_cpl(self,df):
-        df['I_L'] = (df['AC'] + df['DC'])
-        df['I_R'] = (df['DC'] - df['AC'])
-        df['glum'] = 2*df['AC']/df['DC']
-        #Gaussian error progression
-        df['I_L_std'] = ((df['AC_std'])**2 + (df['DC_std'])**2)**0.5
-        df['I_R_std'] = df['I_L_std'].copy()
-        df['glum_std'] = ((2*df['AC_std']/df['DC'])**2 + (2*df['AC']/(df['DC']**2)*df['DC_std'])**2)**0.5        
-        return df
-    
-    def save_spec(self,dfspec,filename,savefig=True):
-        dfspec.to_csv(".\\data\\"+filename+'.csv',index=True)
-        self.log('Data saved as: {}'.format(".\\data\\"+filename+'.csv'))
-        self.save_params(".\\data\\"+filename)
-        if savefig:
-            self.gui.spec_fig.savefig(".\\data\\"+filename+'.png')
-            self.log('Figure saved as: {}'.format(".\\data\\"+filename+'.png'))                 
+            if len(data[1]) > 0:
+                title = title + value_format.format(data[1][-1])
+            ax.set_title(title,fontsize=10)
+            ax.set_xlabel(xlabel,fontsize=10)
+            ax.plot(data[0],data[1])
+            if len(avgdata[0]) > 0:
+                ax.plot(avgdata[0],avgdata[1])
+            ax.axhline(y=0.0, color="#0000004E", linestyle='-')
+        fig.savefig(path)
                  
-    def save_params(self,filename):
-        with open(filename+'_params.txt', 'w') as f:
-            f.write('Specta Name = {}\n'.format(self.gui.edt_filename.get()))
-            f.write('Time = {}\n\n'.format(time.asctime(time.localtime(time.time()))))
-            f.write('Setup parameters\n')        
-            f.write('Start WL = {} nm\n'.format(self.gui.edt_start.get()))
-            f.write('End WL = {} nm\n'.format(self.gui.edt_end.get()))
-            f.write('Step = {} nm\n'.format(self.gui.edt_step.get()))
-            f.write('Dwell time = {} s\n'.format(self.gui.edt_dwell.get()))
-            f.write('Repetitions = {}\n'.format(self.gui.edt_rep.get()))
-            f.write('Exc. slit = {} nm\n'.format(self.gui.edt_excSlit.get()))
-            f.write('Em. slit = {} nm\n'.format(self.gui.edt_emSlit.get()))
-            f.write('Exc. WL = {} nm\n'.format(self.gui.edt_excWL.get()))
-            f.write('Comment = {}\n'.format(self.gui.edt_comment.get()))
-            f.write('AC-Blank-File = {}\n'.format(self.gui.edt_ac_blank.get()))
-            f.write('DC-Blank-File = {}\n'.format(self.gui.edt_dc_blank.get()))
-            f.write('PEM off = {:d}\n'.format(self.gui.var_pem_off.get()))
-            f.write('Detector Correction File = {}\n'.format(self.gui.edt_det_corr.get()))
-            f.write('PMT voltage = {} V\n'.format(self.gui.edt_pmt.get()))
-            f.write('PMT gain = {}\n'.format(self.gui.edt_gain.get()))
-            f.write('Input range = {}\n'.format(self.gui.cbx_range.get()))
-            f.write('Phase offset = {} deg\n'.format(self.gui.edt_phaseoffset.get()))
-            f.close()
-        self.log('Parameters saved as: {}'.format(".\\data\\"+filename+'_params.txt'))
-    
     def abort_measurement(self):
         self.log('')
         self.log('>>Aborting measurement<<')
         
         self.stop_spec_trigger[0] = True
+        #an abort also ends the measurement queue, the remaining jobs are skipped
+        self.stop_queue_trigger = True
         self.reactivate_after_abort()
     
+    #abort_measurement is also called by other threads (oscilloscope monitor, PMT watchdog, control server), 
+    #the check is always done in the GUI thread because it uses window.after
     def reactivate_after_abort(self):
+        if not self.gui_bus.in_gui_thread():
+            self.gui_bus.post('reactivate_after_abort',self.reactivate_after_abort)
+            return
         if not self.spec_thread is None:
             if self.spec_thread.is_alive():
                 self.gui.window.after(500, self.reactivate_after_abort)
@@ -1985,6 +5035,406 @@ class Controller(LogObject):
             self.set_acquisition_running(False)
             
     #---end of spectra acquisition section---
+    
+    
+    
+    #---Kinetics section start---
+    
+    #params: filename, wl (nm), block_time (s, averaging time of one point), duration (s, 0: until abort), 
+    #avg_blocks (number of points in the averaged plot), returns True if the measurement was started
+    def start_kinetics(self,params:dict) -> bool:
+        if not self.initialized or self.acquisition_running or self.queue_running or self.cal_running:
+            self.log('Error: Kinetics can only be started when the instruments are initialized and no measurement is running!',True)
+            return False
+        filename = params['filename']
+        error = False
+        if filename == '' or self.check_illegal_chars(filename):
+            self.log('Error: Filename is empty or contains one of these illegal characters: '+self.illegal_chars,True)
+            error = True
+        elif os.path.exists(".\\data\\"+filename+KineticsFile.suffix):
+            self.log('Error: Kinetics file {} already exists!'.format(filename+KineticsFile.suffix),True)
+            error = True
+        if params['block_time'] <= 0 or params['duration'] < 0 or params['avg_blocks'] < 1:
+            self.log('Error: Block time and averaged blocks must be positive, the duration must not be negative!',True)
+            error = True
+        if error or not self.check_signal_before_scan(0):
+            return False
+        
+        #the remaining parameters are taken from the main window as for a scan
+        kin_params = self.get_params_from_gui()
+        for key in ['start_nm','end_nm','step','reps','dwell_time']:
+            kin_params.pop(key)
+        kin_params.update(params)
+        kin_params['mode'] = 'kinetics'
+        #kinetics are always measured with the PEM on, the checkbox of the main window only applies to scans
+        kin_params['pem_off'] = 0
+        
+        self.kinetics_avg_blocks = params['avg_blocks']
+        self.stop_spec_trigger[0] = False
+        self.set_acquisition_running(True)
+        self.gui.set_spec_xlabel('t / s')
+        self.spec_thread = th.Thread(target=self.record_kinetics,args=(kin_params,))
+        self.spec_thread.start()
+        self.update_spec()
+        return True
+    
+    #will be executed in separate thread
+    #Every point is one call of MFLI.read_data with block_time as dwell time, so the values and their standard deviations
+    #are calculated exactly as for a scan. The latest points are kept in a KineticsBuffer, all points are written to the 
+    #file in chunks by the ResultWriter.
+    def record_kinetics(self,params:dict):
+        filename = params['filename']
+        columns = ['t']+SpectrumProcessor.columns[1:]
+        self.log('')
+        self.log('Kinetics at {:.2f} nm with {:.3f} s per point'.format(params['wl'],params['block_time']))
+        
+        self.move_nm(params['wl'])
+        self.lockin_lock.acquire()
+        self.lockin.set_dwell_time(params['block_time'])
+        params['mfli_config'] = self.lockin.get_config_snapshot()
+        self.lockin_lock.release()
+        self.interruptable_sleep(self.lowpass_filter_risetime)
+        
+        self.kinetics = KineticsBuffer(self.kinetics_capacity,17)
+        kin_file = KineticsFile(".\\data\\"+filename,columns)
+        self.writer.put(kin_file.path,kin_file.create,params)
+        self.notify_clients('scan',{'state': 'started', 'filename': filename, 'mode': 'kinetics'})
+        
+        chunk = []
+        failures = 0
+        t0 = time.time()
+        while not self.stop_spec_trigger[0] and (params['duration'] == 0 or time.time()-t0 < params['duration']):
+            t_start = time.time()
+            self.lockin_lock.acquire()
+            data = self.lockin.read_data(self.stop_spec_trigger)
+            self.lockin_lock.release()
+            if self.stop_spec_trigger[0]:
+                break
+            
+            if not data['success']:
+                failures += 1
+                if failures >= 5:
+                    self.log('Could not collect data after 5 tries, aborting...',True)
+                    self.stop_spec_trigger[0] = True
+                continue
+            failures = 0
+            
+            #the time of a point is the middle of its block
+            values = np.concatenate(([(t_start+time.time())/2-t0],data['data']))
+            self.kinetics.append(values)
+            chunk.append(values)
+            if len(chunk) >= self.kinetics_chunk_size:
+                self.writer.put(kin_file.path,kin_file.write_chunk,np.array(chunk))
+                chunk = []
+            self.notify_point(filename,0,self.kinetics.count-1,values,columns)
+            self.set_canvas_text(self.gui.txt_progress,'{:d} points, {:.0f} s'.format(self.kinetics.count,time.time()-t0))
+        
+        if len(chunk) > 0:
+            self.writer.put(kin_file.path,kin_file.write_chunk,np.array(chunk))
+        self.log('Kinetics stopped after {:d} points ({:.0f} s).'.format(self.kinetics.count,time.time()-t0))
+        self.set_acquisition_running(False)
+        
+        failed = self.writer.flush()
+        if len(failed) > 0:
+            self.log('Error: {} could not be saved!'.format(kin_file.path),True)
+        else:
+            self.log('All files are saved.')
+        
+        self.notify_clients('scan',{'state': 'aborted' if self.stop_spec_trigger[0] else 'finished', 'filename': filename, 'mode': 'kinetics'})
+        self.stop_spec_trigger[0] = False
+    
+    #---Kinetics section end---
+    
+    
+    
+    #---Map section start---
+    
+    #axis: {'type': one of scan_axis_types, 'name': optional, 'values': [...] or 'start', 'stop', 'step', 
+    #'options': {class attribute: value}}, returns the ScanAxis and its values
+    def create_scan_axis(self,axis:dict):
+        if not axis.get('type') in self.scan_axis_types:
+            raise ValueError('Unknown axis type {}, allowed are: {}'.format(axis.get('type'),', '.join(self.scan_axis_types)))
+        scan_axis = self.scan_axis_types[axis['type']](self,axis.get('name',axis['type']),**axis.get('options',{}))
+        if 'values' in axis:
+            values = np.asarray(axis['values'],dtype=float)
+        else:
+            step = float(axis['step'])
+            if not step > 0:
+                raise ValueError('The step of axis {} must be positive'.format(scan_axis.name))
+            if scan_axis.spectral:
+                values = self.get_wl_grid(float(axis['start']),float(axis['stop']),step)
+            else:
+                values = self.get_clamped_grid(float(axis['start']),float(axis['stop']),step)
+        if values.size == 0:
+            raise ValueError('Axis {} has no values'.format(scan_axis.name))
+        return scan_axis, values
+    
+    #Values of a map axis from start to stop. Unlike get_wl_grid, the last value never passes stop, so that e.g. 
+    #a magnet is not driven beyond the requested field.
+    def get_clamped_grid(self,start:float,stop:float,step:float) -> np.array:
+        if start > stop:
+            inc = -step
+        else:
+            inc = step
+        n = int(np.floor(round((stop-start)/inc,9)))+1
+        return start+np.arange(n,dtype=float)*inc
+    
+    #params: filename, dwell_time, axes (list of dicts, see create_scan_axis), returns True if the map was started
+    def start_map(self,params:dict) -> bool:
+        if not self.initialized or self.acquisition_running or self.queue_running or self.cal_running:
+            self.log('Error: A map can only be started when the instruments are initialized and no measurement is running!',True)
+            return False
+        filename = params['filename']
+        if filename == '' or self.check_illegal_chars(filename):
+            self.log('Error: Filename is empty or contains one of these illegal characters: '+self.illegal_chars,True)
+            return False
+        if os.path.exists(".\\data\\"+filename+MapDataset.suffix):
+            self.log('Error: Map {} already exists!'.format(filename+MapDataset.suffix),True)
+            return False
+        try:
+            planner = MapPlanner([self.create_scan_axis(axis) for axis in params['axes']])
+            names = [axis.name for axis in planner.axes]
+            if len(set(names)) < len(names) or len(names) == 0:
+                raise ValueError('The names of the axes must be unique')
+            if params['dwell_time'] <= 0:
+                raise ValueError('The dwell time must be positive')
+        except (ValueError, TypeError, KeyError, ZeroDivisionError) as e:
+            self.log('Error: Invalid map: '+str(e),True)
+            return False
+        if not self.check_signal_before_scan(0):
+            return False
+        
+        map_params = self.get_params_from_gui()
+        for key in ['start_nm','end_nm','step','reps','dwell_time']:
+            map_params.pop(key)
+        map_params.update(params)
+        map_params['mode'] = 'map'
+        #maps are always measured with the PEM on, the checkbox of the main window only applies to scans
+        map_params['pem_off'] = 0
+        map_params['wl'] = self.curr_nm
+        
+        self.stop_spec_trigger[0] = False
+        self.set_acquisition_running(True)
+        self.spec_thread = th.Thread(target=self.record_map,args=(map_params,planner))
+        self.spec_thread.start()
+        return True
+    
+    #will be executed in separate thread
+    #Every point is measured with MFLI.read_data as a point of a spectrum. The actual values of the axes and the 
+    #measured values are written to one MapDataset.
+    def record_map(self,params:dict,planner:MapPlanner):
+        filename = params['filename']
+        columns = [axis.name for axis in planner.axes]+SpectrumProcessor.columns[1:]
+        self.log('')
+        self.log('Map with {:d} points, axes (slowest first): {}'.format(planner.size,', '.join(
+            '{} ({:d} values, {:d} moves)'.format(axis.name,values.size,moves) for axis, values, moves in zip(planner.axes,planner.values,planner.count_moves()))))
+        
+        #Every error aborts the map, the axes are disconnected and the dataset is closed in any case
+        connected = []
+        dataset = None
+        failed = False
+        t0 = time.time()
+        try:
+            for axis in planner.axes:
+                if not axis.connect():
+                    raise RuntimeError('Axis {} could not be connected'.format(axis.name))
+                connected.append(axis)
+            
+            with self.lockin_lock:
+                self.lockin.set_dwell_time(params['dwell_time'])
+                params['mfli_config'] = self.lockin.get_config_snapshot()
+            new_dataset = MapDataset(".\\data\\"+filename,planner,columns)
+            new_dataset.create(params)
+            dataset = new_dataset
+            self.notify_clients('scan',{'state': 'started', 'filename': filename, 'mode': 'map', 'points': planner.size})
+            
+            last = None
+            for n, index in enumerate(planner.iter_order()):
+                if self.stop_spec_trigger[0]:
+                    break
+                try:
+                    #the slower axes are moved first
+                    for k, axis in enumerate(planner.axes):
+                        if last is None or index[k] != last[k]:
+                            axis.move(planner.values[k][index[k]])
+                    last = index
+                except Exception as e:
+                    raise RuntimeError('Error while moving the axes to {}: {}'.format(index,str(e)))
+                self.interruptable_sleep(self.lowpass_filter_risetime)
+                
+                #Try 5 times to get a valid dataset from the MFLI
+                j = 0
+                success = False
+                while (j<5) and not success and not self.stop_spec_trigger[0]:
+                    with self.lockin_lock:
+                        data = self.lockin.read_data(self.stop_spec_trigger)
+                    success = data['success']
+                    j += 1
+                if self.stop_spec_trigger[0]:
+                    break
+                if not success:
+                    raise RuntimeError('Could not collect data after 5 tries')
+                
+                values = np.concatenate(([axis.read() for axis in planner.axes],data['data']))
+                dataset.write(index,values)
+                if dataset.count % dataset.flush_points == 0:
+                    self.writer.put(dataset.path,dataset.flush)
+                self.notify_point(filename,0,n,values,columns)
+                self.set_canvas_text(self.gui.txt_progress,'{:d}/{:d} points, {:.0f} s'.format(n+1,planner.size,time.time()-t0))
+        except Exception as e:
+            self.log('Error: {}, map aborted.'.format(str(e)),True)
+            failed = True
+        finally:
+            if not dataset is None:
+                self.writer.put(dataset.path,dataset.close,not (failed or self.stop_spec_trigger[0]))
+                self.log('Map stopped after {:d}/{:d} points ({:.0f} s).'.format(dataset.count,planner.size,time.time()-t0))
+            for axis in connected:
+                try:
+                    axis.disconnect()
+                except Exception as e:
+                    self.log('Error while disconnecting axis {}: {}'.format(axis.name,str(e)),True)
+            self.set_acquisition_running(False)
+        
+        if len(self.writer.flush()) > 0:
+            self.log('Error: {} could not be saved!'.format(filename+MapDataset.suffix),True)
+            failed = True
+        elif not dataset is None:
+            self.log('All files are saved.')
+        
+        if failed:
+            state = 'failed'
+        elif self.stop_spec_trigger[0]:
+            state = 'aborted'
+        else:
+            state = 'finished'
+        self.notify_clients('scan',{'state': state, 'filename': filename, 'mode': 'map'})
+        self.stop_spec_trigger[0] = False
+    
+    #---Map section end---
+    
+    
+    
+    #---Measurement queue section start---
+    
+    def queue_dialog_open(self):
+        self.meas_queue = MeasurementQueue(self)
+        self.queue_window = QueueDialog(self,self.meas_queue)
+    
+    #Returns True if the queue was started
+    def start_queue(self,meas_queue) -> bool:
+        if self.initialized and not self.acquisition_running and not self.queue_running:
+            if meas_queue.validate():
+                self.meas_queue = meas_queue
+                self.stop_spec_trigger[0] = False
+                self.stop_queue_trigger = False
+                self.queue_running = True
+                self.set_active_components()
+                
+                #The queue thread takes the place of the spectra thread, so that update_spec and abort_measurement work as usual
+                self.spec_thread = th.Thread(target=self.run_queue,args=(meas_queue,))
+                self.spec_thread.start()
+                self.update_spec()
+                return True
+        else:
+            self.log('Error: Queue can only be started when the instruments are initialized and no measurement is running!',True)
+        return False
+    
+    #will be executed in separate thread
+    def run_queue(self,meas_queue):
+        self.log('')
+        self.log('Starting measurement queue with {:d} jobs.'.format(len(meas_queue.jobs)))
+        t0 = time.time()
+        
+        i = 0
+        while (i < len(meas_queue.jobs)) and not self.stop_queue_trigger:
+            job = meas_queue.jobs[i]
+            meas_queue.current_job = i
+            self.log('')
+            self.log('Queue job {:d}/{:d}: {} ({})'.format(i+1,len(meas_queue.jobs),job['filename'],job['type']))
+            
+            self.apply_job_settings(job)            
+            if not self.stop_queue_trigger and not self.check_signal_before_scan(job['pem_off']):
+                self.log('Stopping measurement queue.',True)
+                self.stop_queue_trigger = True
+            if not self.stop_queue_trigger:
+                self.set_acquisition_running(True)
+                self.record_spec(job)
+                meas_queue.jobs_done = i+1
+            i += 1
+        
+        meas_queue.current_job = -1
+        self.queue_running = False
+        self.set_acquisition_running(False)
+        self.log('')
+        if self.stop_queue_trigger:
+            self.log('Measurement queue aborted after {:d}/{:d} jobs ({:.0f} s).'.format(meas_queue.jobs_done,len(meas_queue.jobs),time.time()-t0))
+        else:
+            self.log('Measurement queue finished ({:.0f} s).'.format(time.time()-t0))
+        self.stop_queue_trigger = False
+        
+    #Sets PMT voltage, input range and phase offset of a queued job or a resumed scan and waits for the PMT to stabilize
+    def apply_job_settings(self,job:dict):
+        self.set_PMT_voltage(job['pmt_volt'])
+        
+        if job['input_range'] == 'auto':
+            self.set_auto_range()
+        else:
+            self.set_input_range(float(job['input_range']))
+            self.set_cbx_text(self.gui.cbx_range,job['input_range'])
+        
+        if job['phaseoffset'] != '':
+            self.set_phaseoffset(float(job['phaseoffset']))
+            
+        #Save the values that were actually applied in the parameter file of the job
+        job['pmt_gain'] = '{:.3f}'.format(self.volt_to_gain(job['pmt_volt']))
+        job['input_range'] = '{:.3f}'.format(self.lockin.signal_range)
+        job['phaseoffset'] = '{:.3f}'.format(self.lockin.phaseoffset)
+        
+        self.log('Waiting {} s for PMT stabilization...'.format(self.pmt_settle_time))
+        start = time.time()
+        while (time.time()-start < self.pmt_settle_time) and not self.stop_queue_trigger:
+            time.sleep(0.01)
+    
+    def click_resume(self):
+        path = tk.filedialog.askopenfilename(initialdir='.\\data\\', filetypes=[('Scan journals','*'+ScanJournal.extension)])
+        if path != '':
+            self.resume_spec(path)
+    
+    #Continues an interrupted scan from its journal
+    def resume_spec(self,path:str):
+        if self.initialized and not self.acquisition_running and not self.queue_running:
+            journal = ScanJournal(os.path.splitext(path)[0])
+            try:
+                params = journal.load()
+            except Exception as e:
+                self.log('Error: Could not read the journal {}: {}'.format(path,str(e)),True)
+                return
+            self.log('')
+            self.log('Resuming {} from {} ({} points).'.format(params['filename'],path,len(journal.points)))
+            
+            self.stop_spec_trigger[0] = False
+            self.stop_queue_trigger = False
+            self.set_acquisition_running(True)
+            
+            self.spec_thread = th.Thread(target=self.run_resume,args=(params,journal))
+            self.spec_thread.start()
+            self.update_spec()
+        else:
+            self.log('Error: A scan can only be resumed when the instruments are initialized and no measurement is running!',True)
+    
+    #will be executed in separate thread
+    def run_resume(self,params:dict,journal:ScanJournal):
+        #the devices are set to the state of the interrupted scan
+        params['pmt_volt'] = float(params['pmt_volt'])
+        self.apply_job_settings(params)
+        if not self.stop_queue_trigger and self.check_signal_before_scan(params['pem_off']):
+            self.record_spec(params,journal)
+        else:
+            self.log('Scan was not resumed.',True)
+        self.set_acquisition_running(False)
+        self.stop_queue_trigger = False
+    
+    #---Measurement queue section end---
                 
         
         
@@ -1992,23 +5442,23 @@ class Controller(LogObject):
     
     def set_modulation_active(self,b):
         #deactivating phase-locked loop on PEM reference in lock-in to retain last PEM frequency
-        self.lockin_daq_lock.acquire()
-        self.lockin_daq.set_extref_active(0,b)
-        self.lockin_daq.daq.sync()
-        self.lockin_daq_lock.release()
+        self.lockin_lock.acquire()
+        self.lockin.set_extref_active(0,b)
+        self.lockin.sync()
+        self.lockin_lock.release()
 
         #deactivating pem will cut off reference signal and modulation
         self.pem_lock.acquire()
         self.pem.set_active(b)         
         self.pem_lock.release()
         if not b:
-            self.gui.canvas.itemconfigure(self.gui.txt_PEM, text='off')
+            self.set_canvas_text(self.gui.txt_PEM,'off')
     
     def set_phaseoffset(self,value):
         if initialized:
-            self.lockin_daq_lock.acquire()
-            self.lockin_daq.set_phaseoffset(value)
-            self.lockin_daq_lock.release()
+            self.lockin_lock.acquire()
+            self.lockin.set_phaseoffset(value)
+            self.lockin_lock.release()
   
     def move_nm(self,nm,move_pem=True):
         self.log('')
@@ -2027,6 +5477,7 @@ class Controller(LogObject):
             while mono_thread.is_alive():
                 time.sleep(0.02)
                 
+            self.curr_nm = nm
             self.update_mono_edt_lbl(nm)
             
             if self.acquisition_running:
@@ -2054,34 +5505,37 @@ class Controller(LogObject):
     
     def set_PMT_voltage(self, volt):
         try:
-            self.lockin_daq_lock.acquire()
-            self.lockin_daq.set_PMT_voltage(volt,False)
-            self.lockin_daq_lock.release()
+            self.lockin_lock.acquire()
+            self.lockin.set_PMT_voltage(volt,False)
+            self.lockin_lock.release()
             
             self.update_PMT_voltage_edt(volt)
         except Exception as e:
             self.log('Error in set_PMT_voltage: '+str(e),True)
     
-    def rescue_pmt(self):
-        self.log('Signal ({:.2f} V) higher than threshold ({:.2f} V)!! Setting PMT to 0 V'.format(self.max_volt,self.shutdown_threshold),True)
-        self.set_PMT_voltage(0.0)  
+    #Called by the PMT watchdog after it has set the PMT voltage to 0 V
+    def pmt_watchdog_tripped(self,level:float,latency:float):
+        if self.acquisition_running or self.lockin.acquiring:
+            self.abort_measurement()
+            self.stop_cal_trigger[0] = True
+        self.update_PMT_voltage_edt(0.0)
     
     def set_input_range(self,f):
-        self.lockin_daq_lock.acquire()
-        self.lockin_daq.set_input_range(f=f,auto=False)
-        self.lockin_daq_lock.release()
+        self.lockin_lock.acquire()
+        self.lockin.set_input_range(f=f,auto=False)
+        self.lockin_lock.release()
     
     def set_auto_range(self):
-        self.lockin_daq_lock.acquire()
-        self.lockin_daq.set_input_range(f=0.0,auto=True)
-        self.gui.cbx_range.set('{:.3f}'.format(self.lockin_daq.signal_range))
-        self.lockin_daq_lock.release()
+        self.lockin_lock.acquire()
+        self.lockin.set_input_range(f=0.0,auto=True)
+        self.set_cbx_text(self.gui.cbx_range,'{:.3f}'.format(self.lockin.signal_range))
+        self.lockin_lock.release()
     
     def set_phaseoffset(self,f):
-        self.lockin_daq_lock.acquire()
-        self.lockin_daq.set_phaseoffset(f)
+        self.lockin_lock.acquire()
+        self.lockin.set_phaseoffset(f)
         self.update_phaseoffset_edt(f)
-        self.lockin_daq_lock.release()            
+        self.lockin_lock.release()            
     
     #---control functions end---
     
@@ -2094,9 +5548,19 @@ class Controller(LogObject):
         self.max_volt = 0.0
         self.avg_volt = 0.0
         
-        self.lockin_osc_lock.acquire()
-        self.lockin_osc.start_scope()
-        self.lockin_osc_lock.release()
+        #the oscilloscope does not require lockin_lock, the MFLI class coordinates the access to the shared API session
+        self.lockin.start_scope()
+        
+        #The watchdog reads the oscilloscope and checks the polled demodulator data for too high signals
+        self.watchdog = self.lockin.create_watchdog(self.log_queue,self.pmt_watchdog_tripped)
+        self.watchdog.shutdown_threshold = self.shutdown_threshold
+        self.lockin.watchdog = self.watchdog
+        self.watchdog.start()
+        
+        self.scope_analyzer = ScopeAnalyzer()
+        self.scope_analysis = None
+        self.clip_history = collections.deque(maxlen=self.clip_refresh_count)
+        
         self.monit_thread = th.Thread(target=self.monit_osc_loop)
         self.monit_thread.start()   
         
@@ -2105,51 +5569,55 @@ class Controller(LogObject):
     def refresh_osc(self):
         self.update_osc_captions(self.max_volt,self.gui.txt_maxVolt)     
         self.update_osc_captions(self.avg_volt,self.gui.txt_avgVolt)  
-        self.update_osc_plots(max_vals=np.asarray(self.max_volt_history))
+        self.update_scope_analysis_caption(self.scope_analysis)
+        self.update_osc_plots()
         if self.monit_thread.is_alive():
             self.gui.window.after(self.osc_refresh_delay,self.refresh_osc)
     
-    #Collects current max. voltage in self.max_volt_history, will be executed in separate thread
+    #Writes the current max. voltage into the signal tuning graph, will be executed in separate thread
+    #The oscilloscope is read by the PMT watchdog, this loop only takes the latest values for display and input range checks
     def monit_osc_loop(self):
+        last_analysis = 0.0
+        last_wave_count = 0
         while not self.stop_osc_trigger:
             time.sleep(self.osc_refresh_delay/1000)
             
-            self.lockin_osc_lock.acquire()
-            scope_data = self.lockin_osc.read_scope()
-            self.lockin_osc_lock.release()
+            #only new traces are shown and analysed, otherwise the same trace would be counted several times
+            wave_count = self.watchdog.wave_count
+            if wave_count == last_wave_count:
+                continue
+            last_wave_count = wave_count
             
-            self.max_volt = scope_data[0]
-            self.avg_volt = scope_data[1]            
+            self.max_volt = self.watchdog.max_volt
+            self.avg_volt = self.watchdog.avg_volt            
+            wave = self.watchdog.wave
             if not np.isnan(self.max_volt):
-                self.max_volt_history.append(self.max_volt)
+                self.gui.osc_trace.append(self.max_volt)
+            #the analysis runs less often than the graph is updated
+            if not np.isnan(self.max_volt) and not wave is None and time.time() - last_analysis >= self.scope_analysis_delay:
+                last_analysis = time.time()
                 
-                #Check if value reached input range limit by checking if the last 5 values are the same and
-                #close to input range (>95%)     
-                if len(self.max_volt_history) >= 5:
-                    range_limit_reached = True 
-                    for i in range(2,6):
-                        range_limit_reached = range_limit_reached and (math.isclose(self.max_volt_history[-i],self.max_volt,abs_tol=0.000000001)
-                            and (self.max_volt_history[-i]>=0.95*self.lockin_daq.signal_range))
-                    
-                    #Check if value too high (may cause damage to PMT) for several consecutive values
-                    pmt_limit_reached = True
-                    for i in range(1,4):
-                        pmt_limit_reached = pmt_limit_reached and (self.max_volt_history[-i] >= self.shutdown_threshold)
-                        
+                ref_freq, ref_locked = self.lockin.read_ref_status()
+                self.scope_analysis = self.scope_analyzer.analyze(wave,self.lockin.scope_rate,self.lockin.signal_range,ref_freq,ref_locked,self.lockin.pem_freq)
+                self.clip_history.append(self.scope_analysis['clip_fraction'])
+                
+                #Check if the signal reached the input range limit by checking the fraction of clipped samples in the last traces
+                if len(self.clip_history) >= self.clip_refresh_count:
+                    range_limit_reached = min(self.clip_history) >= self.clip_fraction_limit
+
+                    #The monitor sees whether the shared session is acquiring data (also during phase offset calibration)
+                    #A running acquisition is stopped first, so that it releases lockin_lock
                     if range_limit_reached:
-                        self.set_auto_range()
-                        if self.acquisition_running:
+                        if self.acquisition_running or self.lockin.acquiring:
                             self.log('Input range limit reached during measurement! Restart with higher input range or lower gain. Aborting...', True)
                             self.abort_measurement()                        
-                    if pmt_limit_reached:
-                        self.rescue_pmt()
-                        if self.acquisition_running:
-                            self.abort_measurement()
+                            self.stop_cal_trigger[0] = True
+                        self.set_auto_range()
                     
         if self.stop_osc_trigger:
-            self.lockin_osc_lock.acquire()
-            self.lockin_osc.stop_scope()
-            self.lockin_osc_lock.release()
+            self.watchdog.stop()
+            self.lockin.watchdog = None
+            self.lockin.stop_scope()
             
             self.stop_osc_trigger = False
                 
@@ -2162,7 +5630,7 @@ class Controller(LogObject):
     def cal_phaseoffset_start(self):
         self.log('')
         self.log('Starting calibration...')
-        self.log('Current phaseoffset: {:.3f} deg'.format(self.lockin_daq.phaseoffset))
+        self.log('Current phaseoffset: {:.3f} deg'.format(self.lockin.phaseoffset))
         
         self.cal_running = True
         self.cal_collecting = False
@@ -2184,9 +5652,9 @@ class Controller(LogObject):
 
     def cal_record_thread(self,positive):
         self.log('Thread started...')
-        self.lockin_daq_lock.acquire()
-        avg = self.lockin_daq.read_ac_theta(self.stop_cal_trigger)
-        self.lockin_daq_lock.release()
+        self.lockin_lock.acquire()
+        avg = self.lockin.read_ac_theta(self.stop_cal_trigger)
+        self.lockin_lock.release()
         
         if positive:
             self.cal_pos_theta = avg
@@ -2195,7 +5663,7 @@ class Controller(LogObject):
         self.log('Thread stopped...')
         
     def cal_get_current_values(self):
-        return self.lockin_daq.ac_theta_avg,self.lockin_daq.ac_theta_count
+        return self.lockin.ac_theta_avg,self.lockin.ac_theta_count
     
     def cal_stop_record(self):
         if self.cal_collecting:
@@ -2217,7 +5685,7 @@ class Controller(LogObject):
             n += 1
         if n>0:
             self.log('Change in phaseoffset: {:.3f} deg'.format(difference/n))
-            result = self.lockin_daq.phaseoffset + difference/n
+            result = self.lockin.phaseoffset + difference/n
         self.cal_new_value = result
         return result
       
@@ -2245,7 +5713,7 @@ class Controller(LogObject):
         self.log('End of phase calibration.')
         
         #Save new calibration in last parameters file
-        self.save_params('last')
+        self.processor.save_params('last',self.get_params_from_gui())
         
     #---Phase offset calibration section end---
 
@@ -2253,5 +5721,13 @@ class Controller(LogObject):
 # In[46]:
 
 
-ctr = Controller()
+#python catcpl.py batch ... starts the batch processing (see BatchProcessor) instead of the GUI,
+#python catcpl.py client ... sends a command to a running CatCPL (see ControlClient)
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(BatchProcessor().main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'client':
+        sys.exit(ControlClient.main(sys.argv[2:]))
+    else:
+        ctr = Controller()
 
@@ -25,11 +25,202 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import time
 import numpy as np
 
+#Min/max decimation of a long trace with sorted x values (ascending or descending): the min. and max. of blocks 
+#of factor**k points are kept in a pyramid, so that a range of the data can be returned with at most max_points 
+#points (two per block) that contain all extrema. Appending points only updates the last blocks of every level.
+class MinMaxDecimator():
+    factor = 4 #points per block of the next level
+    
+    def __init__(self):
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        #levels[k]: min. and max. of the blocks of factor**(k+1) points
+        self.levels = []
+    
+    def set_data(self,x,y):
+        x = np.asarray(x,dtype=float)
+        y = np.asarray(y,dtype=float)
+        n = self.x.size
+        #if the new data is longer and ends the old data at the same point, it is assumed that points were only appended
+        #and the complete blocks of the old data are kept
+        appended = x.size > n > 0 and x[n-1] == self.x[-1] and (y[n-1] == self.y[-1] or (np.isnan(y[n-1]) and np.isnan(self.y[-1])))
+        if not appended:
+            self.levels = []
+        self.x = x.copy()
+        self.y = y.copy()
+        
+        src_min = self.y
+        src_max = self.y
+        k = 0
+        while src_min.size >= self.factor:
+            if k == len(self.levels):
+                self.levels.append((np.empty(0),np.empty(0)))
+            dst_min, dst_max = self.levels[k]
+            done = dst_min.size
+            n_blocks = src_min.size // self.factor
+            if n_blocks > done:
+                #NaN values are ignored by fmin and fmax
+                new_min = np.fmin.reduce(src_min[done*self.factor:n_blocks*self.factor].reshape(-1,self.factor),axis=1)
+                new_max = np.fmax.reduce(src_max[done*self.factor:n_blocks*self.factor].reshape(-1,self.factor),axis=1)
+                self.levels[k] = (np.concatenate((dst_min,new_min)),np.concatenate((dst_max,new_max)))
+            src_min, src_max = self.levels[k]
+            k += 1
+        del self.levels[k:]
+    
+    #Returns the indices of the first and behind the last point in the x range (including one point outside on each side)
+    def find_range(self,x0,x1):
+        if self.x.size == 0:
+            return 0, 0
+        if self.x[-1] < self.x[0]:
+            i0 = self.x.size - np.searchsorted(self.x[::-1],max(x0,x1),side='right')
+            i1 = self.x.size - np.searchsorted(self.x[::-1],min(x0,x1),side='left')
+        else:
+            i0 = np.searchsorted(self.x,min(x0,x1),side='left')
+            i1 = np.searchsorted(self.x,max(x0,x1),side='right')
+        return max(i0-1,0), min(i1+1,self.x.size)
+    
+    #Returns x and y with at most max_points points for the x range x0 to x1
+    def get(self,x0,x1,max_points):
+        i0, i1 = self.find_range(x0,x1)
+        if i1 - i0 <= max_points:
+            return self.x[i0:i1], self.y[i0:i1]
+        
+        #lowest level with at most max_points/2 blocks in the range
+        k = 0
+        block = self.factor
+        while k < len(self.levels) - 1 and 2*((i1 - 1)//block - i0//block + 1) > max_points:
+            k += 1
+            block *= self.factor
+        mins, maxs = self.levels[k]
+        j0 = i0//block
+        j1 = min((i1 - 1)//block + 1,mins.size)
+        mins = mins[j0:j1]
+        maxs = maxs[j0:j1]
+        starts = np.arange(j0,j1)*block
+        ends = starts + block - 1
+        
+        #points behind the last complete block form one additional block
+        if i1 > j1*block:
+            with np.errstate(all='ignore'):
+                mins = np.append(mins,np.fmin.reduce(self.y[j1*block:i1]))
+                maxs = np.append(maxs,np.fmax.reduce(self.y[j1*block:i1]))
+            starts = np.append(starts,j1*block)
+            ends = np.append(ends,i1 - 1)
+        
+        #min. and max. of every block at the center of the block
+        xc = (self.x[starts] + self.x[ends])/2
+        return np.repeat(xc,2), np.column_stack((mins,maxs)).ravel()
+
+
+#Line that shows a long trace with at most about two points per pixel of the axes (see MinMaxDecimator). 
+#The points are selected again if the x limits of the axes change (e.g. zoom).
+class DecimatedLine():
+    points_per_pixel = 2
+    
+    def __init__(self,ax,**kwargs):
+        self.ax = ax
+        self.line, = ax.plot([],[],**kwargs)
+        self.decimator = MinMaxDecimator()
+        ax.callbacks.connect('xlim_changed',lambda ax: self.render())
+        
+    def set_data(self,x,y):
+        self.decimator.set_data(x,y)
+        self.render()
+        
+    def render(self):
+        x0, x1 = self.ax.get_xlim()
+        max_points = max(int(self.ax.bbox.width*self.points_per_pixel),16)
+        self.line.set_data(*self.decimator.get(x0,x1,max_points))
+
+
+#Fast plot of the latest values of a signal (signal tuning): the x axis is fixed, the values and the times when
+#they were measured are written into a ring buffer (also from other threads) and the line is drawn onto the saved
+#background by blitting. The axes are only redrawn if the y limits have to change.
+class ScopeTrace():
+    margin = 0.2 #margin of the y limits as fraction of the data range
+    min_fill = 0.25 #new limits are set if the data covers less than this fraction of them
+    
+    #n_points: capacity of the ring buffer, time_step: shortest time between two values (s)
+    def __init__(self,canvas,ax,n_points,time_step):
+        self.canvas = canvas
+        self.ax = ax
+        self.ring = np.full(n_points,np.nan)
+        self.time_ring = np.full(n_points,np.nan) #time.monotonic() of the values
+        self.index = 0 #next position in the ring buffer
+        #ordered values for drawing, x: time in s, the current time is at 0
+        self.x = np.full(n_points,np.nan)
+        self.y = np.full(n_points,np.nan)
+        self.background = None
+        
+        formatter = ticker.ScalarFormatter(useMathText=True)
+        formatter.set_scientific(True) 
+        formatter.set_powerlimits((0,0))
+        ax.yaxis.set_major_formatter(formatter)
+        ax.set_xlim(-(n_points - 1)*time_step,0.0)
+        self.line, = ax.plot(self.x,self.y,animated=True)
+        self.cid = canvas.mpl_connect('draw_event',self.on_draw)
+        
+    #The values do not have to arrive in fixed intervals, each one is drawn at its time
+    def append(self,value,t=None):
+        self.ring[self.index] = value
+        self.time_ring[self.index] = time.monotonic() if t is None else t
+        self.index = (self.index + 1) % self.ring.size
+        
+    def clear(self):
+        self.ring[:] = np.nan
+        self.time_ring[:] = np.nan
+        
+    def on_draw(self,event):
+        self.background = self.canvas.copy_from_bbox(self.ax.figure.bbox)
+        self.ax.draw_artist(self.line)
+        
+    def disconnect(self):
+        self.canvas.mpl_disconnect(self.cid)
+        self.line.remove()
+    
+    #Sets new y limits if the values are outside of the current limits or only cover a small part of them, 
+    #returns True if the limits were changed
+    def update_limits(self) -> bool:
+        valid = self.y[np.isfinite(self.y)]
+        if valid.size == 0:
+            return False
+        low, high = valid.min(), valid.max()
+        span = high - low
+        if span == 0:
+            span = abs(high)*0.1 if high != 0 else 1.0
+        curr_low, curr_high = self.ax.get_ylim()
+        if low < curr_low or high > curr_high or span < (curr_high - curr_low)*self.min_fill:
+            self.ax.set_ylim(low - span*self.margin, high + span*self.margin)
+            return True
+        return False
+        
+    def refresh(self):
+        i = self.index
+        n = self.ring.size - i
+        #oldest values first
+        self.y[:n] = self.ring[i:]
+        self.y[n:] = self.ring[:i]
+        self.x[:n] = self.time_ring[i:]
+        self.x[n:] = self.time_ring[:i]
+        self.x -= time.monotonic()
+        self.line.set_data(self.x,self.y)
+        
+        if self.update_limits() or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.figure.bbox)
+
+
 class GUI():
     OUTPUT_PATH = Path(__file__).parent
     ASSETS_PATH = OUTPUT_PATH / Path("./assets")
 
     k = 0
+    spec_margin = 0.2 #margin of the y limits of the spectra plots as fraction of the data range
+    spec_min_fill = 0.25 #new limits are set if the data covers less than this fraction of them
+    spec_zoom_factor = 1.5 #zoom of the x axis of the spectra plots per step of the mouse wheel
         
     def get_state_const(self,b):
         if b:
@@ -61,6 +252,7 @@ class GUI():
             top=0.88, 
             wspace=0.0, 
             hspace=0.0)
+        self.osc_trace = None
         self.osc_canvas.draw()
         
         self.spec_fig = Figure(figsize = (2.74,6.76),dpi = 100)
@@ -86,70 +278,146 @@ class GUI():
             top=0.95, 
             wspace=0.0, 
             hspace=0.4)
+        self.setup_spec_artists()
         self.spec_canvas.draw()
-
-    def plot(self,fig,canvas,ax,xlabel,ylabel,title,data,avgdata=[]):
-        ax.clear()
         
-        formatter = ticker.ScalarFormatter(useMathText=True)
-        formatter.set_scientific(True) 
-        formatter.set_powerlimits((0,0))        
-
-        ax.set_xlabel(xlabel,fontsize=10)
-        ax.set_ylabel(ylabel,fontsize=10)
-        ax.set_title(title,fontsize=10)
-        ax.yaxis.set_major_formatter(formatter)
-
-        ax.plot(data[0], data[1])    
-        
-        if len(avgdata) > 0:
-            if len(avgdata[0]) == len(avgdata[1]) and len(avgdata[0]) > 0:
-                ax.plot(avgdata[0], avgdata[1])    
-
-        if fig == self.osc_fig:
-            fig.subplots_adjust(
-                left=0.12,
-                bottom=0.2, 
-                right=0.985, 
-                top=0.88, 
-                wspace=0.0, 
-                hspace=0.0)
-            ax.set_facecolor("#FFFDF1")
-            fig.set_facecolor("#FFFAD5")
-        elif fig == self.spec_fig:
-            fig.subplots_adjust(
-                left=0.2,
-                bottom=0.07, 
-                right=0.95, 
-                top=0.95, 
-                wspace=0.0, 
-                hspace=0.4) 
-            ax.set_facecolor("#FFF9EF")
-            fig.set_facecolor("#FFEDCC")
+    #The lines and titles of the spectra plots are kept and updated with set_data. They are drawn onto the saved 
+    #background (axes, ticks, labels) by blitting, the whole figure is only redrawn if the axes limits change.
+    def setup_spec_artists(self):
+        self.spec_artists = {}
+        self.spec_lines = {}
+        self.spec_background = None
+        for ax in [self.total_ax,self.cpl_ax,self.glum_ax]:
+            formatter = ticker.ScalarFormatter(useMathText=True)
+            formatter.set_scientific(True) 
+            formatter.set_powerlimits((0,0))
+            ax.yaxis.set_major_formatter(formatter)
             ax.axhline(y=0.0, color="#0000004E", linestyle='-')
-        canvas.draw()
+            
+            #long spectra are decimated to the resolution of the plot
+            line = DecimatedLine(ax,animated=True)
+            avg_line = DecimatedLine(ax,animated=True)
+            title = ax.set_title('',fontsize=10)
+            title.set_animated(True)
+            self.spec_lines[ax] = [line,avg_line]
+            self.spec_artists[ax] = [line.line,avg_line.line,title]
+        self.glum_ax.set_xlabel('WL / nm',fontsize=10)
+        self.spec_canvas.mpl_connect('draw_event',self.on_spec_draw)
         
-    
-    def plot_osc(self,data_max,max_len,time_step):
-        self.plot(fig=self.osc_fig,canvas=self.osc_canvas,ax=self.osc_ax,data=[[-(min(max_len,data_max.size)-i)/(time_step/10) for i in range(0,data_max.size)], data_max],xlabel='',ylabel='',title='')
-    
-    def plot_spec(self,tot,tot_avg,cpl,cpl_avg,glum,glum_avg):
-        s = 'Tot. Int.'
-        if len(tot[1]) > 0:
-            s = s + ' {:.1e} V'.format(tot[1][-1])   
-        self.plot(self.spec_fig,self.spec_canvas,self.total_ax,'','',s,tot,tot_avg)
+        self.spec_zoomed = False
+        self.spec_last_plot = None #arguments of the last call of plot_spec
+        self.spec_canvas.mpl_connect('scroll_event',self.on_spec_scroll)
+        self.spec_canvas.mpl_connect('button_press_event',self.on_spec_click)
         
-        s = 'CPL'
-        if len(cpl[1]) > 0:
-            s = s + ' {:.1e} V'.format(cpl[1][-1])           
-        self.plot(self.spec_fig,self.spec_canvas,self.cpl_ax,'','',s,cpl,cpl_avg)
+    #The mouse wheel zooms the x axis of all spectra plots around the mouse position, the lines are decimated again 
+    #for the visible range. The x limits are kept until a double click or the start of a scan with another range.
+    def on_spec_scroll(self,event):
+        if event.inaxes is None or event.xdata is None:
+            return
+        if event.button == 'up':
+            factor = 1/self.spec_zoom_factor
+        else:
+            factor = self.spec_zoom_factor
+        x0, x1 = event.inaxes.get_xlim()
+        self.spec_zoomed = True
+        for ax in self.spec_lines:
+            ax.set_xlim(event.xdata - (event.xdata - x0)*factor, event.xdata + (x1 - event.xdata)*factor)
+        self.spec_canvas.draw()
+        
+    def on_spec_click(self,event):
+        if event.dblclick and self.spec_zoomed:
+            self.reset_spec_zoom()
+            
+    def reset_spec_zoom(self):
+        self.spec_zoomed = False
+        if not self.spec_last_plot is None:
+            self.plot_spec(*self.spec_last_plot,reset_xlim=True)
+        
+    #Called after every complete redraw of the spectra figure
+    def on_spec_draw(self,event):
+        self.spec_background = self.spec_canvas.copy_from_bbox(self.spec_fig.bbox)
+        self.draw_spec_artists()
+        
+    def draw_spec_artists(self):
+        for artists in self.spec_artists.values():
+            for artist in artists:
+                self.spec_fig.draw_artist(artist)
                 
-        s = 'glum'
-        if len(glum[1]) > 0:
-            s = s + ' {:.1e}'.format(glum[1][-1])   
-        self.plot(self.spec_fig,self.spec_canvas,self.glum_ax,'WL / nm','',s,glum,glum_avg)    
-
+    #Sets new limits if the data is outside of the current limits or only covers a small part of them (new scan),
+    #returns True if the limits were changed. The y limits get a margin so that only a few redraws are necessary 
+    #while the spectrum grows, the x limits are the wavelength range of the scan if it is known.
+    #reset_xlim: the x limits are set in any case (end of zoom), while zoomed only the y limits are set
+    def update_spec_limits(self,ax,data,avgdata,wl_range,reset_xlim=False):
+        x = np.concatenate((np.asarray(data[0],dtype=float),np.asarray(avgdata[0],dtype=float)))
+        y = np.concatenate((np.asarray(data[1],dtype=float),np.asarray(avgdata[1],dtype=float)))
+        valid = np.isfinite(x) & np.isfinite(y)
+        if not valid.any():
+            return False
+        x = x[valid]
+        y = y[valid]
+        
+        changed = False
+        if not wl_range is None:
+            xlim = (min(wl_range),max(wl_range))
+            margin = 0.0
+        else:
+            xlim = (x.min(),x.max())
+            margin = self.spec_margin
+        limits = [((y.min(),y.max()),self.spec_margin,ax.get_ylim,ax.set_ylim,False)]
+        if not self.spec_zoomed:
+            limits.append((xlim,margin,ax.get_xlim,ax.set_xlim,reset_xlim))
+        for (low, high), margin, get_lim, set_lim, force in limits:
+            span = high - low
+            if span == 0:
+                span = abs(high)*0.1 if high != 0 else 1.0
+            curr_low, curr_high = get_lim()
+            if force or low < curr_low or high > curr_high or span < (curr_high - curr_low)*self.spec_min_fill:
+                set_lim(low - span*margin, high + span*margin)
+                changed = True
+        return changed
+
+    #'WL / nm' for spectra, 't / s' for kinetics
+    def set_spec_xlabel(self,label):
+        if self.glum_ax.get_xlabel() != label:
+            self.glum_ax.set_xlabel(label,fontsize=10)
+            self.spec_canvas.draw()
+
+    #the values of the last (n_points - 1)*time_step s are shown in the signal tuning graph, at most one every time_step
+    def setup_osc_trace(self,n_points,time_step):
+        if not self.osc_trace is None:
+            self.osc_trace.disconnect()
+        self.osc_trace = ScopeTrace(self.osc_canvas,self.osc_ax,n_points,time_step)
+        self.osc_canvas.draw()
     
+    #wl_range: wavelength range of the scan for the x axis
+    def plot_spec(self,tot,tot_avg,cpl,cpl_avg,glum,glum_avg,wl_range=None,reset_xlim=False):
+        #a scan with another range ends the zoom
+        if self.spec_zoomed and not self.spec_last_plot is None and self.spec_last_plot[6] != wl_range:
+            self.spec_zoomed = False
+            reset_xlim = True
+        self.spec_last_plot = (tot,tot_avg,cpl,cpl_avg,glum,glum_avg,wl_range)
+        redraw = reset_xlim
+        for ax, title, value_format, data, avgdata in [(self.total_ax,'Tot. Int.',' {:.1e} V',tot,tot_avg),
+                                                        (self.cpl_ax,'CPL',' {:.1e} V',cpl,cpl_avg),
+                                                        (self.glum_ax,'glum',' {:.1e}',glum,glum_avg)]:
+            line, avg_line = self.spec_lines[ax]
+            if len(data[1]) > 0:
+                title = title + value_format.format(data[1][-1])
+            if len(avgdata) == 0 or len(avgdata[0]) != len(avgdata[1]):
+                avgdata = [[],[]]
+            #the limits are set first, the lines are decimated for the visible range
+            redraw = self.update_spec_limits(ax,data,avgdata,wl_range,reset_xlim) or redraw
+            line.set_data(data[0],data[1])
+            avg_line.set_data(avgdata[0],avgdata[1])
+            self.spec_artists[ax][2].set_text(title)
+        
+        if redraw or self.spec_background is None:
+            self.spec_canvas.draw()
+        else:
+            self.spec_canvas.restore_region(self.spec_background)
+            self.draw_spec_artists()
+            self.spec_canvas.blit(self.spec_fig.bbox)
+
     def set_spectra_setup_enable(self,b):
         self.edt_start['state'] = self.get_state_const(b)
         self.edt_end['state'] = self.get_state_const(b)
@@ -313,6 +581,15 @@ class GUI():
             font=("Calibri", 20 * -1)
         )
 		
+        self.txt_scope_analysis = self.canvas.create_text(
+            34.0,
+            534.0,
+            anchor="nw",
+            text="",
+            fill="#000000",
+            font=("Calibri", 14 * -1)
+        )
+		
         self.txt_intensity = self.canvas.create_text(
             795.0,
             72.0,
@@ -1179,6 +1456,45 @@ class GUI():
             height=53.0
         )
 
+        self.btn_queue = Button(
+            text="Queue...",
+            font=("Calibri", 16 * -1),
+            command=lambda: print("btn_queue clicked"),
+            master=self.window
+        )
+        self.btn_queue.place(
+            x=363.0,
+            y=632.0,
+            width=85.0,
+            height=26.0
+        )
+
+        self.btn_kinetics = Button(
+            text="Kinetics...",
+            font=("Calibri", 16 * -1),
+            command=lambda: print("btn_kinetics clicked"),
+            master=self.window
+        )
+        self.btn_kinetics.place(
+            x=458.0,
+            y=632.0,
+            width=85.0,
+            height=26.0
+        )
+
+        self.btn_resume = Button(
+            text="Resume...",
+            font=("Calibri", 16 * -1),
+            command=lambda: print("btn_resume clicked"),
+            master=self.window
+        )
+        self.btn_resume.place(
+            x=553.0,
+            y=632.0,
+            width=85.0,
+            height=26.0
+        )
+
         self.button_image_6 = PhotoImage(
             file=self.relative_to_assets("button_6.png"),master=self.window)
         self.btn_abort = Button(